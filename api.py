@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Look up elevations for paths held in NumPy arrays, from other Python code
+
+import numpy as np
+from shapely.geometry import box  # type: ignore
+from typing import Optional
+
+from cache import Bounds
+from data import DataSourceError, NULL_ELEVATION, SourceRouter  # noqa: F401
+
+__author__ = "Eldan Goldenberg for A/B Street, February-March 2021"
+__license__ = "Apache"
+
+
+class ElevationLookup:
+    # e.g.:
+    #   area = (-122.5, 47.4, -122.2, 47.8)
+    #   with ElevationLookup("datasources.json", area) as lookup:
+    #       stats = lookup.tag_paths(coords, offsets)
+    #       elevations = lookup.sample_points(xy)
+    # If bbox is given, the data sources for that area are loaded once, up
+    # front, and kept for every later call; points outside it get no data.
+    # Otherwise each call loads whatever its own input needs.
+    # Problems with data sources raise DataSourceError.
+
+    def __init__(
+        self,
+        datasources: str = "datasources.json",
+        bbox: Optional[Bounds] = None,
+        data_dir: str = "data",
+        n_threads: int = 1,
+        block_cache_mb: int = 0,
+        crop_cache_mb: int = 0,
+        contour_max_distance: Optional[float] = None,
+        contour_index: bool = True,
+        logger_name: str = __name__
+    ) -> None:
+        self.n_threads: int = n_threads
+        self.bbox: Optional[Bounds] = bbox
+        self.router = SourceRouter(
+            logger_name,
+            data_dir,
+            datasources,
+            None if bbox is None else box(*bbox),
+            block_cache_mb=block_cache_mb,
+            crop_cache_mb=crop_cache_mb,
+            contour_max_distance=contour_max_distance,
+            contour_index=contour_index
+        )
+        if bbox is not None:
+            self.router.warm(n_threads)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.close()
+
+    def tag_paths(self, coords: np.ndarray, offsets: np.ndarray) -> np.ndarray:
+        # Takes paths as an (n, 2) array of x, y vertices in decimal degrees,
+        # and an array of len(paths) + 1 offsets so that path i is
+        # coords[offsets[i]:offsets[i + 1]].  Returns an (len(paths), 4)
+        # array of [start, end, climb, descent] in metres, with NaNs for
+        # paths that couldn't be tagged.
+        coords = np.asarray(coords, dtype=np.float64)
+        offsets = np.asarray(offsets, dtype=np.int64)
+        if coords.ndim != 2 or coords.shape[1] != 2:
+            raise ValueError("coords must be an (n, 2) array")
+        if len(offsets) == 0 or offsets[0] != 0 or \
+                offsets[-1] != len(coords) or np.any(np.diff(offsets) < 1):
+            raise ValueError(
+                "offsets must run from 0 to len(coords), with at least "
+                "one vertex per path"
+            )
+        if len(offsets) == 1:
+            return np.empty((0, 4), dtype=np.float64)
+        if self.bbox is None:
+            results: np.ndarray = self.router.tag_paths(
+                coords, offsets, self.n_threads
+            )
+        else:
+            results = self.router.submit(
+                (0, coords, offsets), self.n_threads
+            ).get()
+        results = results.astype(np.float64)
+        results[results[:, 0] == NULL_ELEVATION] = np.nan
+        return results
+
+    def sample_points(self, xy: np.ndarray) -> np.ndarray:
+        # Takes an (n, 2) array of x, y points in decimal degrees, and
+        # returns an array of their n elevations in metres, with NaNs for
+        # points that have no data
+        xy = np.asarray(xy, dtype=np.float64)
+        return self.tag_paths(xy, np.arange(len(xy) + 1))[:, 0]
+
+    def close(self) -> None:
+        self.router.close()
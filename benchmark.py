@@ -0,0 +1,536 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Measure lookup throughput on synthetic data, and compare results between
+# runs to catch performance regressions
+
+import hashlib
+import json
+import logging
+import math
+import os
+import platform
+import subprocess
+import sys
+import time
+
+import click
+import geopandas as gp  # type: ignore
+import numpy as np
+import psutil  # type: ignore
+import pyproj
+import rasterio  # type: ignore
+from rasterio.transform import from_origin  # type: ignore
+from shapely.geometry import box, LineString  # type: ignore
+from typing import Dict, List, Optional, Tuple
+
+__author__ = "Eldan Goldenberg for A/B Street, February-March 2021"
+__license__ = "Apache"
+
+
+RESULTS_VERSION: int = 2  # bump if the format of results files changes
+SEED: int = 20210301  # so every run generates exactly the same data
+AREA: Tuple[float, float, float, float] = (-1, 50, 1, 52)  # W, S, E, N
+# paths are kept a little inside the data sources' area
+PATHS_AREA: Tuple[float, float, float, float] = (-0.9, 50.1, 0.9, 51.9)
+RASTER_RESOLUTION: float = 0.001  # degrees, for the EPSG:4326 DEM
+PROJECTED_CRS: str = "EPSG:32630"  # UTM zone 30N
+PROJECTED_RESOLUTION: float = 100  # metres, for the projected DEM
+NODATA: float = -32768
+N_NODATA_HOLES: int = 20
+N_CONTOURS: int = 500
+RSS_POLL_INTERVAL: float = 0.05  # seconds
+# how the input is read: all at once, as by default, or with --stream
+MODES: List[str] = ["whole", "stream"]
+# lookup method for each benchmark case, with the source it uses
+METHODS: Dict[str, Dict] = {
+    "raster": {
+        "filename": "dem4326.tif",
+        "crs": "EPSG:4326",
+        "lookup_method": "raster",
+        "lookup_field": 1
+    },
+    "raster_projected": {
+        "filename": "dem_projected.tif",
+        "crs": PROJECTED_CRS,
+        "lookup_method": "raster",
+        "lookup_field": 1
+    },
+    "contour_lines": {
+        "filename": "contours.geojson",
+        "crs": "EPSG:4326",
+        "lookup_method": "contour_lines",
+        "lookup_field": "elevation"
+    }
+}
+
+
+@click.group()
+def cli() -> None:
+    pass
+
+
+@cli.command()
+@click.option(
+    '--work_dir',
+    default='benchmark',
+    help=('Directory to generate synthetic data in and run from, '
+            'or leave out for default value: "benchmark".  Data that is '  # noqa: E127, E501
+            'already there is reused')
+)
+@click.option(
+    '--sizes',
+    default='1000,10000,100000,1000000',
+    help=('Comma-separated numbers of paths to benchmark with, '
+            'or leave out for default value: 1000,10000,100000,1000000')  # noqa: E127, E501
+)
+@click.option(
+    '--methods',
+    default=','.join(METHODS.keys()),
+    help=('Comma-separated lookup methods to benchmark, '
+            'or leave out for all of them: ' + ','.join(METHODS.keys()))  # noqa: E127, E501
+)
+@click.option(
+    '--modes',
+    default=','.join(MODES),
+    help=('Comma-separated ways of reading the input to benchmark: "whole" '
+            'to read it all before looking it up, as by default, or "stream" '  # noqa: E127, E501
+            'to stream it in batches.  Leave out for both')
+)
+@click.option(
+    '--threads',
+    default='1,' + str(os.cpu_count()),
+    help=('Comma-separated values of --n_threads to benchmark, '
+            'or leave out for 1 and the number of CPU cores')  # noqa: E127, E501
+)
+@click.option(
+    '--repeat',
+    default=1,
+    help=('Number of times to run each case, keeping the fastest, '
+            'or leave out for default value: 1')  # noqa: E127, E501
+)
+@click.option(
+    '--output',
+    default=None,
+    help=('File to save results to as JSON, '
+            'or leave out to only print them')  # noqa: E127, E501
+)
+def run(
+    work_dir: str,
+    sizes: str,
+    methods: str,
+    modes: str,
+    threads: str,
+    repeat: int,
+    output: Optional[str]
+) -> None:
+    # Each case runs in a fresh process, so that startup time and peak
+    # memory use are measured the same way as for a real run of main.py
+    logging.basicConfig(
+        format='%(asctime)s %(levelname)s:\t%(message)s',
+        datefmt='%Y%m%d %H:%M'
+    )
+    logger = logging.getLogger(__name__)
+    logger.setLevel(logging.INFO)
+    n_lines_list: List[int] = [int(x) for x in sizes.split(",")]
+    method_list: List[str] = methods.split(",")
+    for method in method_list:
+        if method not in METHODS:
+            logger.critical('Unknown lookup method "%s"', method)
+            sys.exit(1)
+    mode_list: List[str] = modes.split(",")
+    for mode in mode_list:
+        if mode not in MODES:
+            logger.critical('Unknown mode "%s"', mode)
+            sys.exit(1)
+    threads_list: List[int] = [int(x) for x in threads.split(",")]
+    generate_data(work_dir, n_lines_list)
+    cases: List[Dict] = []
+    for method in method_list:
+        # one untimed run first, so that any index or cache a source builds
+        # on first use is in place, as it would be for all but the first
+        # real run
+        measure_case(work_dir, method, mode_list[0], 1, min(n_lines_list))
+        for mode in mode_list:
+            for n_threads in threads_list:
+                for n_lines in n_lines_list:
+                    runs: List[Dict] = [
+                        measure_case(
+                            work_dir, method, mode, n_threads, n_lines
+                        )
+                        for i in range(repeat)
+                    ]
+                    case: Dict = min(runs, key=lambda r: r["run_s"])
+                    logger.info(
+                        "%s, %s, %s threads, %s lines: %s lines/s, "
+                        "%s points/s, startup %ss, peak RSS %s MB",
+                        method,
+                        mode,
+                        n_threads,
+                        n_lines,
+                        round(case["lines_per_s"]),
+                        round(case["points_per_s"]),
+                        round(case["startup_s"], 2),
+                        round(case["peak_rss_mb"])
+                    )
+                    cases.append(case)
+    results: Dict = {
+        "version": RESULTS_VERSION,
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "cases": cases
+    }
+    if output is None:
+        print(json.dumps(results, indent=2))
+    else:
+        with open(output, 'w') as f:
+            json.dump(results, f, indent=2)
+        logger.info("Results saved to %s", output)
+
+
+@cli.command()
+@click.option(
+    '--threshold',
+    default=0.1,
+    help=('Fraction by which a case can be worse than the baseline before '
+            'it counts as a regression, or leave out for default value: 0.1')  # noqa: E127, E501
+)
+@click.argument('baseline')
+@click.argument('current')
+def compare(threshold: float, baseline: str, current: str) -> None:
+    # Prints how each case in current compares to the same case in
+    # baseline, and exits with status 1 if any of them has regressed
+    with open(baseline) as f:
+        before: Dict = json.load(f)
+    with open(current) as f:
+        after: Dict = json.load(f)
+    baseline_cases: Dict[Tuple, Dict] = {
+        case_key(case): case for case in before["cases"]
+    }
+    regressions: int = 0
+    print("\t".join([
+        "method", "mode", "threads", "lines",
+        "lines/s", "change", "startup s", "change", "peak MB", "change", ""
+    ]))
+    for case in after["cases"]:
+        old: Optional[Dict] = baseline_cases.get(case_key(case))
+        if old is None:
+            print("\t".join(str(x) for x in case_key(case)) + "\tnew case")
+            continue
+        # for each measure, how much worse it has become, as a fraction
+        worse: List[float] = [
+            1 - case["lines_per_s"] / old["lines_per_s"],
+            case["startup_s"] / old["startup_s"] - 1,
+            case["peak_rss_mb"] / old["peak_rss_mb"] - 1
+        ]
+        notes: List[str] = []
+        if any(x > threshold for x in worse):
+            notes.append("REGRESSION")
+            regressions += 1
+        if case["output_md5"] != old["output_md5"]:
+            notes.append("output changed")
+        print("\t".join(str(x) for x in case_key(case) + (
+            round(case["lines_per_s"]),
+            percentage(-worse[0]),
+            round(case["startup_s"], 2),
+            percentage(worse[1]),
+            round(case["peak_rss_mb"]),
+            percentage(worse[2]),
+            ", ".join(notes)
+        )))
+    if regressions > 0:
+        print(
+            "%s cases regressed by more than %s" % (
+                regressions, percentage(threshold)
+            )
+        )
+        sys.exit(1)
+    sys.exit(0)
+
+
+@cli.command()
+@click.option('--work_dir', default='benchmark')
+@click.option(
+    '--method',
+    type=click.Choice(list(METHODS.keys())),
+    default="raster"
+)
+@click.option('--mode', type=click.Choice(MODES), default="whole")
+@click.option('--n_threads', default=1)
+@click.option('--n_lines', default=1000)
+def measure(
+    work_dir: str,
+    method: str,
+    mode: str,
+    n_threads: int,
+    n_lines: int
+) -> None:
+    # Runs a single case and prints its timings as JSON.  This is what run
+    # starts a fresh process for, and isn't usually needed on its own.
+    # Imported here so that their import time counts towards startup.
+    from data import SourceRouter
+    from files import InputFile, OutputFile
+    logging.basicConfig(format='%(levelname)s:\t%(message)s')
+    logging.getLogger(__name__).setLevel(logging.ERROR)
+    input_dir: str = os.path.join(work_dir, "input")
+    output_dir: str = os.path.join(work_dir, "output")
+    os.makedirs(output_dir, exist_ok=True)
+    # As in main.py, the input is opened before the data sources are
+    # loaded, which for the "whole" mode includes reading all of it, so that
+    # counts towards startup time
+    infile = InputFile(
+        __name__,
+        input_dir,
+        paths_file(n_lines),
+        stream=mode == "stream",
+        bbox=box(*PATHS_AREA)
+    )
+    with SourceRouter(
+        __name__,
+        os.path.join(work_dir, "data"),
+        sources_file(work_dir, method),
+        box(*PATHS_AREA)
+    ) as d:
+        d.warm(n_threads)
+        startup_s: float = time.time() - psutil.Process().create_time()
+        start_time: float = time.time()
+        with OutputFile(__name__, output_dir, method) as outfile:
+            infile.tag_elevations(d, outfile, n_threads)
+        run_s: float = time.time() - start_time
+    with open(os.path.join(work_dir, "input", paths_file(n_lines))) as f:
+        n_points: int = sum(row.count(" ") + 1 for row in f)
+    with open(os.path.join(output_dir, method), 'rb') as f:
+        output_md5: str = hashlib.md5(f.read()).hexdigest()
+    print(json.dumps({
+        "method": method,
+        "mode": mode,
+        "n_threads": n_threads,
+        "n_lines": n_lines,
+        "n_points": n_points,
+        "startup_s": startup_s,
+        "run_s": run_s,
+        "lines_per_s": n_lines / run_s,
+        "points_per_s": n_points / run_s,
+        "output_md5": output_md5
+    }))
+
+
+
+
+
+def measure_case(
+    work_dir: str,
+    method: str,
+    mode: str,
+    n_threads: int,
+    n_lines: int
+) -> Dict:
+    # runs one case in a fresh process, and adds the peak memory use of it
+    # and its workers to the timings it reports
+    proc = subprocess.Popen(
+        [
+            sys.executable,
+            os.path.abspath(__file__),
+            "measure",
+            "--work_dir", work_dir,
+            "--method", method,
+            "--mode", mode,
+            "--n_threads", str(n_threads),
+            "--n_lines", str(n_lines)
+        ],
+        stdout=subprocess.PIPE
+    )
+    peak_rss: int = 0
+    parent = psutil.Process(proc.pid)
+    while proc.poll() is None:
+        # shared memory is counted once for each process that uses it, so
+        # this overstates the real total for rasters shared between workers
+        rss: int = 0
+        try:
+            for p in [parent] + parent.children(recursive=True):
+                rss += p.memory_info().rss
+        except psutil.Error:
+            # a process ended while we were looking at it
+            pass
+        peak_rss = max(peak_rss, rss)
+        time.sleep(RSS_POLL_INTERVAL)
+    out, _ = proc.communicate()
+    if proc.returncode != 0:
+        raise click.ClickException(
+            "%s, %s with %s threads and %s lines failed" % (
+                method, mode, n_threads, n_lines
+            )
+        )
+    case: Dict = json.loads(out.decode("utf-8").strip().split("\n")[-1])
+    case["peak_rss_mb"] = peak_rss / 1024 / 1024
+    return case
+
+
+def case_key(case: Dict) -> Tuple[str, str, int, int]:
+    # results from before modes were added were all streamed
+    return (
+        case["method"],
+        case.get("mode", "stream"),
+        case["n_threads"],
+        case["n_lines"]
+    )
+
+
+def percentage(fraction: float) -> str:
+    return "%+.1f%%" % (fraction * 100)
+
+
+def paths_file(n_lines: int) -> str:
+    return "paths_" + str(n_lines)
+
+
+def sources_file(work_dir: str, method: str) -> str:
+    return os.path.join(work_dir, "datasources_" + method + ".json")
+
+
+def generate_data(work_dir: str, sizes: List[int]) -> None:
+    # Writes synthetic data sources and input files to work_dir, unless
+    # they're there already.  Everything is generated from a fixed seed, so
+    # it's the same on every machine.
+    logger = logging.getLogger(__name__)
+    data_dir: str = os.path.join(work_dir, "data")
+    input_dir: str = os.path.join(work_dir, "input")
+    os.makedirs(data_dir, exist_ok=True)
+    os.makedirs(input_dir, exist_ok=True)
+    for method, source in METHODS.items():
+        with open(sources_file(work_dir, method), 'w') as f:
+            json.dump({"sources": [dict(
+                source,
+                name=method,
+                url=None,
+                bbox=list(AREA),
+                download_method="local",
+                units="meters",
+                recheck_interval_days=None
+            )]}, f, indent=2)
+        path: str = os.path.join(data_dir, source["filename"])
+        if os.path.exists(path):
+            continue
+        logger.info("Generating %s", path)
+        if method == "raster":
+            write_dem(path, source["crs"], RASTER_RESOLUTION)
+        elif method == "raster_projected":
+            write_dem(path, source["crs"], PROJECTED_RESOLUTION)
+        else:
+            write_contours(path)
+    for n_lines in sizes:
+        path = os.path.join(input_dir, paths_file(n_lines))
+        if not os.path.exists(path):
+            logger.info("Generating %s", path)
+            write_paths(path, n_lines)
+
+
+def terrain(xs: np.ndarray, ys: np.ndarray) -> np.ndarray:
+    # smooth hills and valleys, in metres, for points in decimal degrees
+    return (
+        200 + 150 * np.sin(xs * 7) * np.cos(ys * 5) +
+        50 * np.sin(xs * 31 + ys * 23) + 500 * (ys - AREA[1])
+    )
+
+
+def write_dem(path: str, crs: str, resolution: float) -> None:
+    # a DEM of terrain() over AREA, with rectangular holes of nodata
+    rng = np.random.default_rng(SEED)
+    to_crs = pyproj.Transformer.from_crs("EPSG:4326", crs, always_xy=True)
+    xs, ys = to_crs.transform(
+        [AREA[0], AREA[0], AREA[2], AREA[2]],
+        [AREA[1], AREA[3], AREA[1], AREA[3]]
+    )
+    west: float = min(xs)
+    north: float = max(ys)
+    width: int = math.ceil((max(xs) - west) / resolution)
+    height: int = math.ceil((north - min(ys)) / resolution)
+    cols, rows = np.meshgrid(np.arange(width), np.arange(height))
+    lons, lats = pyproj.Transformer.from_crs(
+        crs, "EPSG:4326", always_xy=True
+    ).transform(
+        west + (cols + 0.5) * resolution,
+        north - (rows + 0.5) * resolution
+    )
+    values: np.ndarray = terrain(lons, lats).astype(np.float32)
+    values += rng.normal(0, 0.5, values.shape).astype(np.float32)
+    for i in range(N_NODATA_HOLES):
+        row: int = int(rng.integers(0, height))
+        col: int = int(rng.integers(0, width))
+        values[row:row + height // 50, col:col + width // 50] = NODATA
+    with rasterio.open(
+        path,
+        'w',
+        driver='GTiff',
+        width=width,
+        height=height,
+        count=1,
+        dtype='float32',
+        crs=crs,
+        transform=from_origin(west, north, resolution, resolution),
+        nodata=NODATA,
+        tiled=True
+    ) as dst:
+        dst.write(values, 1)
+
+
+def write_contours(path: str) -> None:
+    # wavy east-west contours spread evenly across AREA
+    xs: np.ndarray = np.linspace(AREA[0], AREA[2], 200)
+    ys: np.ndarray = AREA[1] + \
+        (np.arange(N_CONTOURS) + 0.5) * (AREA[3] - AREA[1]) / N_CONTOURS
+    gp.GeoDataFrame(
+        {"elevation": np.round(terrain(np.zeros(N_CONTOURS), ys))},
+        geometry=[
+            LineString(np.column_stack([xs, y + 0.002 * np.sin(xs * 40 + i)]))
+            for i, y in enumerate(ys)
+        ],
+        crs="EPSG:4326"
+    ).to_file(path, driver="GeoJSON")
+
+
+def write_paths(path: str, n_lines: int) -> None:
+    # A road-like network: a jittered grid of junctions covering
+    # PATHS_AREA, with each path running between neighbouring junctions
+    # through a few intermediate points, so that junctions are shared
+    # between up to 4 paths.  Paths are in the order of the grid, as road
+    # network extracts tend to be roughly spatially ordered.
+    rng = np.random.default_rng(SEED + n_lines)
+    side: int = math.ceil(math.sqrt(n_lines / 2)) + 1
+    spacing_x: float = (PATHS_AREA[2] - PATHS_AREA[0]) / side
+    spacing_y: float = (PATHS_AREA[3] - PATHS_AREA[1]) / side
+    junctions: np.ndarray = np.stack(np.meshgrid(
+        PATHS_AREA[0] + (np.arange(side) + 0.5) * spacing_x,
+        PATHS_AREA[1] + (np.arange(side) + 0.5) * spacing_y,
+        indexing="ij"
+    ), axis=-1)
+    junctions += rng.uniform(-0.25, 0.25, junctions.shape) * \
+        [spacing_x, spacing_y]
+    written: int = 0
+    with open(path, 'w') as f:
+        for i in range(side):
+            for j in range(side):
+                for di, dj in [(1, 0), (0, 1)]:
+                    if written == n_lines:
+                        return
+                    if i + di == side or j + dj == side:
+                        continue
+                    start: np.ndarray = junctions[i, j]
+                    end: np.ndarray = junctions[i + di, j + dj]
+                    steps: np.ndarray = np.linspace(
+                        0, 1, int(rng.integers(2, 8))
+                    )[:, None]
+                    points: np.ndarray = start + (end - start) * steps
+                    points[1:-1] += rng.normal(
+                        0, 0.05, points[1:-1].shape
+                    ) * [spacing_x, spacing_y]
+                    f.write(" ".join(
+                        "%.6f,%.6f" % (x, y) for x, y in points
+                    ) + "\n")
+                    written += 1
+
+
+
+if __name__ == "__main__":
+    cli()
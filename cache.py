@@ -0,0 +1,404 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# persistent caches of merged and cropped rasters, and of results
+
+import hashlib
+import json
+import logging
+import os
+import tempfile
+
+try:
+    import fcntl
+except ImportError:  # not available on Windows, where we don't lock at all
+    fcntl = None  # type: ignore
+
+import numpy as np
+import rasterio  # type: ignore
+from typing import Any, Dict, List, Optional, Tuple
+
+
+Bounds = Tuple[float, float, float, float]
+
+
+class CropCache:
+    # Rasters are saved as <key>.tif with a <key>.json sidecar describing
+    # them.  Entries are keyed by the source files (including their mtimes
+    # and sizes, so a refreshed source never matches an old entry), the
+    # band, and the bounds covered.  The sidecar is only written once its
+    # raster is complete, so a half-written entry is never visible.  The
+    # sidecar's mtime records when the entry was last used, for LRU eviction.
+    # Each entry found or stored is kept locked, through its <key>.lock,
+    # until release() is called, and locked entries are never evicted, so
+    # the rasters returned stay there for as long as they're being used.
+
+    def __init__(
+        self,
+        logger_name: str,
+        cache_dir: str,
+        max_mb: int
+    ) -> None:
+        self.logger = logging.getLogger(logger_name)
+        self.cache_dir: str = cache_dir
+        self.max_bytes: int = max_mb * 1024 * 1024
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir, exist_ok=True)
+        self.lock_path: str = os.path.join(self.cache_dir, ".lock")
+        self.held: List[CacheLock] = []
+
+
+    def find(
+        self,
+        sources: List[str],
+        band: int,
+        bounds: Bounds
+    ) -> Optional[str]:
+        # returns the path of the smallest cached raster made from exactly
+        # these sources which covers bounds, or None if there isn't one
+        source_key: str = self.__source_key__(sources, band)
+        best: Optional[Tuple[float, str]] = None
+        with self.__locked__(exclusive=False):
+            for key, meta in self.__entries__():
+                cached: List[float] = meta["bounds"]
+                if meta["source_key"] == source_key and \
+                        cached[0] <= bounds[0] and cached[1] <= bounds[1] and \
+                        cached[2] >= bounds[2] and cached[3] >= bounds[3]:
+                    area: float = (
+                        (cached[2] - cached[0]) * (cached[3] - cached[1])
+                    )
+                    if best is None or area < best[0]:
+                        best = (area, key)
+            if best is None:
+                return None
+            # mark the entry as recently used
+            os.utime(self.__path__(best[1], ".json"))
+            self.__hold__(best[1])
+        self.logger.info(
+            'Using cached raster %s',
+            self.__path__(best[1], ".tif")
+        )
+        return self.__path__(best[1], ".tif")
+
+
+    def store(
+        self,
+        sources: List[str],
+        band: int,
+        bounds: Bounds,
+        values: np.ndarray,
+        profile: Dict[str, Any]
+    ) -> str:
+        # saves values as a new entry covering bounds, and returns its path
+        source_key: str = self.__source_key__(sources, band)
+        key: str = hashlib.sha1(
+            (source_key + json.dumps(list(bounds))).encode("utf-8")
+        ).hexdigest()
+        path: str = self.__path__(key, ".tif")
+        self.logger.info('Caching raster for %s as %s', bounds, path)
+        # write everything under temporary names and then rename them into
+        # place, so that concurrent readers never see a partial file
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+        os.close(fd)
+        try:
+            with rasterio.open(tmp_path, 'w', **profile) as dst:
+                dst.write(values, 1)
+            # mkstemp makes files only readable by their owner
+            os.chmod(tmp_path, 0o644)
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        meta: Dict[str, Any] = {
+            "source_key": source_key,
+            "sources": sources,
+            "band": band,
+            "bounds": list(bounds),
+            "size": os.path.getsize(path)
+        }
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+        with os.fdopen(fd, 'w') as f:
+            json.dump(meta, f)
+        os.chmod(tmp_path, 0o644)
+        with self.__locked__(exclusive=True):
+            os.replace(tmp_path, self.__path__(key, ".json"))
+            self.__hold__(key)
+            self.__evict__()
+        return path
+
+
+    def release(self) -> None:
+        # lets the entries found or stored so far be evicted again
+        for lock in self.held:
+            lock.release()
+        self.held = []
+
+
+    def __hold__(self, key: str) -> None:
+        # Must be called with the cache's lock held, so that the entry can't
+        # be evicted before it's locked
+        lock = CacheLock(self.__path__(key, ".lock"), exclusive=False)
+        lock.acquire()
+        self.held.append(lock)
+
+
+    def __evict__(self) -> None:
+        # remove least recently used entries until the cache fits its cap,
+        # apart from those in use by any process.  Must be called with the
+        # exclusive lock held.
+        entries: List[Tuple[float, int, str]] = []
+        for key, meta in self.__entries__():
+            try:
+                used: float = os.stat(self.__path__(key, ".json")).st_mtime
+            except FileNotFoundError:
+                continue
+            entries.append((used, meta["size"], key))
+        total: int = sum(entry[1] for entry in entries)
+        for used, size, key in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            entry_lock = CacheLock(
+                self.__path__(key, ".lock"),
+                exclusive=True,
+                remove=True
+            )
+            if not entry_lock.acquire(blocking=False):
+                continue
+            self.logger.info(
+                'Evicting cached raster %s',
+                self.__path__(key, ".tif")
+            )
+            # remove the sidecar first, so the entry stops being found
+            # before its raster disappears
+            for ext in [".json", ".tif"]:
+                try:
+                    os.remove(self.__path__(key, ext))
+                except FileNotFoundError:
+                    pass
+            entry_lock.release()
+            total -= size
+
+
+    def __entries__(self) -> List[Tuple[str, Dict[str, Any]]]:
+        entries: List[Tuple[str, Dict[str, Any]]] = []
+        for fname in os.listdir(self.cache_dir):
+            if not fname.endswith(".json"):
+                continue
+            try:
+                with open(os.path.join(self.cache_dir, fname)) as f:
+                    entries.append((fname[:-len(".json")], json.load(f)))
+            except (FileNotFoundError, ValueError):
+                # evicted or replaced since we listed the directory
+                continue
+        return entries
+
+
+    def __source_key__(self, sources: List[str], band: int) -> str:
+        identity: List[Any] = [band]
+        for source in sorted(sources):
+            stat = os.stat(source)
+            identity.append([
+                os.path.abspath(source),
+                stat.st_mtime,
+                stat.st_size
+            ])
+        return hashlib.sha1(json.dumps(identity).encode("utf-8")).hexdigest()
+
+
+    def __path__(self, key: str, ext: str) -> str:
+        return os.path.join(self.cache_dir, key + ext)
+
+
+    def __locked__(self, exclusive: bool) -> "CacheLock":
+        return CacheLock(self.lock_path, exclusive)
+
+
+
+
+class CacheLock:
+    # An advisory lock on a file, shared between processes, held either
+    # with a with statement, or from acquire() until release().  If remove
+    # is True, the lock file is deleted again on release, rather than being
+    # left behind; that's only possible for exclusive locks.
+
+    def __init__(
+        self,
+        path: str,
+        exclusive: bool,
+        remove: bool = False
+    ) -> None:
+        self.path: str = path
+        self.exclusive: bool = exclusive
+        self.remove: bool = remove and exclusive
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.release()
+
+    def acquire(self, blocking: bool = True) -> bool:
+        # returns False if not blocking and someone else holds the lock
+        while True:
+            self.f = open(self.path, 'a')
+            if fcntl is None:
+                return True
+            try:
+                fcntl.flock(
+                    self.f.fileno(),
+                    (fcntl.LOCK_EX if self.exclusive else fcntl.LOCK_SH) |
+                    (0 if blocking else fcntl.LOCK_NB)
+                )
+            except BlockingIOError:
+                self.f.close()
+                return False
+            if not self.remove or self.__is_current__():
+                return True
+            # whoever held it before removed the file, so locking the old
+            # one doesn't exclude anyone who opens the path afresh
+            self.f.close()
+
+    def release(self) -> None:
+        if self.remove:
+            # removed while still locked, so anyone waiting on it will see
+            # that it's gone once they get the lock
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+        if fcntl is not None:
+            fcntl.flock(self.f.fileno(), fcntl.LOCK_UN)
+        self.f.close()
+
+    def __is_current__(self) -> bool:
+        # whether the locked file is still the one at self.path
+        try:
+            return os.stat(self.path).st_ino == \
+                os.fstat(self.f.fileno()).st_ino
+        except FileNotFoundError:
+            return False
+
+
+
+
+class ResultStore:
+    # Results from a previous run, kept in an npz file next to its output,
+    # so that a rerun only has to look up the rows that have changed.  Each
+    # row's result is keyed by a hash of its coordinates, and stored along
+    # with a key identifying the data source and version it was looked up
+    # in (see SourceRouter.source_version), so results from a source that
+    # has since been refreshed are never reused.  Results added by this run
+    # replace the stored ones when it's saved, so rows that are no longer in
+    # the input are dropped.
+
+    def __init__(self, logger_name: str, path: str) -> None:
+        self.logger = logging.getLogger(logger_name)
+        self.path: str = path
+        self.hashes: np.ndarray = np.empty(0, dtype="S16")
+        self.results: np.ndarray = np.empty((0, 4), dtype=np.float64)
+        self.keys: np.ndarray = np.empty(0, dtype=str)
+        if os.path.exists(path):
+            try:
+                with np.load(path) as stored:
+                    self.hashes = stored["hashes"]
+                    self.results = stored["results"]
+                    self.keys = stored["keys"][stored["key_ids"]]
+            except (OSError, KeyError, ValueError) as e:
+                self.logger.warning(
+                    "Ignoring unreadable result store %s: %s", path, e
+                )
+            else:
+                self.logger.info(
+                    "Found %s stored results in %s", len(self.hashes), path
+                )
+        self.added: List[Tuple[np.ndarray, np.ndarray, np.ndarray]] = []
+
+
+    def lookup(
+        self,
+        hashes: np.ndarray,
+        keys: np.ndarray
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        # Takes row hashes and the key of the source each row would be
+        # looked up in now, and returns a mask of the rows with a stored
+        # result from that source, and an array of those results.  A key of
+        # "" never matches.  Results are integers if they were stored as
+        # integers.
+        found: np.ndarray = np.zeros(len(hashes), dtype=bool)
+        results: np.ndarray = np.zeros(
+            (len(hashes), 4),
+            dtype=self.results.dtype
+        )
+        if len(self.hashes) == 0:
+            return found, results
+        idx: np.ndarray = np.minimum(
+            np.searchsorted(self.hashes, hashes), len(self.hashes) - 1
+        )
+        found = (self.hashes[idx] == hashes) & (self.keys[idx] == keys) & \
+            (keys != "")
+        results[found] = self.results[idx[found]]
+        return found, results
+
+
+    def add(
+        self,
+        hashes: np.ndarray,
+        keys: np.ndarray,
+        results: np.ndarray
+    ) -> None:
+        self.added.append((hashes, keys, results))
+
+
+    def save(self) -> None:
+        # replaces the stored results with those added by this run
+        if len(self.added) > 0:
+            hashes: np.ndarray = np.concatenate([a[0] for a in self.added])
+            keys: np.ndarray = np.concatenate([a[1] for a in self.added])
+            results: np.ndarray = np.concatenate([a[2] for a in self.added])
+        else:
+            hashes = np.empty(0, dtype="S16")
+            keys = np.empty(0, dtype=str)
+            results = np.empty((0, 4), dtype=np.float64)
+        # sorted by hash for lookups, with repeated rows only stored once
+        hashes, firsts = np.unique(hashes, return_index=True)
+        key_names, key_ids = np.unique(
+            keys[firsts].astype(str), return_inverse=True
+        )
+        fd, tmp_path = tempfile.mkstemp(
+            dir=os.path.dirname(os.path.abspath(self.path)),
+            suffix=".tmp"
+        )
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.savez(
+                    f,
+                    hashes=hashes,
+                    results=results[firsts],
+                    keys=key_names,
+                    key_ids=key_ids.astype(np.int32)
+                )
+            # mkstemp makes files only readable by their owner
+            os.chmod(tmp_path, 0o644)
+            os.replace(tmp_path, self.path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        self.logger.info("Saved %s results to %s", len(hashes), self.path)
+
+
+def row_hashes(coords: np.ndarray, offsets: np.ndarray) -> np.ndarray:
+    # returns a hash of the coordinates of each line in an (n, 2) array of
+    # vertices, where line i is coords[offsets[i]:offsets[i + 1]]
+    raw: memoryview = memoryview(
+        np.ascontiguousarray(coords, dtype=np.float64).tobytes()
+    )
+    width: int = 2 * np.dtype(np.float64).itemsize
+    return np.array(
+        [
+            hashlib.blake2b(
+                raw[width * start:width * end], digest_size=16
+            ).digest()
+            for start, end in zip(offsets[:-1].tolist(), offsets[1:].tolist())
+        ],
+        dtype="S16"
+    )
@@ -2,61 +2,116 @@
 # -*- coding: utf-8 -*-
 # data source management
 
+import collections
+import concurrent.futures
+import ftplib
+import hashlib
+import itertools
 import json
 import logging
 import math
 import multiprocessing as mp
+import multiprocessing.pool
+import multiprocessing.shared_memory as shared_memory
 import os
 import psutil  # type: ignore
+import shutil
+import sys
+import tempfile
 import time
-import urllib.request as ftp
-import warnings
+import urllib.parse
 
 import elevation as eio  # type: ignore
 # elevation is an SRTM downloader.  See https://github.com/bopen/elevation
-import fiona  # type: ignore  # noqa: F401
-# fiona is only used indirectly, but needs to be explicitly imported to avoid:
+import fiona  # type: ignore
+# fiona needs to be explicitly imported before geopandas to avoid:
 # ` AttributeError: partially initialized module 'fiona' has no
 # attribute '_loading' (most likely due to a circular import) `
 import geopandas as gp  # type: ignore
+import numpy as np
+import pandas as pd  # type: ignore
+import pygeos  # type: ignore
 import pyproj
 import rasterio  # type: ignore
 import rasterio.merge  # type: ignore
+import rasterio.windows  # type: ignore
 import requests
 
-from shapely.geometry import box, LineString, MultiLineString, Point  # type: ignore  # noqa: E501
+from shapely.geometry import box, LineString, MultiLineString  # type: ignore
 from shapely.ops import transform  # type: ignore
-from typing import List
+from rasterio.transform import Affine  # type: ignore
+from typing import (
+    Deque, Dict, Iterable, Iterator, List, Optional, Set, Tuple,
+    Union
+)
+
+from cache import Bounds, CacheLock, CropCache
+from metrics import METRICS, timed, write_atomically
+from progress import PROGRESS, ProgressBoard
 
 
-SCREEN_PRECISION: int = 2  # round terminal output to 1cm
 FOOT_IN_M: float = 0.3048
 NULL_ELEVATION: float = -11000  # deeper than the deepest ocean
+REPROJECTION_CHUNK_SIZE: int = 1000000  # points per pyproj call
+MAX_CHUNK_LINES: int = 10000  # most lines to send to a worker at once
+CHUNKS_PER_WORKER: int = 8  # aim for at least this many chunks per worker
+BATCHES_IN_FLIGHT_PER_WORKER: int = 2  # bounds memory use when streaming
+CONTOUR_INDEX_VERSION: int = 2  # increment if the index format changes
+VECTOR_READ_BATCH_SIZE: int = 10000  # features to decode at a time
+CLUSTER_CELL_DEGREES: float = 0.1  # grid used to find clusters of input
+MAX_CLUSTERS_PER_SOURCE: int = 8  # the grid is coarsened to stay within this
+SRTM_DOWNLOAD_THREADS: int = 4  # SRTM tiles to download at once
+DOWNLOAD_CHUNK_SIZE: int = 1024 * 1024  # bytes to write at a time
+DOWNLOAD_TIMEOUT: int = 60  # seconds to wait for a server to respond
+# asks servers not to compress downloads, so that sizes and byte ranges are
+# of the file itself
+IDENTITY_ENCODING: Dict[str, str] = {"Accept-Encoding": "identity"}
 
+# the fallback used wherever no source in data_source_list applies
+SRTM_SOURCE: Dict = {
+    "name": "SRTM 30m",
+    "url": "https://lpdaac.usgs.gov/products/srtmgl1nv003/",
+    "filename": "srtm",
+    "crs": "EPSG:4326",
+    "bbox": [-180, -90, 180, 90],
+    "download_method": "srtm",
+    "lookup_method": "raster",
+    "lookup_field": "1",
+    "units": "meters",
+    "recheck_interval_days": 100
+}
 
 
 
-class ElevationStats:
 
-    def __init__(self, i: int = -1) -> None:
-        self.i: int = i
-        self.start: float = NULL_ELEVATION
-        self.end: float = NULL_ELEVATION
-        self.climb: float = 0
-        self.descent: float = 0
+class DataSourceError(Exception):
+    # a data source can't be used, e.g. because it couldn't be downloaded
+    pass
 
-    def __str__(self) -> str:
-        return " \t".join([
-            'row: ' + str(self.i),
-            'Starting elevation: ' +
-            str(round(self.start, SCREEN_PRECISION)),
-            'Ending elevation: ' +
-            str(round(self.end, SCREEN_PRECISION)),
-            'Total climb: ' +
-            str(round(self.climb, SCREEN_PRECISION)),
-            'Total descent: ' +
-            str(round(self.descent, SCREEN_PRECISION))
-        ])
+
+
+
+class BlockCache:
+    # A size-bounded least-recently-used cache of raster blocks
+
+    def __init__(self, max_bytes: int) -> None:
+        self.max_bytes: int = max_bytes
+        self.n_bytes: int = 0
+        self.blocks: collections.OrderedDict = collections.OrderedDict()
+
+    def get(self, key: Tuple[int, int]) -> Optional[np.ndarray]:
+        if key not in self.blocks:
+            return None
+        self.blocks.move_to_end(key)
+        return self.blocks[key]
+
+    def put(self, key: Tuple[int, int], block: np.ndarray) -> None:
+        self.blocks[key] = block
+        self.n_bytes += block.nbytes
+        # always keep the newest block, even if it alone is over the limit
+        while self.n_bytes > self.max_bytes and len(self.blocks) > 1:
+            evicted: np.ndarray = self.blocks.popitem(last=False)[1]
+            self.n_bytes -= evicted.nbytes
 
 
 
@@ -68,21 +123,42 @@ class DataSource:
         logger_name: str,
         data_dir: str,
         data_source_list: str,
-        bbox: box
+        bbox: box,
+        block_cache_mb: int = 0,
+        crop_cache_mb: int = 0,
+        contour_max_distance: Optional[float] = None,
+        contour_index: bool = True,
+        source: Optional[Dict] = None
     ) -> None:
         self.logger = logging.getLogger(logger_name)
         self.data_dir: str = data_dir
         self.sources_file: str = data_source_list
+        self.bbox: box = bbox
+        # if > 0, rasters are read block by block as needed, keeping up to
+        # this many MB of recently used blocks, instead of all at once
+        self.block_cache_mb: int = block_cache_mb
+        # if > 0, mosaics of multiple raster tiles are kept in data_dir for
+        # reuse by later runs, up to this many MB of them
+        self.crop_cache_mb: int = crop_cache_mb
+        # if set, points further than this from any contour (in degrees)
+        # are treated as having no data, rather than using a distant contour
+        self.contour_max_distance: Optional[float] = contour_max_distance
+        # if True, contour sources are preprocessed into an on-disk index
+        # the first time they're used, for faster loading by later runs
+        self.contour_index: bool = contour_index
 
-        self.__choose_source__(bbox)
+        # a source can be given directly, if it has already been chosen by
+        # a SourceRouter; otherwise it's chosen from data_source_list
+        if source is None:
+            self.__choose_source__(bbox)
+        else:
+            self.__use_source__(source, bbox)
         if self.lookup_method == "contour_lines":
             self.__read_vectors__(bbox)
         elif self.lookup_method != "raster":
-            self.logger.critical(
-                "Lookup method %s not implemented",
-                self.lookup_method
+            raise DataSourceError(
+                "Lookup method " + self.lookup_method + " not implemented"
             )
-            exit(1)
 
 
     def __enter__(self):
@@ -93,6 +169,7 @@ class DataSource:
         self.close()
 
 
+    @timed("select_source")
     def __choose_source__(self, bbox: box) -> None:
         # load available sources from metadata JSON
         with open(self.sources_file) as infile:
@@ -101,19 +178,7 @@ class DataSource:
         # try to find an applicable source
         for source in sources:
             if box(*source["bbox"]).contains(bbox):
-                self.name: str = source["name"]
-                self.url: str = source["url"]
-                self.filename: str = os.path.join(
-                    self.data_dir, source["filename"]
-                )
-                self.source_crs: str = source["crs"]
-                self.download_method: str = source["download_method"]
-                self.lookup_method: str = source["lookup_method"]
-                self.lookup_field: str = source["lookup_field"]
-                self.source_units: str = source["units"]
-                self.recheck_days: int = source["recheck_interval_days"]
-                self.logger.info('Using data source: %s', self.name)
-                self.__download_file__(bbox)
+                self.__use_source__(source, bbox)
                 return
             else:
                 self.logger.debug(
@@ -126,18 +191,26 @@ class DataSource:
             'No applicable data sources found in %s, defaulting to SRTM.',
             self.sources_file
         )
-        self.name = "SRTM 30m"
-        self.url = "https://lpdaac.usgs.gov/products/srtmgl1nv003/"
-        self.filename = os.path.join(os.getcwd(), self.data_dir, "srtm")
-        if not os.path.exists(self.filename):
-            os.mkdir(self.filename)
-        self.source_crs = "EPSG:4326"
-        self.download_method = "srtm"
-        self.lookup_method = "raster"
-        self.lookup_field = "1"
-        self.source_units = "meters"
-        self.recheck_days = 100
-        self.__configure_srtm__(bbox)
+        self.__use_source__(SRTM_SOURCE, bbox)
+
+
+    def __use_source__(self, source: Dict, bbox: box) -> None:
+        self.name: str = source["name"]
+        self.url: str = source["url"]
+        self.filename: str = os.path.join(self.data_dir, source["filename"])
+        self.source_crs: str = source["crs"]
+        self.download_method: str = source["download_method"]
+        self.lookup_method: str = source["lookup_method"]
+        self.lookup_field: str = source["lookup_field"]
+        self.source_units: str = source["units"]
+        self.recheck_days: int = source["recheck_interval_days"]
+        self.logger.info('Using data source: %s', self.name)
+        if self.download_method == "srtm":
+            if not os.path.exists(self.filename):
+                os.mkdir(self.filename)
+            self.__configure_srtm__(bbox)
+        else:
+            self.__download_file__(bbox)
 
 
     def __download_file__(self, bbox: box) -> None:
@@ -146,98 +219,350 @@ class DataSource:
         if not os.path.exists(self.filename):
             file_needed = True
         elif self.download_method != "local" and self.recheck_days is not None:
-            age: float = time.time() - os.stat(self.filename).st_mtime
+            age: float = time.time() - _last_checked(self.filename)
             if age > self.recheck_days * 60 * 60 * 24:
                 file_needed = True
                 self.logger.info(
-                    'Replacing %s from %s because it`s > than %s days old',
-                    self.filename,
+                    'Checking %s for a newer version of %s because it`s > '
+                    'than %s days old',
                     self.url,
+                    self.filename,
                     self.recheck_days
                 )
         if file_needed:
-            if self.download_method == "http":
-                self.logger.info('Downloading %s as http', self.url)
-                req = requests.get(self.url)
-                with open(self.filename, 'wb') as outfile:
-                    outfile.write(req.content)
-            elif self.download_method == "ftp":
-                self.logger.info('Downloading %s as ftp', self.url)
-                ftp.urlretrieve(self.url, self.filename)
+            if self.download_method in ["http", "ftp"]:
+                self.__fetch_remote__()
             elif self.download_method == "local":
-                self.logger.critical(
-                    'Local file %s not found.',
-                    self.filename
+                raise DataSourceError(
+                    'Local file ' + self.filename + ' not found.'
                 )
-                exit(1)
             else:
-                self.logger.critical(
-                    'Download method %s not supported',
-                    self.download_method
+                raise DataSourceError(
+                    'Download method ' + self.download_method +
+                    ' not supported'
                 )
-                exit(1)
         else:
             self.logger.info('Data file already saved at %s', self.filename)
-        # make a cropped raster if appropriate
         if self.lookup_method == "raster":
-            srcfile: List[str] = [self.filename]
-            ext: str = self.filename.split('.')[-1]
-            self.filename += '_' + str(time.time()) + "_temp." + ext
-            self.__crop_raster__(bbox, srcfile)
+            self.__configure_raster__(bbox, [self.filename])
+
+
+    @timed("download")
+    def __fetch_remote__(self) -> None:
+        # Downloads the source over http or ftp, unless the saved copy is
+        # still the same as the remote one.  The download is streamed to a
+        # .part file, which is resumed if a previous attempt was interrupted
+        # and is only renamed into place once it's complete.
+        # .download.json sidecars record the version of the remote file that
+        # each local one came from, and when it was last found unchanged.
+        part_path: str = self.filename + ".part"
+        saved_meta_path: str = self.filename + ".download.json"
+        part_meta_path: str = part_path + ".json"
+        try:
+            remote: Dict[str, Optional[str]] = self.__remote_meta__()
+            if any(value is not None for value in remote.values()):
+                saved: Optional[Dict] = self.__read_meta__(saved_meta_path)
+                if os.path.exists(self.filename) and saved is not None and \
+                        _remote_version(saved) == remote:
+                    self.logger.info(
+                        '%s is unchanged, so keeping %s',
+                        self.url,
+                        self.filename
+                    )
+                    # restart the clock for the next recheck, in the
+                    # sidecar rather than the file's mtime, which the
+                    # caches of results, indexes and crops key it by
+                    write_atomically(
+                        saved_meta_path,
+                        json.dumps(dict(remote, checked=time.time()))
+                    )
+                    return
+                resumable: bool = os.path.exists(part_path) and \
+                    self.__read_meta__(part_meta_path) == remote
+            else:
+                # without anything to tell versions apart, a partial
+                # download could be of an older version, so start afresh
+                resumable = False
+            offset: int = os.path.getsize(part_path) if resumable else 0
+            if offset == 0:
+                with open(part_meta_path, 'w') as f:
+                    json.dump(remote, f)
+            if self.download_method == "http":
+                self.__download_http__(part_path, offset, remote)
+            else:
+                self.__download_ftp__(part_path, offset)
+        except (requests.RequestException,) + ftplib.all_errors as e:
+            # anything downloaded so far is kept, to be resumed next time
+            raise DataSourceError(
+                'Failed to download ' + self.url + ': ' + str(e)
+            ) from e
+        if remote["size"] is not None and \
+                os.path.getsize(part_path) != int(remote["size"]):
+            raise DataSourceError(
+                'Download of ' + self.url + ' stopped after ' +
+                str(os.path.getsize(part_path)) + ' of ' + remote["size"] +
+                ' bytes'
+            )
+        os.replace(part_path, self.filename)
+        os.replace(part_meta_path, saved_meta_path)
+        self.logger.info('Saved %s as %s', self.url, self.filename)
+
+
+    def __remote_meta__(self) -> Dict[str, Optional[str]]:
+        # returns whatever the server will tell us about the remote file's
+        # version, without downloading it
+        meta: Dict[str, Optional[str]] = {
+            "etag": None,
+            "last_modified": None,
+            "size": None
+        }
+        if self.download_method == "http":
+            head = requests.head(
+                self.url,
+                allow_redirects=True,
+                headers=IDENTITY_ENCODING,
+                timeout=DOWNLOAD_TIMEOUT
+            )
+            if not head.ok:
+                # not every server supports HEAD, and without it there's
+                # nothing to compare, so the file is simply downloaded
+                self.logger.info(
+                    'Server answered HEAD %s with %s, so downloading it '
+                    'without checking its version',
+                    self.url,
+                    head.status_code
+                )
+                return meta
+            meta["etag"] = head.headers.get("ETag")
+            meta["last_modified"] = head.headers.get("Last-Modified")
+            if not _is_encoded(head):
+                # otherwise this is the compressed size, not the file's
+                meta["size"] = head.headers.get("Content-Length")
+            return meta
+        with self.__ftp_connect__() as conn:
+            path: str = self.__ftp_path__()
+            # not every server supports these commands
+            try:
+                meta["last_modified"] = conn.voidcmd("MDTM " + path)[4:]
+            except ftplib.error_perm:
+                pass
+            try:
+                size: Optional[int] = conn.size(path)
+                meta["size"] = None if size is None else str(size)
+            except ftplib.error_perm:
+                pass
+        return meta
+
+
+    def __read_meta__(self, path: str) -> Optional[Dict]:
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+
+    def __download_http__(
+        self,
+        part_path: str,
+        offset: int,
+        remote: Dict[str, Optional[str]]
+    ) -> None:
+        headers: Dict[str, str] = dict(IDENTITY_ENCODING)
+        if offset > 0 and remote["size"] is not None and \
+                offset >= int(remote["size"]):
+            self.logger.info(
+                'Earlier download of %s is already complete',
+                self.url
+            )
+            return
+        if offset > 0:
+            self.logger.info(
+                'Resuming download of %s as http from byte %s',
+                self.url,
+                offset
+            )
+            headers["Range"] = "bytes=" + str(offset) + "-"
+            # only resume if the file hasn't changed since, and otherwise
+            # have the server send all of it
+            validator: Optional[str] = (
+                remote["etag"] or remote["last_modified"]
+            )
+            if validator is not None:
+                headers["If-Range"] = validator
+        else:
+            self.logger.info('Downloading %s as http', self.url)
+        with requests.get(
+            self.url,
+            headers=headers,
+            stream=True,
+            timeout=DOWNLOAD_TIMEOUT
+        ) as req:
+            if offset > 0 and req.status_code == 416 and \
+                    req.headers.get("Content-Range") == "bytes */" + \
+                    str(offset):
+                # the earlier download got everything, but wasn't renamed
+                self.logger.info(
+                    'Earlier download of %s is already complete',
+                    self.url
+                )
+                return
+            req.raise_for_status()
+            if offset > 0 and _is_encoded(req) and req.status_code == 206:
+                # a range of the compressed body, which can't be appended
+                # to the uncompressed part already saved
+                self.logger.info(
+                    'Server compressed the rest of %s, so starting again',
+                    self.url
+                )
+                req.close()
+                self.__download_http__(part_path, 0, remote)
+                return
+            if offset > 0 and req.status_code != 206:
+                self.logger.info(
+                    'Server sent all of %s, so starting again',
+                    self.url
+                )
+                offset = 0
+            # iter_content undoes any Content-Encoding, so what's saved is
+            # always the file itself
+            with open(part_path, 'ab' if offset > 0 else 'wb') as outfile:
+                for chunk in req.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                    outfile.write(chunk)
+
+
+    def __download_ftp__(self, part_path: str, offset: int) -> None:
+        if offset > 0:
+            self.logger.info(
+                'Resuming download of %s as ftp from byte %s',
+                self.url,
+                offset
+            )
+            try:
+                self.__retrieve_ftp__(part_path, offset)
+                return
+            except (ftplib.error_perm, ftplib.error_reply):
+                # servers that don't support resuming refuse REST, usually
+                # with a 5xx
+                self.logger.info(
+                    'Server can`t resume %s, so starting again',
+                    self.url
+                )
+        else:
+            self.logger.info('Downloading %s as ftp', self.url)
+        self.__retrieve_ftp__(part_path, 0)
+
+
+    def __retrieve_ftp__(self, part_path: str, offset: int) -> None:
+        # appends to part_path from offset, or replaces it if offset is 0,
+        # over a new connection
+        with self.__ftp_connect__() as conn:
+            with open(part_path, 'ab' if offset > 0 else 'wb') as outfile:
+                conn.retrbinary(
+                    "RETR " + self.__ftp_path__(),
+                    outfile.write,
+                    blocksize=DOWNLOAD_CHUNK_SIZE,
+                    rest=offset if offset > 0 else None
+                )
+
+
+    def __ftp_connect__(self) -> ftplib.FTP:
+        url = urllib.parse.urlparse(self.url)
+        conn = ftplib.FTP(timeout=DOWNLOAD_TIMEOUT)
+        conn.connect(url.hostname or "", url.port or 21)
+        conn.login(url.username or "anonymous", url.password or "")
+        # binary mode, which SIZE needs to give an exact answer
+        conn.voidcmd("TYPE I")
+        return conn
+
+
+    def __ftp_path__(self) -> str:
+        return urllib.parse.unquote(urllib.parse.urlparse(self.url).path)
 
 
     def __configure_srtm__(self, bbox: box) -> None:
-        # make a list of file[s] needed
-        tiles: List[int] = [
-            math.floor(bbox.bounds[0]),
-            math.floor(bbox.bounds[1]),
-            math.ceil(bbox.bounds[2]),
-            math.ceil(bbox.bounds[3]),
-        ]
+        # Make a list of the 1° tiles needed.  Lookups nudge points right
+        # and down (see __raster_points_lookup__), so a point on a whole
+        # degree of longitude is in the tile to its east, and one on a whole
+        # degree of latitude is in the tile to its south.  Even a single
+        # point therefore always needs one tile.
+        west, south, east, north = bbox.bounds
+        xs: range = range(math.floor(west), math.floor(east) + 1)
+        ys: range = range(math.ceil(south) - 1, math.ceil(north))
         srtm_tiles: List[str] = []
-        for x in range(tiles[0], tiles[2]):
-            for y in range(tiles[1], tiles[3]):
-                srtm_tiles.append(os.path.join(
-                    self.filename,
-                    "srtm." + str(x) + "." + str(y) + ".tif"
-                ))
-                # download file[s] if appropriate
-                self.__download_srtm__(srtm_tiles[-1], x, y)
-        # merge files to temp.....tif on disk
-        tile_id: str = str(tiles[0]) + "_" + str(tiles[1])
-        tile_id += "_" + str(tiles[2]) + "_" + str(tiles[3])
-        self.filename = os.path.join(
-            self.filename,
-            "temp_" + tile_id + "_" + str(time.time()) + ".tif"
-        )
-        self.__crop_raster__(bbox, srtm_tiles)
+        # download file[s] if appropriate, a few at a time
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=SRTM_DOWNLOAD_THREADS
+        ) as executor:
+            downloads: List[concurrent.futures.Future] = []
+            for x in xs:
+                for y in ys:
+                    srtm_tiles.append(os.path.join(
+                        self.filename,
+                        "srtm." + str(x) + "." + str(y) + ".tif"
+                    ))
+                    downloads.append(executor.submit(
+                        self.__download_srtm__, srtm_tiles[-1], x, y
+                    ))
+            # re-raise any download's exception here
+            for download in downloads:
+                download.result()
+        self.__configure_raster__(bbox, srtm_tiles)
 
 
+    @timed("download")
     def __download_srtm__(self, filename: str, x: int, y: int) -> None:
-        file_needed: bool = True
-        if os.path.exists(filename):
-            age: float = time.time() - os.stat(filename).st_mtime
-            if age > self.recheck_days * 60 * 60 * 24:
-                self.logger.info(
-                    'Replacing %s because it`s > than %s days old',
-                    filename,
-                    self.recheck_days
-                )
+        # Other processes wanting the same tile wait here until it's
+        # finished, and will then find it already saved.  The lock file is
+        # removed afterwards, so it doesn't clutter the tile directory.
+        with CacheLock(filename + ".lock", exclusive=True, remove=True):
+            file_needed: bool = True
+            if os.path.exists(filename):
+                age: float = time.time() - os.stat(filename).st_mtime
+                if age > self.recheck_days * 60 * 60 * 24:
+                    self.logger.info(
+                        'Replacing %s because it`s > than %s days old',
+                        filename,
+                        self.recheck_days
+                    )
+                else:
+                    file_needed = False
+                    self.logger.info('Tile already saved at %s', filename)
             else:
-                file_needed = False
-                self.logger.info('Tile already saved at %s', filename)
-        else:
-            self.logger.info('Downloading %s', filename)
-        if file_needed:
-            eio.clip(bounds=[x, y, x + 1, y + 1], output=filename)
+                self.logger.info('Downloading %s', filename)
+            if file_needed:
+                # Each download gets its own working directory, including
+                # its own elevation cache, because elevation's cache isn't
+                # safe for concurrent use.  The tile is written there and
+                # then renamed into place, so a partial one is never seen.
+                work_dir: str = tempfile.mkdtemp(
+                    dir=os.path.dirname(filename),
+                    prefix=".download."
+                )
+                try:
+                    tmp_path: str = os.path.join(
+                        work_dir,
+                        os.path.basename(filename)
+                    )
+                    eio.clip(
+                        bounds=[x, y, x + 1, y + 1],
+                        output=tmp_path,
+                        cache_dir=os.path.join(work_dir, "cache")
+                    )
+                    os.replace(tmp_path, filename)
+                finally:
+                    shutil.rmtree(work_dir, ignore_errors=True)
 
 
-    def __crop_raster__(self, bbox: box, fnames: List[str]) -> None:
-        self.logger.info(
-            'Saving raster data cropped to %s as %s',
-            bbox.bounds,
-            self.filename
-        )
+    def __configure_raster__(self, bbox: box, fnames: List[str]) -> None:
+        # Nothing is cropped or merged on disk: a single file is read through
+        # a window, and multiple tiles are mosaicked in memory on loading
+        self.raster_files: List[str] = fnames
+        with rasterio.open(fnames[0]) as raster_dataset:
+            self.raster_integral: bool = bool(np.issubdtype(
+                raster_dataset.dtypes[int(self.lookup_field) - 1],
+                np.integer
+            ))
         if self.source_crs != "EPSG:4326":
             reprojector = pyproj.Transformer.from_crs(
                 crs_from=pyproj.CRS("EPSG:4326"),
@@ -245,11 +570,46 @@ class DataSource:
                 always_xy=True
             ).transform
             bbox = transform(reprojector, bbox)
-        rasterio.merge.merge(
-            fnames,
-            bounds=bbox.bounds,
-            dst_path=self.filename,
-            method='last'
+        self.raster_bounds: Bounds = bbox.bounds
+        if len(fnames) > 1 and self.crop_cache_mb > 0:
+            # reuse or save the mosaic, so later runs can skip merging.  The
+            # entry used is kept from being evicted until this is closed.
+            cache = CropCache(
+                self.logger.name,
+                os.path.join(self.data_dir, "crop_cache"),
+                self.crop_cache_mb
+            )
+            self.crop_cache: Optional[CropCache] = cache
+            cached: Optional[str] = cache.find(
+                fnames,
+                int(self.lookup_field),
+                self.raster_bounds
+            )
+            if cached is None:
+                mosaic, mosaic_transform, bounds = self.__mosaic_raster__()
+                cached = cache.store(
+                    fnames,
+                    int(self.lookup_field),
+                    bounds,
+                    mosaic,
+                    {
+                        "driver": "GTiff",
+                        "width": mosaic.shape[1],
+                        "height": mosaic.shape[0],
+                        "count": 1,
+                        "dtype": self.raster_dtype,
+                        "crs": self.source_crs,
+                        "transform": mosaic_transform,
+                        "nodata": self.raster_nodata,
+                        "tiled": True,
+                        "compress": "deflate"
+                    }
+                )
+            self.raster_files = [cached]
+        self.logger.info(
+            'Raster data will be read from %s file[s], windowed to %s',
+            len(self.raster_files),
+            self.raster_bounds
         )
         if self.source_units in ["feet", "foot", "ft"]:
             self.logger.info(
@@ -264,39 +624,324 @@ class DataSource:
 
 
     def __read_vectors__(self, bbox: box) -> None:
+        if self.contour_index:
+            self.__read_contour_index__(bbox)
+        else:
+            self.gdf = self.__load_vectors__(bbox)
+
+
+    @timed("load")
+    def __load_vectors__(self, bbox: Optional[box]) -> gp.GeoDataFrame:
+        # returns the source's geometries and elevations in metres, cropped
+        # to bbox if there is one
         self.logger.info('Loading %s as vector data', self.filename)
-        gdf = gp.read_file(self.filename)
-        # reproject if necessary
         if self.source_crs != 'EPSG:4326':
             self.logger.info(
                 'Reprojecting from %s to EPSG:4326',
                 self.source_crs
             )
-            gdf.to_crs(4326)
-        # crop to bbox and standardise fields
-        self.logger.info('Cropping to %s', bbox.bounds)
-        self.gdf = gdf.loc[
-            gdf.sindex.query(bbox),
-            ["geometry", self.lookup_field]
-        ]
-        self.gdf.rename(columns={self.lookup_field: "elevation"}, inplace=True)
+        # only decode the one field we need, where the driver can skip the
+        # others, which GeoJSON's can't
+        with fiona.open(self.filename) as src:
+            ignore_fields: List[str] = [
+                field for field in src.schema["properties"]
+                if field != self.lookup_field
+            ]
+        try:
+            src = fiona.open(self.filename, ignore_fields=ignore_fields)
+        except fiona.errors.DriverError:
+            src = fiona.open(self.filename)
+        parts: List[gp.GeoDataFrame] = []
+        with src:
+            if bbox is None:
+                features: Iterator = iter(src)
+            else:
+                # let the driver skip features outside bbox, which has to be
+                # given in the source's own CRS for that
+                self.logger.info('Cropping to %s', bbox.bounds)
+                if self.source_crs != 'EPSG:4326':
+                    bbox = transform(
+                        pyproj.Transformer.from_crs(
+                            crs_from=pyproj.CRS("EPSG:4326"),
+                            crs_to=pyproj.CRS(self.source_crs),
+                            always_xy=True
+                        ).transform,
+                        bbox
+                    )
+                features = src.filter(bbox=bbox.bounds)
+            # decode and reproject in batches
+            while True:
+                batch: List = list(
+                    itertools.islice(features, VECTOR_READ_BATCH_SIZE)
+                )
+                if len(batch) == 0:
+                    break
+                gdf = gp.GeoDataFrame.from_features(
+                    batch,
+                    crs=self.source_crs
+                )
+                if self.source_crs != 'EPSG:4326':
+                    gdf = gdf.to_crs(4326)
+                parts.append(gdf.loc[:, ["geometry", self.lookup_field]])
+        if len(parts) == 0:
+            gdf = gp.GeoDataFrame(
+                {"elevation": []},
+                geometry=[],
+                crs="EPSG:4326"
+            )
+        else:
+            gdf = gp.GeoDataFrame(
+                pd.concat(parts, ignore_index=True),
+                crs="EPSG:4326"
+            )
+            gdf.rename(columns={self.lookup_field: "elevation"}, inplace=True)
         # convert units if necessary
         if self.source_units in ["feet", "foot", "ft"]:
             self.logger.info(
                 "Converting source elevations from feet to metres"
             )
-            self.gdf["elevation"] = self.gdf["elevation"] * FOOT_IN_M
+            gdf["elevation"] = gdf["elevation"] * FOOT_IN_M
         elif self.source_units not in ["meters", "metres", "m"]:
             self.logger.warning(
                 ("Data source unit of '%s' not recognised; "
                     "using unconverted values"),
                 self.source_units
             )
+        return gdf
+
+
+    @timed("load")
+    def __read_contour_index__(self, bbox: box) -> None:
+        # Loads contours from a preprocessed index next to the source file,
+        # (re)building the index first if it's missing or out of date.
+        # The index is a set of .npy arrays that are memory-mapped, so only
+        # the parts of them needed for bbox are actually read.
+        index_dir: str = self.filename + ".index"
+        with CacheLock(index_dir + ".lock", exclusive=True):
+            if not self.__contour_index_is_current__(index_dir):
+                self.__build_contour_index__(index_dir)
+            # All the arrays are mapped before the lock is released, so
+            # they're all from the same build.  If another process rebuilds
+            # the index after that, the old files stay mapped until we're
+            # done with them.
+            self.logger.info('Loading contours from %s', index_dir)
+            arrays: Dict[str, np.ndarray] = {
+                name: np.load(
+                    os.path.join(index_dir, name + ".npy"),
+                    mmap_mode="r"
+                )
+                for name in ["coords", "offsets", "elevation", "bounds"]
+            }
+        # crop to contours whose bounds intersect bbox
+        self.logger.info('Cropping to %s', bbox.bounds)
+        bounds: np.ndarray = arrays["bounds"]
+        selected: np.ndarray = np.flatnonzero(
+            (bounds[:, 0] <= bbox.bounds[2]) &
+            (bounds[:, 1] <= bbox.bounds[3]) &
+            (bounds[:, 2] >= bbox.bounds[0]) &
+            (bounds[:, 3] >= bbox.bounds[1])
+        )
+        # gather the vertices of the selected lines and build them all at once
+        starts: np.ndarray = arrays["offsets"][selected]
+        counts: np.ndarray = arrays["offsets"][selected + 1] - starts
+        line_ids: np.ndarray = np.repeat(np.arange(len(selected)), counts)
+        vertex_ids: np.ndarray = (
+            np.arange(counts.sum()) -
+            np.repeat(np.cumsum(counts) - counts, counts) +
+            np.repeat(starts, counts)
+        )
+        self.gdf = gp.GeoDataFrame(
+            {"elevation": np.array(arrays["elevation"][selected])},
+            geometry=gp.GeoSeries(
+                pygeos.linestrings(
+                    arrays["coords"][vertex_ids],
+                    indices=line_ids
+                ),
+                crs="EPSG:4326"
+            )
+        )
+
 
+    def __contour_index_is_current__(self, index_dir: str) -> bool:
+        meta_path: str = os.path.join(index_dir, "meta.json")
+        if not os.path.exists(meta_path):
+            return False
+        with open(meta_path) as f:
+            meta: Dict = json.load(f)
+        # the source file is replaced whenever it's refreshed, which changes
+        # its mtime, so this also catches recheck_interval_days refreshes
+        if meta != self.__contour_index_meta__():
+            self.logger.info('Contour index %s is out of date', index_dir)
+            return False
+        return True
 
-    def __read_raster__(self, bbox: box) -> None:
-        self.raster_dataset = rasterio.open(self.filename)
-        self.raster_values = self.raster_dataset.read(int(self.lookup_field))
+
+    def __contour_index_meta__(self) -> Dict:
+        stat = os.stat(self.filename)
+        return {
+            "version": CONTOUR_INDEX_VERSION,
+            "source_mtime": stat.st_mtime,
+            "source_size": stat.st_size,
+            "crs": self.source_crs,
+            "lookup_field": self.lookup_field,
+            "units": self.source_units
+        }
+
+
+    @timed("index")
+    def __build_contour_index__(self, index_dir: str) -> None:
+        self.logger.info('Building contour index %s', index_dir)
+        gdf = self.__load_vectors__(None)
+        # multi-part contours become one line per part
+        gdf = gdf.explode(index_parts=False)
+        is_line: np.ndarray = (gdf.geom_type == "LineString").values
+        if not is_line.all():
+            self.logger.warning(
+                'Skipping %s features that are not lines',
+                (~is_line).sum()
+            )
+            gdf = gdf.loc[is_line]
+        coords, offsets = self.__flatten_lines__(list(gdf.geometry))
+        # write everything to a temporary directory and then move it into
+        # place, so a failed build never leaves a partial index behind
+        tmp_dir: str = index_dir + ".tmp" + str(os.getpid())
+        os.makedirs(tmp_dir, exist_ok=True)
+        np.save(os.path.join(tmp_dir, "coords.npy"), coords)
+        np.save(os.path.join(tmp_dir, "offsets.npy"), offsets)
+        np.save(
+            os.path.join(tmp_dir, "elevation.npy"),
+            gdf["elevation"].values.astype(np.float64)
+        )
+        np.save(os.path.join(tmp_dir, "bounds.npy"), gdf.bounds.values)
+        with open(os.path.join(tmp_dir, "meta.json"), 'w') as f:
+            json.dump(self.__contour_index_meta__(), f)
+        if os.path.exists(index_dir):
+            shutil.rmtree(index_dir)
+        os.replace(tmp_dir, index_dir)
+        self.logger.info('Saved %s contour lines to %s', len(gdf), index_dir)
+
+
+    @timed("load")
+    def __read_raster__(
+        self,
+        bbox: box,
+        shared: bool = False
+    ) -> Optional[shared_memory.SharedMemory]:
+        # if shared is True then the band is read into a new block of shared
+        # memory, which is returned so that the caller can unlink it once all
+        # the parallel workers are done with it
+        band: int = int(self.lookup_field)
+        if len(self.raster_files) == 1:
+            with self.__open_raster__() as raster_dataset:
+                window = self.__raster_window__(raster_dataset)
+                self.raster_shape: Tuple[int, int] = (
+                    int(window.height), int(window.width)
+                )
+                self.raster_transform = raster_dataset.window_transform(
+                    window
+                )
+                shm: Optional[shared_memory.SharedMemory] = \
+                    self.__allocate_raster__(shared)
+                raster_dataset.read(
+                    band,
+                    window=window,
+                    out=self.raster_values
+                )
+        else:
+            mosaic, self.raster_transform, bounds = self.__mosaic_raster__()
+            self.raster_shape = (mosaic.shape[0], mosaic.shape[1])
+            shm = self.__allocate_raster__(shared)
+            self.raster_values[:] = mosaic
+        return shm
+
+
+    @timed("merge")
+    def __mosaic_raster__(self) -> Tuple[np.ndarray, Affine, Bounds]:
+        # mosaic the tiles in memory, on the pixel grid of the first one.
+        # Returns the band, its transform, and the bounds it covers.
+        with self.__open_raster__() as raster_dataset:
+            window = self.__raster_window__(raster_dataset, clip=False)
+            bounds: Bounds = rasterio.windows.bounds(
+                window,
+                raster_dataset.transform
+            )
+        mosaic, mosaic_transform = rasterio.merge.merge(
+            self.raster_files,
+            bounds=bounds,
+            indexes=[int(self.lookup_field)],
+            method='last'
+        )
+        return mosaic[0], mosaic_transform, bounds
+
+
+    def __allocate_raster__(
+        self,
+        shared: bool
+    ) -> Optional[shared_memory.SharedMemory]:
+        # makes an empty self.raster_values of the right shape and type,
+        # optionally in shared memory
+        if not shared:
+            self.raster_values: np.ndarray = np.empty(
+                self.raster_shape,
+                dtype=self.raster_dtype
+            )
+            return None
+        shm = shared_memory.SharedMemory(
+            create=True,
+            size=max(1, self.raster_shape[0] * self.raster_shape[1] *
+                     np.dtype(self.raster_dtype).itemsize)
+        )
+        self.raster_values = np.ndarray(
+            self.raster_shape,
+            dtype=self.raster_dtype,
+            buffer=shm.buf
+        )
+        return shm
+
+
+    def __raster_window__(
+        self,
+        raster_dataset: rasterio.io.DatasetReader,
+        clip: bool = True
+    ) -> rasterio.windows.Window:
+        # the window of raster_dataset covering self.raster_bounds, snapped
+        # outwards to whole pixels so that values are read without resampling
+        window = rasterio.windows.from_bounds(
+            *self.raster_bounds,
+            transform=raster_dataset.transform
+        )
+        col_off: int = math.floor(window.col_off)
+        row_off: int = math.floor(window.row_off)
+        # Lookups nudge points down and right before flooring them to a pixel
+        # (see __raster_points_lookup__), so a point exactly on a pixel-aligned
+        # south or east edge belongs to the pixel beyond it.  Keeping one more
+        # of each means such points get the same value whatever the bounds.
+        col_end: int = math.ceil(window.col_off + window.width) + 1
+        row_end: int = math.ceil(window.row_off + window.height) + 1
+        if clip:
+            col_off = min(max(col_off, 0), raster_dataset.width)
+            row_off = min(max(row_off, 0), raster_dataset.height)
+            col_end = min(max(col_end, col_off), raster_dataset.width)
+            row_end = min(max(row_end, row_off), raster_dataset.height)
+        return rasterio.windows.Window(
+            col_off,
+            row_off,
+            col_end - col_off,
+            row_end - row_off
+        )
+
+
+    def __open_raster__(self) -> rasterio.io.DatasetReader:
+        # opens the raster and records the metadata needed to query it
+        raster_dataset = rasterio.open(self.raster_files[0])
+        band: int = int(self.lookup_field)
+        self.raster_shape = raster_dataset.shape
+        self.raster_dtype: str = raster_dataset.dtypes[band - 1]
+        self.raster_transform = raster_dataset.transform
+        self.raster_nodata: Optional[float] = raster_dataset.nodata
+        self.block_shape: Tuple[int, int] = raster_dataset.block_shapes[
+            band - 1
+        ]
         # instead of reprojecting a raster,
         # configure a reprojector for queries to it
         if self.source_crs != "EPSG:4326":
@@ -305,281 +950,523 @@ class DataSource:
                 crs_to=pyproj.CRS(self.source_crs),
                 always_xy=True
             ).transform
+        return raster_dataset
 
 
     def tag_multiline(
         self,
         lines: MultiLineString,
         n_threads: int
-    ) -> List[ElevationStats]:
+    ) -> np.ndarray:
+        # as for tag_paths
+        coords, offsets = self.__flatten_lines__(list(lines.geoms))
+        return self.tag_paths(coords, offsets, n_threads)
+
+
+    def tag_paths(
+        self,
+        coords: np.ndarray,
+        offsets: np.ndarray,
+        n_threads: int
+    ) -> np.ndarray:
+        # Takes lines as an (n, 2) array of vertices and an array of offsets
+        # to the start of each line, and returns one row of [start, end,
+        # climb, descent] per line, in metres, with NULL_ELEVATION for the
+        # start and end of lines that couldn't be tagged
+        return self.__results_to_metres__(
+            self.__tag_arrays__(coords, offsets, n_threads)
+        )
+
+
+    def __tag_arrays__(
+        self,
+        coords: np.ndarray,
+        offsets: np.ndarray,
+        n_threads: int
+    ) -> np.ndarray:
+        results: np.ndarray = np.empty((len(offsets) - 1, 4), dtype=np.float64)
         # allow multiprocessing to be sidestepped so there's always an
         # option for simple, sequential runs for debugging purposes
         if n_threads == 1:
-            return self.__serial_worker__(lines)
+            self.logger.info('Processing singlethreaded.')
+            self.__prepare_worker__(None)
+            # still in chunks, so that progress can be reported as they're
+            # done
+            for job in self.__chunks__(coords, offsets, n_threads):
+                start, chunk_results = self.__tag_in_process__(*job)
+                results[start:start + len(chunk_results)] = chunk_results
         else:
-            self.logger.info('Spawning %s threads', n_threads)
-            if self.lookup_method == "raster":
-                fsize: int = os.path.getsize(self.filename)
-                footprint: int = fsize * n_threads
-                mem = psutil.virtual_memory()
-                if mem.available / footprint < 2:
-                    self.logger.warning(
-                        ('%s is %s GB. %s threads will each load their own '
-                            'copy, and there is only %s GB memory available. '
-                            'You may get faster results with fewer threads.'),
-                        self.filename,
-                        round(float(fsize) / 1024 / 1024 / 1024, 3),
-                        n_threads,
-                        round(mem.available / 1024 / 1024 / 1024, 3)
-                    )
-            q: mp.JoinableQueue = mp.JoinableQueue()  # for processing
-            out: mp.Queue = mp.Queue()  # to collect output
-            # put each line into the queue
-            for i in range(len(lines)):
-                q.put({
-                    "line": lines[i],
-                    "i": i
-                })
-            # start an appropriate number of workers
-            workers: List[mp.Process] = []
-            for i in range(n_threads):
-                self.logger.debug("Spawning thread %s", i)
-                if self.lookup_method == "contour_lines":
-                    workers.append(mp.Process(
-                        target=self.__parallel_contour_worker__,
-                        args=(q, out, i, self.logger.getEffectiveLevel()),
-                        daemon=True
-                    ))
-                elif self.lookup_method == "raster":
-                    workers.append(mp.Process(
-                        target=self.__parallel_raster_worker__,
-                        args=(
-                            q,
-                            out,
-                            box(*lines.bounds),
-                            i,
-                            self.logger.getEffectiveLevel()
-                        ),
-                        daemon=True
-                    ))
-                workers[i].start()
-            q.join()
-            # collect all the output into one list
-            vals: List[ElevationStats] = []
-            while len(vals) != len(lines):
-                wait: int = 25
-                while(out.empty()):
-                    self.logger.debug(
-                        "Pausing %s milliseconds for %s more lines of data",
-                        wait,
-                        len(lines) - len(vals)
-                    )
-                    time.sleep(wait / 1000)
-                    wait *= 2
-                vals.append(out.get())
-            # clean up child processes
-            for i in range(n_threads):
-                if workers[i].is_alive():
-                    workers[i].terminate()
-            for i in range(n_threads):
-                workers[i].join()
-                if hasattr(workers[i], 'close'):
-                    workers[i].close()
-            self.logger.debug("Parallel processing complete")
-            # output order is not guaranteed, so sort it on returning
-            return sorted(vals, key=lambda x: x.i)
-
-
-    def __serial_worker__(
-        self,
-        lines: MultiLineString
-    ) -> List[ElevationStats]:
-        vals: List[ElevationStats] = []
-        self.logger.info('Processing singlethreaded.')
-        if self.lookup_method == "contour_lines":
-            self.logger.info("Creating spatial index")
-            self.idx = self.gdf.sindex
-            self.logger.info("Deriving elevations from contours")
-            for i in range(len(lines)):
-                vals.append(self.__contour_line_crossings__(
-                    lines[i], i)
-                )
-        elif self.lookup_method == "raster":
-            self.logger.info('Loading %s as raster data', self.filename)
-            self.__read_raster__(box(*lines.bounds))
-            for i in range(len(lines)):
-                vals.append(self.__raster_line_lookups__(lines[i], i))
-            self.raster_dataset.close()
-        return vals
+            pool: mp.pool.Pool = self.__get_pool__(n_threads)
+            jobs = self.__chunks__(coords, offsets, n_threads)
+            n_chunks: int = 0
+            # imap_unordered blocks until each chunk's results are ready,
+            # and the start index says where they belong.  Only that wait
+            # counts as queue_wait, not copying and merging the results.
+            chunks: Iterator[Tuple[int, np.ndarray, Dict]] = \
+                pool.imap_unordered(_tag_chunk, jobs)
+            while True:
+                with METRICS.stage("queue_wait"):
+                    chunk: Optional[
+                        Tuple[int, np.ndarray, Dict]
+                    ] = next(chunks, None)
+                if chunk is None:
+                    break
+                start, chunk_results, recorded = chunk
+                results[start:start + len(chunk_results)] = chunk_results
+                METRICS.merge(recorded)
+                n_chunks += 1
+            self.logger.debug(
+                "Parallel processing of %s lines in %s chunks complete",
+                len(results),
+                n_chunks
+            )
+        return results
 
 
-    def __parallel_contour_worker__(
+    def __chunks__(
         self,
-        q: mp.JoinableQueue,
-        out: mp.Queue,
-        i: int,
-        loglevel: int
-    ) -> None:
-        jobcount: int = 0
-        # taking a shortcut because the built-in logging
-        # becomes tricky with multiprocessing
-        if loglevel < logging.INFO:
-            print("Thread " + str(i) + " creating spatial index")
-        # spatial indexes can't be passed to child processes,
-        # so make one in each thread.  Fortunately, this is a quick operation.
-        self.idx = self.gdf.sindex
-        if loglevel < logging.INFO:
-            print("Thread " + str(i) + " deriving elevations from contours")
-        while not q.empty():
-            job = q.get()
-            out.put(self.__contour_line_crossings__(job["line"], job["i"]))
-            q.task_done()
-            jobcount += 1
-        if loglevel <= logging.INFO:
-            print(
-                "Thread " + str(i) + " processed " + str(jobcount) + " lines"
+        coords: np.ndarray,
+        offsets: np.ndarray,
+        n_threads: int
+    ) -> Iterator[Tuple[int, np.ndarray, np.ndarray]]:
+        # contiguous (first row, coords, offsets) chunks of lines, small
+        # enough to keep every worker busy until the end, but big enough to
+        # keep IPC cheap
+        n_lines: int = len(offsets) - 1
+        chunk_size: int = max(1, min(
+            MAX_CHUNK_LINES,
+            math.ceil(n_lines / (n_threads * CHUNKS_PER_WORKER))
+        ))
+        for i in range(0, n_lines, chunk_size):
+            end: int = min(i + chunk_size, n_lines)
+            yield (
+                i,
+                coords[offsets[i]:offsets[end]],
+                offsets[i:end + 1] - offsets[i]
             )
 
 
-    def __parallel_raster_worker__(
+    def tag_batches(
         self,
-        q: mp.JoinableQueue,
-        out: mp.Queue,
-        bbox: box,
-        i: int,
-        loglevel: int
-    ) -> None:
-        jobcount: int = 0
-        # taking a shortcut because the built-in logging
-        # becomes tricky with multiprocessing
-        if loglevel < logging.INFO:
-            print(
-                "Thread " + str(i) + " loading " + self.filename + " as raster"
-            )
-        # rasterio datasets can't be passed to child threads, so repeat the
-        # load in each thread.  Fortunately, this is a quick operation.
-        self.__read_raster__(bbox)
-        if loglevel < logging.INFO:
-            print("Thread " + str(i) + " deriving elevations from raster")
-        while not q.empty():
-            job = q.get()
-            out.put(self.__raster_line_lookups__(job["line"], job["i"]))
-            q.task_done()
-            jobcount += 1
-        if loglevel <= logging.INFO:
-            print(
-                "Thread " + str(i) + " processed " + str(jobcount) + " lines"
-            )
-        self.raster_dataset.close()
-
-
-    def __nearest_contour__(self, point: Point) -> float:
-        # Check for intersections with progressively larger
-        # buffers until we find at least one contour
-        subset: List[int] = []
-        padding: float = 0.00001
-        i: int = 0
-        while len(subset) < 1:
-            i += 1
-            subset = self.idx.query(
-                point.buffer(padding * i), predicate="intersects"
+        batches: Iterable[Tuple[int, np.ndarray, np.ndarray]],
+        n_threads: int
+    ) -> Iterator[np.ndarray]:
+        # Takes (first row, coords, offsets) batches, and yields their results
+        # in the same order, as for tag_paths.  Only a bounded number of
+        # batches are in flight at once, so memory use doesn't grow with the
+        # size of the input.
+        if n_threads == 1:
+            self.logger.info('Processing singlethreaded.')
+        # results come back in any order, so hold them in submission order
+        # and only hand each one on when everything before it is done
+        pending: Deque[PendingResults] = collections.deque()
+        for batch in batches:
+            pending.append(self.submit(batch, n_threads))
+            if len(pending) >= n_threads * BATCHES_IN_FLIGHT_PER_WORKER:
+                yield pending.popleft().get()
+        while len(pending) > 0:
+            yield pending.popleft().get()
+
+
+    def submit(
+        self,
+        batch: Tuple[int, np.ndarray, np.ndarray],
+        n_threads: int
+    ) -> "PendingResults":
+        # starts tagging a (first row, coords, offsets) batch of lines in the
+        # pool, or tags it straight away if n_threads is 1
+        if n_threads == 1:
+            self.__prepare_worker__(None)
+            return PendingResults(self, self.__tag_in_process__(*batch))
+        return PendingResults(
+            self,
+            self.__get_pool__(n_threads).apply_async(_tag_chunk, (batch,))
+        )
+
+
+    def warm(self, n_threads: int) -> None:
+        # gets everything ready for lines to be submitted, without waiting
+        # for the first batch to need it
+        if n_threads == 1:
+            self.__prepare_worker__(None)
+        else:
+            self.__get_pool__(n_threads)
+
+
+    def __get_pool__(self, n_threads: int) -> mp.pool.Pool:
+        # Worker processes are kept alive between calls, so that the raster
+        # or spatial index only has to be set up once per DataSource
+        if getattr(self, "pool_size", None) == n_threads:
+            return self.pool
+        self.__close_pool__()
+        self.logger.info('Spawning %s threads', n_threads)
+        shm_name: Optional[str] = None
+        if self.lookup_method == "raster" and not self.__use_blocks__():
+            # load the raster once into shared memory, for all the
+            # workers to read from
+            self.logger.info(
+                'Loading %s as raster data into shared memory',
+                self.filename
             )
-        # if we have exactly one result, it must be the nearest
-        if len(subset) == 1:
-            return self.gdf.elevation.iloc[subset[0]]
-        # otherwise calculate distances among the subset returned by .query
-        with warnings.catch_warnings():
-            # suppressing the geopandas UserWarning about distances from a
-            # projected CRS, because we only care about _relative_ distance
-            warnings.simplefilter(action='ignore', category=UserWarning)
-            distances = self.gdf.iloc[subset].distance(point)
-        # and return the elevation of the closest contour
-        return self.gdf.loc[distances.idxmin()]["elevation"]
-
-
-    def __contour_line_crossings__(
+            self.shm: Optional[shared_memory.SharedMemory] = \
+                self.__read_raster__(self.bbox, shared=True)
+            shm_name = self.shm.name  # type: ignore
+            footprint: int = self.raster_values.nbytes
+            mem = psutil.virtual_memory()
+            if mem.available / max(footprint, 1) < 2:
+                self.logger.warning(
+                    ('%s needs %s GB in memory, and there is only %s GB '
+                        'memory available.'),
+                    self.filename,
+                    round(float(footprint) / 1024 / 1024 / 1024, 3),
+                    round(mem.available / 1024 / 1024 / 1024, 3)
+                )
+        # the workers report their progress through this as they go
+        self.board: ProgressBoard = ProgressBoard(n_threads)
+        PROGRESS.add_board(self.board)
+        self.pool: mp.pool.Pool = mp.Pool(
+            n_threads,
+            initializer=_init_pool_worker,
+            initargs=(self, shm_name, self.board)
+        )
+        self.pool_size: Optional[int] = n_threads
+        return self.pool
+
+
+    def __close_pool__(self) -> None:
+        if getattr(self, "pool_size", None) is not None:
+            self.logger.debug("Closing pool of %s threads", self.pool_size)
+            self.pool.close()
+            self.pool.join()
+            self.pool_size = None
+            PROGRESS.remove_board(self.board)
+        if getattr(self, "shm", None) is not None:
+            del self.raster_values
+            self.shm.close()  # type: ignore
+            self.shm.unlink()  # type: ignore
+            self.shm = None
+
+
+    def __getstate__(self) -> dict:
+        # This object is copied to each worker process.  Pools can't be
+        # pickled, and workers attach to the shared raster themselves rather
+        # than receiving their own copy of it.
+        state: dict = self.__dict__.copy()
+        for key in [
+            "pool", "shm", "raster_values", "raster_dataset", "block_cache",
+            "idx", "board", "local_board", "crop_cache"
+        ]:
+            state.pop(key, None)
+        return state
+
+
+    def __prepare_worker__(self, shm_name: Optional[str]) -> None:
+        # set up whatever a worker needs before it can process chunks
+        if self.lookup_method == "contour_lines":
+            if not hasattr(self, "idx"):
+                self.logger.info("Creating spatial index")
+                # spatial indexes can't be passed to child processes,
+                # so make one in each.  Fortunately, this is quick.
+                with METRICS.stage("index"):
+                    self.idx = self.gdf.sindex
+        elif self.lookup_method == "raster":
+            if shm_name is not None:
+                # the parent process has already loaded the band into shared
+                # memory, so this is a zero-copy view onto it
+                self.shm = shared_memory.SharedMemory(name=shm_name)
+                self.raster_values = np.ndarray(
+                    self.raster_shape,
+                    dtype=self.raster_dtype,
+                    buffer=self.shm.buf
+                )
+            elif self.__use_blocks__():
+                if not hasattr(self, "raster_dataset"):
+                    # read blocks of the raster only as they're needed
+                    self.logger.info(
+                        'Reading %s as raster data by blocks, caching up '
+                        'to %s MB',
+                        self.filename,
+                        self.block_cache_mb
+                    )
+                    self.raster_dataset = self.__open_raster__()
+                    self.block_cache = BlockCache(
+                        self.block_cache_mb * 1024 * 1024
+                    )
+            elif not hasattr(self, "raster_values"):
+                self.logger.info('Loading %s as raster data', self.filename)
+                self.__read_raster__(self.bbox)
+
+
+    def __tag_in_process__(
         self,
-        line: LineString,
-        i: int
-    ) -> ElevationStats:
-        stats = ElevationStats(i)
-        # Find the elevation of the first point
-        stats.start = self.__nearest_contour__(Point(line.coords[0]))
-        # if we only have one point then we're set
-        if (len(line.coords) == 1) or (
-            (len(line.coords) == 2) and (line.coords[0] == line.coords[-1])
-        ):
-            stats.end = stats.start
-        # otherwise find all the contour crossings to get the total
+        start: int,
+        coords: np.ndarray,
+        offsets: np.ndarray
+    ) -> Tuple[int, np.ndarray]:
+        # as for __tag_chunk__, for runs without a pool, with progress
+        # reported as if this process were its only worker
+        if getattr(self, "local_board", None) is None:
+            self.local_board: Optional[ProgressBoard] = ProgressBoard(1)
+            self.local_board.claim()
+            PROGRESS.add_board(self.local_board)
+        self.local_board.start_chunk(0)  # type: ignore
+        tagged: Tuple[int, np.ndarray] = self.__tag_chunk__(
+            start, coords, offsets
+        )
+        self.local_board.finish_chunk(  # type: ignore
+            0, len(offsets) - 1, len(coords)
+        )
+        return tagged
+
+
+    @timed("lookup")
+    def __tag_chunk__(
+        self,
+        start: int,
+        coords: np.ndarray,
+        offsets: np.ndarray
+    ) -> Tuple[int, np.ndarray]:
+        # Returns the start index of the chunk and an array with one row of
+        # [start, end, climb, descent] per line
+        if self.lookup_method == "raster":
+            elevations: np.ndarray = self.__raster_points_lookup__(coords)
+            METRICS.count("points_queried", len(coords))
         else:
-            previous_elevation: float = stats.start
-            for coord in line.coords[1:]:
-                elevation: float = self.__nearest_contour__(Point(coord))
-                if elevation > previous_elevation:
-                    stats.climb += elevation - previous_elevation
-                elif elevation < previous_elevation:
-                    stats.descent += previous_elevation - elevation
-                previous_elevation = elevation
-            # after the loop, we already have our final elevation
-            stats.end = elevation
-        return stats
-
-
-    def __raster_point_lookup__(self, point: Point) -> float:
+            # Nearest contour queries are by far the slowest lookups, and
+            # paths from road networks share most of their vertices, so each
+            # distinct vertex is only looked up once.  Raster lookups are
+            # cheaper than finding the duplicates, so they aren't deduped.
+            unique_coords, inverse = self.__unique_points__(coords)
+            elevations = self.__contour_points_lookup__(unique_coords)[inverse]
+            METRICS.count("points_queried", len(unique_coords))
+        METRICS.count("lines", len(offsets) - 1)
+        METRICS.count("points", len(coords))
+        METRICS.count(
+            "nodata_points", int(np.sum(elevations <= NULL_ELEVATION))
+        )
+        return start, self.__reduce_line_stats__(elevations, offsets)
+
+
+    def __unique_points__(
+        self,
+        coords: np.ndarray
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        # Returns the distinct rows of an (n, 2) array of coordinates, and
+        # the index into them of each original row.  Each x, y pair is
+        # hashed as a single complex number, which is much faster than
+        # sorting the rows.
+        codes, uniques = pd.factorize(
+            np.ascontiguousarray(coords, dtype=np.float64)
+            .view(np.complex128).ravel()
+        )
+        return np.asarray(uniques).view(np.float64).reshape(-1, 2), codes
+
+
+    def __results_to_metres__(self, results: np.ndarray) -> np.ndarray:
+        if self.__raster_in_feet__():
+            results = results.copy()
+            results[results[:, 0] > NULL_ELEVATION] *= FOOT_IN_M
+        elif self.lookup_method == "raster" and self.raster_integral:
+            # whole numbers stay integers, so that they're written as such,
+            # e.g. 512 rather than 512.0, as they always have been
+            results = results.astype(np.int64)
+        return results
+
+
+    def __raster_in_feet__(self) -> bool:
+        # contours are already converted to metres as they're loaded
+        return self.lookup_method == "raster" and \
+            self.source_units in ["feet", "foot", "ft"]
+
+
+    def __contour_points_lookup__(self, coords: np.ndarray) -> np.ndarray:
+        # takes an (n, 2) array of x, y coordinates and returns an array of
+        # n elevations, each taken from the nearest contour to that point.
+        # Points with no contour within contour_max_distance get
+        # NULL_ELEVATION.
+        points = gp.points_from_xy(coords[:, 0], coords[:, 1])
+        # one bulk query of the STRtree, returning a [point index, contour
+        # index] pair for each point that has a nearest contour
+        nearest: np.ndarray = self.idx.nearest(
+            points,
+            return_all=False,
+            max_distance=self.contour_max_distance
+        )
+        elevations: np.ndarray = np.full(
+            len(coords), NULL_ELEVATION, dtype=np.float64
+        )
+        elevations[nearest[0]] = self.gdf["elevation"].values[nearest[1]]
+        return elevations
+
+
+    def __raster_points_lookup__(self, coords: np.ndarray) -> np.ndarray:
+        # takes an (n, 2) array of x, y coordinates and returns an array of
+        # n elevations, with NULL_ELEVATION for points outside the raster
         if self.source_crs == "EPSG:4326":
-            row, col = self.raster_dataset.index(point.x, point.y)
+            xs: np.ndarray = coords[:, 0]
+            ys: np.ndarray = coords[:, 1]
         else:
-            projected = transform(self.reprojector, point)
-            row, col = self.raster_dataset.index(projected.x, projected.y)
-        return self.raster_values[row, col]
+            # reproject in bulk, a chunk at a time to bound the size of
+            # pyproj's temporary buffers
+            xs = np.empty(len(coords), dtype=np.float64)
+            ys = np.empty(len(coords), dtype=np.float64)
+            for i in range(0, len(coords), REPROJECTION_CHUNK_SIZE):
+                chunk = slice(i, i + REPROJECTION_CHUNK_SIZE)
+                xs[chunk], ys[chunk] = self.reprojector(
+                    coords[chunk, 0], coords[chunk, 1]
+                )
+        # convert to pixel space in one affine operation.  The epsilon nudge
+        # and flooring replicate rasterio's DatasetReader.index()
+        eps: float = sys.float_info.epsilon
+        cols, rows = ~self.raster_transform * (xs + eps, ys - eps)
+        rows = np.floor(rows).astype(np.int64)
+        cols = np.floor(cols).astype(np.int64)
+        inside = (
+            (rows >= 0) & (rows < self.raster_shape[0]) &
+            (cols >= 0) & (cols < self.raster_shape[1])
+        )
+        elevations: np.ndarray = np.full(
+            len(coords), NULL_ELEVATION, dtype=np.float64
+        )
+        if self.__use_blocks__():
+            elevations[inside] = self.__raster_block_lookup__(
+                rows[inside], cols[inside]
+            )
+        else:
+            elevations[inside] = self.raster_values[
+                rows[inside], cols[inside]
+            ]
+        return elevations
+
 
+    def __use_blocks__(self) -> bool:
+        # block reads go straight to the source file, so they're only
+        # possible if there's just one
+        return self.block_cache_mb > 0 and len(self.raster_files) == 1
 
-    def __raster_line_lookups__(
+
+    def __raster_block_lookup__(
         self,
-        line: LineString,
-        i: int
-    ) -> ElevationStats:
-        stats = ElevationStats(i)
-        # Find the elevation of the first point
-        stats.start = self.__raster_point_lookup__(Point(line.coords[0]))
-        # deal with nodata returns
-        while stats.start <= NULL_ELEVATION:
-            if len(line.coords) <= 2:
-                return ElevationStats()
-            line.coords = line.coords[1:]
-            stats.start = self.__raster_point_lookup__(
-                Point(line.coords[0])
+        rows: np.ndarray,
+        cols: np.ndarray
+    ) -> np.ndarray:
+        # Group the points by the raster block they fall in, so that each
+        # block is only read (or fetched from the cache) once per call
+        block_rows: np.ndarray = rows // self.block_shape[0]
+        block_cols: np.ndarray = cols // self.block_shape[1]
+        n_block_cols: int = math.ceil(
+            self.raster_shape[1] / self.block_shape[1]
+        )
+        block_ids: np.ndarray = block_rows * n_block_cols + block_cols
+        order: np.ndarray = np.argsort(block_ids, kind="stable")
+        unique_ids, firsts = np.unique(block_ids[order], return_index=True)
+        lasts: np.ndarray = np.append(firsts[1:], len(order))
+        elevations: np.ndarray = np.empty(len(rows), dtype=np.float64)
+        for block_id, first, last in zip(unique_ids, firsts, lasts):
+            block_row, block_col = divmod(int(block_id), n_block_cols)
+            block: Optional[np.ndarray] = self.block_cache.get(
+                (block_row, block_col)
             )
-        # if we only have one point then we're set
-        if (len(line.coords) == 1) or (
-            (len(line.coords) == 2) and (line.coords[0] == line.coords[-1])
-        ):
-            stats.end = stats.start
-        # otherwise find all the contour crossings to get the total
-        else:
-            previous_elevation: float = stats.start
-            for coord in line.coords[1:]:
-                elevation: float = self.__raster_point_lookup__(Point(coord))
-                if elevation > NULL_ELEVATION:
-                    if elevation > previous_elevation:
-                        stats.climb += elevation - previous_elevation
-                    elif elevation < previous_elevation:
-                        stats.descent += previous_elevation - elevation
-                    previous_elevation = elevation
-            # after the loop, we already have our final elevation
-            stats.end = previous_elevation
-        if self.source_units in ["feet", "foot", "ft"]:
-            stats.start *= FOOT_IN_M
-            stats.end *= FOOT_IN_M
-            stats.climb *= FOOT_IN_M
-            stats.descent *= FOOT_IN_M
-        return stats
+            if block is None:
+                METRICS.count("raster_blocks_read")
+                row_off: int = block_row * self.block_shape[0]
+                col_off: int = block_col * self.block_shape[1]
+                block = self.raster_dataset.read(
+                    int(self.lookup_field),
+                    window=rasterio.windows.Window(
+                        col_off,
+                        row_off,
+                        min(self.block_shape[1],
+                            self.raster_shape[1] - col_off),
+                        min(self.block_shape[0],
+                            self.raster_shape[0] - row_off)
+                    )
+                )
+                self.block_cache.put((block_row, block_col), block)
+            else:
+                METRICS.count("raster_block_cache_hits")
+            points: np.ndarray = order[first:last]
+            elevations[points] = block[
+                rows[points] - block_row * self.block_shape[0],
+                cols[points] - block_col * self.block_shape[1]
+            ]
+        return elevations
+
+
+    def __flatten_lines__(
+        self,
+        lines: List[LineString]
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        # returns all vertices as one (n, 2) array, plus an array of
+        # len(lines) + 1 offsets so that line i is coords[offsets[i]:
+        # offsets[i + 1]]
+        offsets: np.ndarray = np.zeros(len(lines) + 1, dtype=np.int64)
+        if len(lines) == 0:
+            return np.empty((0, 2), dtype=np.float64), offsets
+        parts: List[np.ndarray] = [
+            np.asarray(line.coords, dtype=np.float64)[:, :2] for line in lines
+        ]
+        offsets[1:] = np.cumsum([len(part) for part in parts])
+        return np.concatenate(parts), offsets
+
+
+    def __reduce_line_stats__(
+        self,
+        elevations: np.ndarray,
+        offsets: np.ndarray
+    ) -> np.ndarray:
+        # Segmented reduction of per-vertex elevations into an array with one
+        # row of [start, end, climb, descent] per line.
+        # Vertices with no data are skipped, so the line is treated as
+        # running straight between the valid vertices either side of them.
+        # As in the original point-by-point implementation, a line is NULL
+        # if its first valid vertex is neither the first nor at least 2 from
+        # the end.
+        n_lines: int = len(offsets) - 1
+        counts: np.ndarray = np.diff(offsets)
+        line_ids: np.ndarray = np.repeat(np.arange(n_lines), counts)
+        positions: np.ndarray = (
+            np.arange(len(elevations)) - np.repeat(offsets[:-1], counts)
+        )
+        valid: np.ndarray = elevations > NULL_ELEVATION
+        values: np.ndarray = elevations[valid]
+        valid_ids: np.ndarray = line_ids[valid]
+        n_valid: np.ndarray = np.bincount(valid_ids, minlength=n_lines)
+        firsts: np.ndarray = np.cumsum(n_valid) - n_valid
+        has_data: np.ndarray = n_valid > 0
+        first_position: np.ndarray = np.full(n_lines, -1, dtype=np.int64)
+        first_position[has_data] = positions[valid][firsts[has_data]]
+        ok: np.ndarray = has_data & (
+            (first_position == 0) | (first_position <= counts - 2)
+        )
+        # elevation changes between consecutive valid vertices of each line
+        steps: np.ndarray = np.diff(values)
+        steps[valid_ids[1:] != valid_ids[:-1]] = 0
+        climb: np.ndarray = np.bincount(
+            valid_ids[1:], weights=np.clip(steps, 0, None), minlength=n_lines
+        )
+        descent: np.ndarray = np.bincount(
+            valid_ids[1:], weights=np.clip(-steps, 0, None), minlength=n_lines
+        )
+        results: np.ndarray = np.zeros((n_lines, 4), dtype=np.float64)
+        results[:, :2] = NULL_ELEVATION
+        results[ok, 0] = values[firsts[ok]]
+        results[ok, 1] = values[firsts[ok] + n_valid[ok] - 1]
+        results[ok, 2] = climb[ok]
+        results[ok, 3] = descent[ok]
+        return results
 
 
     def close(self) -> None:
-        if self.lookup_method == "raster":
-            self.logger.info('Removing temp data file %s', self.filename)
-            os.remove(self.filename)
+        self.__close_pool__()
+        if hasattr(self, "raster_dataset"):
+            self.raster_dataset.close()
+        if getattr(self, "local_board", None) is not None:
+            PROGRESS.remove_board(self.local_board)  # type: ignore
+            self.local_board = None
+        if getattr(self, "crop_cache", None) is not None:
+            self.crop_cache.release()  # type: ignore
+            self.crop_cache = None
 
 
     def __str__(self) -> str:
@@ -590,3 +1477,576 @@ class DataSource:
             "CRS": self.source_crs,
             "elevation units": self.source_units
         })
+
+
+
+
+class PendingResults:
+    # the results of a batch of lines submitted to a DataSource, which may
+    # still be being worked on by its pool
+
+    def __init__(
+        self,
+        source: DataSource,
+        result: Union[mp.pool.AsyncResult, Tuple[int, np.ndarray]]
+    ) -> None:
+        self.source: DataSource = source
+        self.result: Union[mp.pool.AsyncResult, Tuple[int, np.ndarray]] = \
+            result
+
+    def get(self) -> np.ndarray:
+        # blocks until the results are ready, and returns them as for
+        # DataSource.tag_paths
+        if isinstance(self.result, mp.pool.AsyncResult):
+            with METRICS.stage("queue_wait"):
+                start, results, recorded = self.result.get()
+            METRICS.merge(recorded)
+        else:
+            results = self.result[1]
+        return self.source.__results_to_metres__(results)
+
+
+
+
+class PendingBatch:
+    # the results of a batch of lines submitted to a SourceRouter, made up
+    # of the results of each part of it that went to a different DataSource
+
+    def __init__(
+        self,
+        n_lines: int,
+        parts: List[Tuple[np.ndarray, PendingResults]]
+    ) -> None:
+        self.n_lines: int = n_lines
+        # the indices within the batch of each part's lines, and its results
+        self.parts: List[Tuple[np.ndarray, PendingResults]] = parts
+
+    def get(self) -> np.ndarray:
+        # blocks until the results are ready, and merges them in order, as
+        # for DataSource.tag_paths
+        return merge_results(
+            self.n_lines,
+            [(selected, part.get()) for selected, part in self.parts]
+        )
+
+
+
+
+class SourceRouter:
+    # Splits lines between the sources in data_source_list, so that each
+    # line is looked up in the first source in the list whose bbox covers
+    # it, with SRTM as the fallback for lines that no source covers.  The
+    # lines routed to each raster source are then split into spatial
+    # clusters, and the source is loaded separately for each cluster's area,
+    # so that scattered inputs don't need one huge, mostly empty raster.
+    # Results are put back in the order of the input.
+
+    def __init__(
+        self,
+        logger_name: str,
+        data_dir: str,
+        data_source_list: str,
+        bbox: Optional[box] = None,
+        block_cache_mb: int = 0,
+        crop_cache_mb: int = 0,
+        contour_max_distance: Optional[float] = None,
+        contour_index: bool = True
+    ) -> None:
+        self.logger = logging.getLogger(logger_name)
+        self.logger_name: str = logger_name
+        self.data_dir: str = data_dir
+        self.sources_file: str = data_source_list
+        # the area covered by the whole input, if known in advance
+        self.bbox: Optional[box] = bbox
+        self.source_options: Dict = {
+            "block_cache_mb": block_cache_mb,
+            "crop_cache_mb": crop_cache_mb,
+            "contour_max_distance": contour_max_distance,
+            "contour_index": contour_index
+        }
+        with open(self.sources_file) as infile:
+            sources: List[Dict] = json.load(infile)["sources"]
+        # SRTM goes last, so it's only used where nothing else applies
+        self.sources: List[Dict] = sources + [SRTM_SOURCE]
+        self.source_index = gp.GeoSeries(
+            [box(*source["bbox"]) for source in sources]
+        ).sindex
+        # for each source, the grid coarsening and the map from grid cells
+        # to clusters that its lines were split with
+        self.clusters: Dict[int, Tuple[int, Dict[Tuple[int, int], int]]] = {}
+        # the area each (source, cluster) needs to cover when streaming, if
+        # the input has been surveyed
+        self.partition_bounds: Dict[Tuple[int, int], Bounds] = {}
+        self.datasources: Dict[Tuple[int, int], DataSource] = {}
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.close()
+
+
+    def survey(
+        self,
+        batches: Iterable[Tuple[int, np.ndarray, np.ndarray]]
+    ) -> None:
+        # one cheap pass through streamed input, to find the clusters that
+        # each source will need to cover, without loading any of them yet
+        n_lines: int = 0
+        cell_bounds: Dict[int, Dict[Tuple[int, ...], Bounds]] = {}
+        for start, coords, offsets in batches:
+            envelopes: np.ndarray = self.__batch_envelopes__(coords, offsets)
+            routes: np.ndarray = self.__route__(envelopes)
+            for i in np.unique(routes):
+                found: Dict[Tuple[int, ...], Bounds] = cell_bounds.setdefault(
+                    i, {}
+                )
+                for cells, bounds in self.__cell_bounds__(
+                    pygeos.bounds(envelopes[routes == i])
+                ).items():
+                    found[cells] = self.__union__(found.get(cells), bounds)
+            n_lines += len(envelopes)
+        self.logger.info("Found %s rows to look up", n_lines)
+        PROGRESS.expect(n_lines)
+        for i, found in sorted(cell_bounds.items()):
+            self.clusters[i] = self.__find_clusters__(i, found)
+            shift, cluster_of = self.clusters[i]
+            for cells, bounds in found.items():
+                key: Tuple[int, int] = (i, cluster_of[(
+                    cells[0] >> shift, cells[1] >> shift
+                )])
+                self.partition_bounds[key] = self.__union__(
+                    self.partition_bounds.get(key), bounds
+                )
+        for key, bounds in sorted(self.partition_bounds.items()):
+            self.logger.info(
+                "%s will be used for an area of %s",
+                self.sources[key[0]]["name"],
+                bounds
+            )
+
+
+    def tag_multiline(
+        self,
+        lines: MultiLineString,
+        n_threads: int
+    ) -> np.ndarray:
+        geoms: np.ndarray = pygeos.from_shapely(list(lines.geoms))
+        return self.tag_paths(
+            pygeos.get_coordinates(geoms),
+            np.append(0, np.cumsum(pygeos.get_num_coordinates(geoms))),
+            n_threads
+        )
+
+
+    def tag_paths(
+        self,
+        coords: np.ndarray,
+        offsets: np.ndarray,
+        n_threads: int
+    ) -> np.ndarray:
+        # as for DataSource.tag_paths, for lines from any number of sources
+        n_lines: int = len(offsets) - 1
+        PROGRESS.expect(n_lines)
+        counts: np.ndarray = np.diff(offsets)
+        parts: List[Tuple[np.ndarray, np.ndarray]] = []
+        for d, selected in self.__partitions__(
+            self.__batch_envelopes__(coords, offsets)
+        ):
+            if len(selected) == n_lines:
+                parts.append(
+                    (selected, d.tag_paths(coords, offsets, n_threads))
+                )
+            else:
+                in_part: np.ndarray = np.zeros(n_lines, dtype=bool)
+                in_part[selected] = True
+                parts.append((selected, d.tag_paths(
+                    coords[np.repeat(in_part, counts)],
+                    np.append(0, np.cumsum(counts[selected])),
+                    n_threads
+                )))
+        return merge_results(n_lines, parts)
+
+
+    def __partitions__(
+        self,
+        envelopes: np.ndarray
+    ) -> Iterator[Tuple[DataSource, np.ndarray]]:
+        # Splits lines with these envelopes between sources and clusters,
+        # and yields a DataSource loaded for each partition, along with the
+        # indices of the lines in it.  Each partition is only needed once,
+        # so its DataSource is closed to free its workers and data as soon
+        # as the caller is done with it.
+        routes: np.ndarray = self.__route__(envelopes)
+        for i in np.unique(routes):
+            routed: np.ndarray = np.flatnonzero(routes == i)
+            bounds: np.ndarray = pygeos.bounds(envelopes[routed])
+            self.clusters[i] = self.__find_clusters__(
+                i, self.__cell_bounds__(bounds)
+            )
+            clusters: np.ndarray = self.__assign_clusters__(i, bounds)
+            for c in np.unique(clusters):
+                selected: np.ndarray = routed[clusters == c]
+                area: box = box(*pygeos.total_bounds(envelopes[selected]))
+                self.logger.info(
+                    "Routing %s lines in %s to %s",
+                    len(selected),
+                    area.bounds,
+                    self.sources[i]["name"]
+                )
+                yield self.__datasource__((i, c), area), selected
+                self.datasources.pop((i, c)).close()
+
+
+    def tag_batches(
+        self,
+        batches: Iterable[Tuple[int, np.ndarray, np.ndarray]],
+        n_threads: int
+    ) -> Iterator[np.ndarray]:
+        # Routes the lines in each (first row, coords, offsets) batch to
+        # their sources and clusters, and yields the merged results in input
+        # order, with a bounded number of batches in flight as for
+        # DataSource.tag_batches
+        if n_threads == 1:
+            self.logger.info('Processing singlethreaded.')
+        pending: Deque[PendingBatch] = collections.deque()
+        for batch in batches:
+            pending.append(self.submit(batch, n_threads))
+            if len(pending) >= n_threads * BATCHES_IN_FLIGHT_PER_WORKER:
+                yield pending.popleft().get()
+        while len(pending) > 0:
+            yield pending.popleft().get()
+
+
+    def submit(
+        self,
+        batch: Tuple[int, np.ndarray, np.ndarray],
+        n_threads: int
+    ) -> "PendingBatch":
+        # starts tagging a (first row, coords, offsets) batch of lines, by
+        # splitting it between the sources and clusters it's routed to
+        start, coords, offsets = batch
+        envelopes: np.ndarray = self.__batch_envelopes__(coords, offsets)
+        routes: np.ndarray = self.__route__(envelopes)
+        clusters: np.ndarray = np.zeros(len(routes), dtype=np.int64)
+        for i in np.unique(routes):
+            if i in self.clusters:
+                clusters[routes == i] = self.__assign_clusters__(
+                    i, pygeos.bounds(envelopes[routes == i])
+                )
+        counts: np.ndarray = np.diff(offsets)
+        parts: List[Tuple[np.ndarray, PendingResults]] = []
+        keys: np.ndarray = np.stack([routes, clusters], axis=1)
+        for i, c in np.unique(keys, axis=0):
+            in_part: np.ndarray = (routes == i) & (clusters == c)
+            area: box = self.__stream_area__((i, c), envelopes[in_part])
+            if area.is_empty:
+                # the source doesn't overlap bbox at all, and points outside
+                # bbox have no data, so these lines are left NULL
+                continue
+            d: DataSource = self.__datasource__((i, c), area)
+            if in_part.all():
+                part = (0, coords, offsets)
+            else:
+                part = (
+                    0,
+                    coords[np.repeat(in_part, counts)],
+                    np.append(0, np.cumsum(counts[in_part]))
+                )
+            parts.append((np.flatnonzero(in_part), d.submit(part, n_threads)))
+        return PendingBatch(len(routes), parts)
+
+
+    def warm(self, n_threads: int) -> None:
+        # loads every source that could be needed within bbox, so that
+        # batches submitted later don't have to wait for them
+        if self.bbox is None:
+            return
+        uncovered: box = self.bbox
+        for i, source in enumerate(self.sources[:-1]):
+            if box(*source["bbox"]).intersects(self.bbox):
+                area: box = self.__stream_area__((i, 0), np.array([]))
+                self.__datasource__((i, 0), area).warm(n_threads)
+                uncovered = uncovered.difference(box(*source["bbox"]))
+        # SRTM is only needed for whatever isn't covered by anything else
+        if not uncovered.is_empty:
+            srtm: int = len(self.sources) - 1
+            self.__datasource__(
+                (srtm, 0), self.__stream_area__((srtm, 0), np.array([]))
+            ).warm(n_threads)
+
+
+    def route_paths(
+        self,
+        coords: np.ndarray,
+        offsets: np.ndarray
+    ) -> np.ndarray:
+        # returns the index in self.sources of the source that each line
+        # would be looked up in
+        return self.__route__(self.__batch_envelopes__(coords, offsets))
+
+
+    def source_version(self, i: int) -> Optional[str]:
+        # Returns a key identifying self.sources[i], the version of its data
+        # that lines routed to it would be looked up in now, and the options
+        # that affect their results.  None if its file hasn't been saved yet
+        # or is due to be rechecked for a newer version, in which case
+        # results from it can't be reused until it has been loaded.
+        source: Dict = self.sources[i]
+        identity: List = [
+            source,
+            self.source_options["contour_max_distance"]
+        ]
+        # SRTM tiles are never refreshed, so only the source identifies them
+        if source["download_method"] != "srtm":
+            filename: str = os.path.join(self.data_dir, source["filename"])
+            try:
+                stat = os.stat(filename)
+            except FileNotFoundError:
+                return None
+            if source["download_method"] != "local" and \
+                    source["recheck_interval_days"] is not None and \
+                    time.time() - _last_checked(filename) > \
+                    source["recheck_interval_days"] * 60 * 60 * 24:
+                return None
+            identity += [stat.st_mtime, stat.st_size]
+        return hashlib.sha1(
+            json.dumps(identity, sort_keys=True).encode("utf-8")
+        ).hexdigest()
+
+
+    @timed("select_source")
+    def __route__(self, envelopes: np.ndarray) -> np.ndarray:
+        # returns the index in self.sources of the source to use for each
+        # envelope: the first one in the list that fully contains it
+        routes: np.ndarray = np.full(
+            len(envelopes), len(self.sources) - 1, dtype=np.int64
+        )
+        if len(envelopes) > 0:
+            # pairs of [envelope index, source index] for every source that
+            # contains each envelope
+            matches: np.ndarray = self.source_index.query_bulk(
+                envelopes,
+                predicate="within"
+            )
+            np.minimum.at(routes, matches[0], matches[1])
+        return routes
+
+
+    def __cell_bounds__(
+        self,
+        bounds: np.ndarray
+    ) -> Dict[Tuple[int, ...], Bounds]:
+        # Takes an (n, 4) array of line bounds, and returns the exact bounds
+        # of all the lines that span each distinct range of grid cells
+        cells: np.ndarray = np.floor(
+            bounds / CLUSTER_CELL_DEGREES
+        ).astype(np.int64)
+        unique_cells, inverse = np.unique(
+            cells, axis=0, return_inverse=True
+        )
+        inverse = inverse.reshape(-1)
+        lows: np.ndarray = np.full((len(unique_cells), 2), np.inf)
+        highs: np.ndarray = np.full((len(unique_cells), 2), -np.inf)
+        np.minimum.at(lows, inverse, bounds[:, :2])
+        np.maximum.at(highs, inverse, bounds[:, 2:])
+        return {
+            tuple(cells): (low[0], low[1], high[0], high[1])
+            for cells, low, high in zip(
+                unique_cells.tolist(), lows.tolist(), highs.tolist()
+            )
+        }
+
+
+    def __find_clusters__(
+        self,
+        i: int,
+        cell_bounds: Dict[Tuple[int, ...], Bounds]
+    ) -> Tuple[int, Dict[Tuple[int, int], int]]:
+        # Clusters are groups of occupied grid cells that touch each other,
+        # including diagonally.  If there are too many, the grid is made
+        # coarser until there aren't, which merges nearby clusters first.
+        # Returns how many times the grid was halved in resolution, and the
+        # cluster each occupied cell of that grid belongs to.
+        shift: int = 0
+        while True:
+            occupied: Set[Tuple[int, int]] = set()
+            for x0, y0, x1, y1 in cell_bounds.keys():
+                for x in range(x0 >> shift, (x1 >> shift) + 1):
+                    for y in range(y0 >> shift, (y1 >> shift) + 1):
+                        occupied.add((x, y))
+            if self.sources[i]["lookup_method"] != "raster":
+                # the nearest contour to a point near the edge of a cluster
+                # could be outside it, so contours are never split up
+                return shift, {cell: 0 for cell in occupied}
+            cluster_of: Dict[Tuple[int, int], int] = {}
+            n_clusters: int = 0
+            for cell in sorted(occupied):
+                if cell in cluster_of:
+                    continue
+                cluster_of[cell] = n_clusters
+                stack: List[Tuple[int, int]] = [cell]
+                while len(stack) > 0:
+                    x, y = stack.pop()
+                    for dx, dy in itertools.product([-1, 0, 1], repeat=2):
+                        neighbour: Tuple[int, int] = (x + dx, y + dy)
+                        if neighbour in occupied and \
+                                neighbour not in cluster_of:
+                            cluster_of[neighbour] = n_clusters
+                            stack.append(neighbour)
+                n_clusters += 1
+            if n_clusters <= MAX_CLUSTERS_PER_SOURCE:
+                return shift, cluster_of
+            shift += 1
+
+
+    def __assign_clusters__(self, i: int, bounds: np.ndarray) -> np.ndarray:
+        # returns the cluster of source i that each line in an (n, 4) array
+        # of line bounds belongs to, going by the cell of its SW corner
+        shift, cluster_of = self.clusters[i]
+        corners: np.ndarray = np.floor(
+            bounds[:, :2] / CLUSTER_CELL_DEGREES
+        ).astype(np.int64) >> shift
+        unique_corners, inverse = np.unique(
+            corners, axis=0, return_inverse=True
+        )
+        # lines in cells that weren't surveyed go with the first cluster
+        clusters: np.ndarray = np.array([
+            cluster_of.get((x, y), 0) for x, y in unique_corners.tolist()
+        ], dtype=np.int64)
+        return clusters[inverse.reshape(-1)]
+
+
+    def __union__(self, a: Optional[Bounds], b: Bounds) -> Bounds:
+        if a is None:
+            return b
+        return (min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]),
+                max(a[3], b[3]))
+
+
+    def __batch_envelopes__(
+        self,
+        coords: np.ndarray,
+        offsets: np.ndarray
+    ) -> np.ndarray:
+        line_ids: np.ndarray = np.repeat(
+            np.arange(len(offsets) - 1), np.diff(offsets)
+        )
+        return pygeos.envelope(pygeos.multipoints(coords, indices=line_ids))
+
+
+    def __stream_area__(
+        self,
+        key: Tuple[int, int],
+        envelopes: np.ndarray
+    ) -> box:
+        # the area to load a (source, cluster) for when streaming: that
+        # cluster's extent if the input has been surveyed, or else the part
+        # of the input's bbox that the source covers
+        if key in self.partition_bounds:
+            return box(*self.partition_bounds[key])
+        if self.bbox is not None:
+            return self.bbox.intersection(box(*self.sources[key[0]]["bbox"]))
+        return box(*pygeos.total_bounds(envelopes))
+
+
+    def __datasource__(self, key: Tuple[int, int], area: box) -> DataSource:
+        # loads a (source, cluster) for area the first time it's needed
+        if key not in self.datasources:
+            self.datasources[key] = DataSource(
+                self.logger_name,
+                self.data_dir,
+                self.sources_file,
+                area,
+                source=self.sources[key[0]],
+                **self.source_options
+            )
+        return self.datasources[key]
+
+
+    def close(self) -> None:
+        for d in self.datasources.values():
+            d.close()
+        self.datasources = {}
+
+
+def merge_results(
+    n_lines: int,
+    parts: List[Tuple[np.ndarray, np.ndarray]]
+) -> np.ndarray:
+    # Puts the results for each (indices of lines, results) part together
+    # in one array of n_lines rows, with NULL_ELEVATION for lines in no part.
+    # Results are only kept as integers if every part with lines in it is,
+    # and otherwise they're all floats.
+    dtypes: List[np.dtype] = [
+        results.dtype for selected, results in parts if len(selected) > 0
+    ]
+    merged: np.ndarray = np.zeros(
+        (n_lines, 4),
+        dtype=np.result_type(*dtypes) if len(dtypes) > 0 else np.float64
+    )
+    merged[:, :2] = NULL_ELEVATION
+    for selected, results in parts:
+        merged[selected] = results
+    return merged
+
+
+def _last_checked(filename: str) -> float:
+    # when a downloaded file was last found to be the latest version: as
+    # recorded in its .download.json by a recheck, or else when it was saved
+    try:
+        with open(filename + ".download.json") as f:
+            return float(json.load(f)["checked"])
+    except (FileNotFoundError, ValueError, KeyError, TypeError):
+        return os.stat(filename).st_mtime
+
+
+def _remote_version(meta: Dict) -> Dict:
+    # a .download.json's record of the remote version, without the time
+    # that it was last checked
+    return {key: value for key, value in meta.items() if key != "checked"}
+
+
+def _is_encoded(response: requests.Response) -> bool:
+    # whether the server has compressed the body, despite IDENTITY_ENCODING
+    return response.headers.get("Content-Encoding", "identity").lower() \
+        not in ["identity", ""]
+
+
+# each worker process in a DataSource's pool keeps its own copy of the
+# DataSource here, set up once by _init_pool_worker, along with the pool's
+# progress board and its own row of it
+_worker_source: Optional[DataSource] = None
+_worker_board: Optional[ProgressBoard] = None
+_worker_slot: int = 0
+
+
+def _init_pool_worker(
+    source: DataSource,
+    shm_name: Optional[str],
+    board: ProgressBoard
+) -> None:
+    global _worker_source, _worker_board, _worker_slot
+    _worker_board = board
+    _worker_slot = board.claim()
+    # a forked worker starts with a copy of its parent's metrics, which the
+    # parent already has, so only what it records itself is sent back
+    METRICS.reset()
+    METRICS.count("workers_started")
+    source.logger.setLevel(logging.WARNING)
+    source.__prepare_worker__(shm_name)
+    _worker_source = source
+
+
+def _tag_chunk(
+    job: Tuple[int, np.ndarray, np.ndarray]
+) -> Tuple[int, np.ndarray, Dict]:
+    # returns the chunk's results along with the metrics recorded for it
+    _worker_board.start_chunk(_worker_slot)  # type: ignore
+    start, results = _worker_source.__tag_chunk__(*job)  # type: ignore
+    _worker_board.finish_chunk(  # type: ignore
+        _worker_slot, len(job[2]) - 1, len(job[1])
+    )
+    return start, results, METRICS.take()
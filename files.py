@@ -2,17 +2,38 @@
 # -*- coding: utf-8 -*-
 # file handlers and objects
 
+import collections
+import glob
 import logging
 import os
-from typing import List, Tuple
+import re
+import shutil
+import struct
+import tempfile
+import zipfile
+from typing import Any, Deque, Dict, IO, Iterable, Iterator, List, Optional, \
+    Set, Tuple
 
+import numpy as np
 from shapely.geometry import box, LineString, MultiLineString  # type: ignore
 
-from data import DataSource, ElevationStats, NULL_ELEVATION
+from cache import ResultStore, row_hashes
+from data import merge_results, NULL_ELEVATION, SourceRouter
+from metrics import METRICS, timed
 
 
 
 SAVE_PRECISION: int = 3  # round values to mm in the saved output
+# for removing trailing zeros, but leaving at least one decimal place
+TRAILING_ZEROS = re.compile(r'(\.[0-9]*[1-9])0+(?=\s)')
+ROUND_ZEROS = re.compile(r'\.0+(?=\s)')
+# binary input and output files are NumPy .npz archives
+BINARY_EXTENSION: str = ".npz"
+OUTPUT_FORMATS: List[str] = ["text", "npz"]
+# incremental runs keep their results in a store named after the output
+STORE_SUFFIX: str = ".store.npz"
+# what reading an input file fails with if it's missing, or can't be parsed
+INPUT_ERRORS: Tuple = (OSError, ValueError, IndexError, zipfile.BadZipFile)
 
 
 class OutputFile:
@@ -21,10 +42,12 @@ class OutputFile:
         self,
         logger_name: str,
         output_dir: str,
-        output_file: str
+        output_file: str,
+        output_format: str = "text"
     ) -> None:
         self.logger = logging.getLogger(logger_name)
         self.file_path: str = os.path.join(output_dir, output_file)
+        self.output_format: str = output_format
 
         if os.path.exists(self.file_path):
             self.logger.warning(
@@ -34,19 +57,43 @@ class OutputFile:
         else:
             self.logger.info("Output will be saved to new %s", self.file_path)
 
-        self.f = open(self.file_path, 'w')
+        self.f: IO[Any]
+        if output_format == "text":
+            self.f = open(self.file_path, 'w')
+        else:
+            # rows are collected as raw float64s, and only put into the npz
+            # on closing, once we know how many of them there are
+            self.f = tempfile.TemporaryFile(dir=output_dir)
+            self.n_rows: int = 0
+
+    @timed("write")
+    def write_elevations(self, results: np.ndarray) -> None:
+        # takes an array of [start, end, climb, descent] rows, as returned by
+        # SourceRouter.tag_paths, and writes them all at once
+        if self.output_format == "text":
+            self.f.write(format_elevations(results))
+            return
+        results = results.astype(np.float64)
+        results[results[:, 0] == NULL_ELEVATION] = np.nan
+        self.f.write(results.tobytes())
+        self.n_rows += len(results)
 
-    def write_elevations(self, data: ElevationStats) -> None:
-        # skip NULL returns
-        if data.start != NULL_ELEVATION and data.end != NULL_ELEVATION:
-            self.f.write(str(round(data.start, SAVE_PRECISION)))
-            self.f.write('\t')
-            self.f.write(str(round(data.end, SAVE_PRECISION)))
-            self.f.write('\t')
-            self.f.write(str(round(data.climb, SAVE_PRECISION)))
-            self.f.write('\t')
-            self.f.write(str(round(data.descent, SAVE_PRECISION)))
-        self.f.write('\n')
+    @timed("write")
+    def __write_npz__(self) -> None:
+        # Saves the collected rows as a "results" array in an uncompressed
+        # npz, the same as np.savez would, but without having to hold them
+        # all in memory at once.
+        self.f.seek(0)
+        with zipfile.ZipFile(self.file_path, 'w', allowZip64=True) as zf:
+            with zf.open("results.npy", 'w', force_zip64=True) as member:
+                np.lib.format.write_array_header_1_0(member, {
+                    "descr": np.lib.format.dtype_to_descr(
+                        np.dtype(np.float64)
+                    ),
+                    "fortran_order": False,
+                    "shape": (self.n_rows, 4)
+                })
+                shutil.copyfileobj(self.f, member)
 
     def __enter__(self):
         return self
@@ -55,6 +102,8 @@ class OutputFile:
         self.close()
 
     def close(self) -> None:
+        if self.output_format != "text" and not self.f.closed:
+            self.__write_npz__()
         self.f.close()
 
     def __str__(self) -> str:
@@ -68,42 +117,517 @@ class InputFile:
         self,
         logger_name: str,
         input_dir: str,
-        input_file: str
+        input_file: str,
+        stream: bool = False,
+        bbox: Optional[box] = None,
+        batch_size: int = 10000
     ) -> None:
         self.logger = logging.getLogger(logger_name)
+        self.file_name: str = input_file
         self.file_path: str = os.path.join(input_dir, input_file)
+        # in streaming mode rows are only read in batches as they're needed,
+        # so the input never has to be held in memory all at once
+        self.stream: bool = stream
+        self.batch_size: int = batch_size
+        self.__n_lines: Optional[int] = None
+        self.__bbox: Optional[box] = bbox
+        # binary input is memory-mapped rather than parsed, so only the
+        # parts of it being worked on need to be read into memory
+        self.binary: bool = input_file.endswith(BINARY_EXTENSION)
+
+        if self.binary:
+            self.__coords, self.__offsets = load_paths(self.file_path)
+            self.__n_lines = len(self.__offsets) - 1
+            self.logger.info(
+                "Found %s rows in %s",
+                self.n_lines(),
+                self.file_path
+            )
+            if bbox is None and not stream and self.__n_lines > 0:
+                self.__bbox = box(
+                    *self.__coords.min(axis=0),
+                    *self.__coords.max(axis=0)
+                )
+            if self.__bbox is not None:
+                self.logger.info("Area covered: %s", self.__bbox.bounds)
+        elif stream:
+            self.logger.info("Streaming rows from %s", self.file_path)
+            if bbox is not None:
+                self.logger.info("Area covered: %s", bbox.bounds)
+        else:
+            lines: List[LineString] = []
+            with METRICS.stage("read"):
+                for row in self.__rows__():
+                    lines.append(self.__build_line__(row))
+            self.__paths = MultiLineString(lines)
+            self.__n_lines = len(self.__paths.geoms)
+            self.logger.info(
+                "Found %s rows in %s",
+                self.n_lines(),
+                self.file_path
+            )
+            # an empty file covers no area at all
+            if self.__n_lines > 0:
+                self.__bbox = box(*self.__paths.bounds)
+                self.logger.info("Area covered: %s", self.__paths.bounds)
 
-        lines: List[LineString] = []
+    def __rows__(self) -> Iterator[str]:
         with open(self.file_path) as f:
             for row in f:
                 if row.strip() == '':
                     break
-                lines.append(self.__build_line__(row))
-        self.__paths = MultiLineString(lines)
-        self.logger.info("Found %s rows in %s", self.n_lines(), self.file_path)
-        self.logger.info("Area covered: %s", self.__paths.bounds)
+                yield row
 
-    def __build_line__(self, raw_line) -> LineString:
+    def __build_coords__(self, raw_line: str) -> List[Tuple[float, float]]:
+        return parse_coords(raw_line)
+
+    def __build_line__(self, raw_line: str) -> LineString:
+        return LineString(self.__build_coords__(raw_line))
+
+    def batches(self) -> Iterator[Tuple[int, np.ndarray, np.ndarray]]:
+        return self.__batches__()
+
+    def __batches__(self) -> Iterator[Tuple[int, np.ndarray, np.ndarray]]:
+        # yields (first row, coords, offsets) for batch_size rows at a time,
+        # timing how long each one takes to read
+        batches: Iterator[Tuple[int, np.ndarray, np.ndarray]] = \
+            self.__read_batches__()
+        while True:
+            with METRICS.stage("read"):
+                batch: Optional[Tuple[int, np.ndarray, np.ndarray]] = next(
+                    batches, None
+                )
+            if batch is None:
+                return
+            yield batch
+
+    def __read_batches__(
+        self
+    ) -> Iterator[Tuple[int, np.ndarray, np.ndarray]]:
+        if self.binary:
+            yield from self.__binary_batches__()
+            return
+        start: int = 0
         coords: List[Tuple[float, float]] = []
-        for point in raw_line.split(" "):
-            vals = [float(x) for x in point.split(",")]
-            coords.append((vals[0], vals[1]))
-        return LineString(coords)
+        counts: List[int] = [0]
+        for row in self.__rows__():
+            line: List[Tuple[float, float]] = self.__build_coords__(row)
+            coords.extend(line)
+            counts.append(len(line))
+            if len(counts) > self.batch_size:
+                yield start, np.array(coords), np.cumsum(counts)
+                start += len(counts) - 1
+                coords = []
+                counts = [0]
+        if len(counts) > 1:
+            yield start, np.array(coords), np.cumsum(counts)
+
+    def __binary_batches__(
+        self
+    ) -> Iterator[Tuple[int, np.ndarray, np.ndarray]]:
+        for start in range(0, self.__n_lines, self.batch_size):  # type: ignore
+            offsets: np.ndarray = np.array(
+                self.__offsets[start:start + self.batch_size + 1],
+                dtype=np.int64
+            )
+            yield (
+                start,
+                self.__coords[offsets[0]:offsets[-1]],
+                offsets - offsets[0]
+            )
 
     def tag_elevations(
         self,
-        d: DataSource,
+        d: SourceRouter,
         outfile: OutputFile,
-        n_threads: int
+        n_threads: int,
+        store: Optional[ResultStore] = None
     ) -> None:
-        vals: List[ElevationStats] = d.tag_multiline(self.__paths, n_threads)
+        # If a store is given, rows with results in it are copied from there
+        # rather than looked up again, which needs the input to be streamed
+        if self.stream:
+            if store is None:
+                batches: Iterable[Tuple[int, np.ndarray, np.ndarray]] = \
+                    self.__batches__()
+            else:
+                batches = stale_batches(
+                    d, ((batch, store) for batch in self.__batches__())
+                )
+            if self.__bbox is None:
+                # one cheap pass through the file, to find the area that
+                # each data source will need to cover
+                d.survey(batches)
+            self.logger.info("Streaming output to %s", outfile)
+            if store is None:
+                tagged: Iterator[np.ndarray] = d.tag_batches(
+                    self.__batches__(), n_threads
+                )
+            else:
+                tagged = tag_stored_batches(
+                    d,
+                    ((batch, store) for batch in self.__batches__()),
+                    n_threads
+                )
+            for results in tagged:
+                outfile.write_elevations(results)
+            if store is not None:
+                store.save()
+            return
+        if self.binary:
+            results = d.tag_paths(
+                self.__coords, self.__offsets, n_threads
+            )
+        else:
+            results = d.tag_multiline(self.__paths, n_threads)
         self.logger.info("Writing output to %s", outfile)
-        for row in vals:
-            outfile.write_elevations(row)
+        outfile.write_elevations(results)
+
+
+    def bbox(self) -> Optional[box]:
+        # None if streaming rows without having been given their extent
+        return self.__bbox
+
+    def n_lines(self) -> Optional[int]:
+        # None if streaming rows without having counted them
+        return self.__n_lines
+
+
+
+
+
+def find_input_files(input_dir: str, pattern: str) -> List[str]:
+    # returns the files matched by a directory or glob pattern within
+    # input_dir, as paths relative to input_dir
+    path: str = os.path.join(input_dir, pattern)
+    if os.path.isdir(path):
+        path = os.path.join(path, "*")
+    return sorted(
+        os.path.relpath(match, input_dir)
+        for match in glob.glob(path, recursive=True)
+        if os.path.isfile(match)
+    )
+
+
+def tag_files(
+    logger_name: str,
+    infiles: List[InputFile],
+    d: SourceRouter,
+    output_dir: str,
+    n_threads: int,
+    output_format: str = "text",
+    incremental: bool = False
+) -> List[str]:
+    # Tags several streamed input files with one set of data sources.  The
+    # files are surveyed together, so that each source is loaded just once
+    # for the area needed by all of them.  Their batches are then fed to
+    # the workers back to back, so the workers carry straight on with the
+    # next file while the previous one's output is being written.
+    # If incremental, each file's results are kept in a store next to its
+    # output, and only rows that aren't in it already are looked up.
+    # Files that can't be read are skipped, without any output, and the
+    # names of any such files are returned.
+    logger = logging.getLogger(logger_name)
+    failed: Set[int] = set()
+
+    def readable(i: int) -> Iterator[Tuple[int, np.ndarray, np.ndarray]]:
+        # the batches of infiles[i], up to any that can't be read
+        if i in failed:
+            return
+        try:
+            yield from infiles[i].batches()
+        except INPUT_ERRORS as e:
+            logger.error(
+                "Skipping %s, which could not be read: %s",
+                infiles[i].file_path,
+                e
+            )
+            failed.add(i)
+
+    stores: List[ResultStore] = []
+    if incremental:
+        stores = [
+            ResultStore(
+                logger_name,
+                os.path.join(
+                    output_dir,
+                    output_name(infile.file_name, output_format) +
+                    STORE_SUFFIX
+                )
+            )
+            for infile in infiles
+        ]
+    if d.bbox is None:
+        if incremental:
+            d.survey(stale_batches(d, (
+                (batch, stores[i])
+                for i in range(len(infiles))
+                for batch in readable(i)
+            )))
+        else:
+            d.survey(
+                batch for i in range(len(infiles)) for batch in readable(i)
+            )
+    # which file each batch in flight came from, in order
+    owners: Deque[int] = collections.deque()
+
+    def batches() -> Iterator[Tuple[int, np.ndarray, np.ndarray]]:
+        for i in range(len(infiles)):
+            for batch in readable(i):
+                owners.append(i)
+                yield batch
+
+    if incremental:
+        tagged: Iterator[np.ndarray] = tag_stored_batches(
+            d,
+            ((batch, stores[owners[-1]]) for batch in batches()),
+            n_threads
+        )
+    else:
+        tagged = d.tag_batches(batches(), n_threads)
+
+    outfile: Optional[OutputFile] = None
+    opened: int = -1  # the last file that output has been started for
+
+    def next_outfile() -> OutputFile:
+        nonlocal opened
+        opened += 1
+        name: str = output_name(infiles[opened].file_name, output_format)
+        if os.path.dirname(name) != '':
+            os.makedirs(
+                os.path.join(output_dir, os.path.dirname(name)),
+                exist_ok=True
+            )
+        return OutputFile(logger_name, output_dir, name, output_format)
+
+    try:
+        for results in tagged:
+            i: int = owners.popleft()
+            # files that had no rows still get an empty output file
+            while opened < i:
+                if outfile is not None:
+                    outfile.close()
+                outfile = next_outfile()
+            outfile.write_elevations(results)  # type: ignore
+        while opened < len(infiles) - 1:
+            if outfile is not None:
+                outfile.close()
+            outfile = next_outfile()
+    finally:
+        if outfile is not None:
+            outfile.close()
+    for i in sorted(failed):
+        # rather than leaving part of its output behind
+        os.remove(os.path.join(
+            output_dir,
+            output_name(infiles[i].file_name, output_format)
+        ))
+    for i, store in enumerate(stores):
+        if i not in failed:
+            store.save()
+    logger.info("Tagged %s files", len(infiles) - len(failed))
+    return [infiles[i].file_name for i in sorted(failed)]
+
+
+def tag_stored_batches(
+    d: SourceRouter,
+    batches: Iterable[Tuple[Tuple[int, np.ndarray, np.ndarray], ResultStore]],
+    n_threads: int
+) -> Iterator[np.ndarray]:
+    # As for SourceRouter.tag_batches, but for (batch, store) pairs, where
+    # rows with results in the store are copied from it rather than being
+    # looked up again.  The results for each batch are added to its store.
+    splits: Deque[Tuple[ResultStore, np.ndarray, np.ndarray, np.ndarray,
+                        np.ndarray, np.ndarray]] = collections.deque()
+
+    def stale() -> Iterator[Tuple[int, np.ndarray, np.ndarray]]:
+        for batch, store in batches:
+            hashes, routes, keys, found, results, stale_batch = _split_batch(
+                d, batch, store
+            )
+            splits.append((store, hashes, routes, keys, found, results))
+            # batches with nothing to look up are still passed on, so that
+            # their results come back in order
+            yield stale_batch
+
+    for stale_results in d.tag_batches(stale(), n_threads):
+        store, hashes, routes, keys, found, results = splits.popleft()
+        results = merge_results(len(found), [
+            (np.flatnonzero(found), results[found]),
+            (np.flatnonzero(~found), stale_results)
+        ])
+        METRICS.count("rows_from_store", int(found.sum()))
+        # the sources used for the other rows are loaded now, so their
+        # versions are the ones those rows were looked up in
+        store.add(
+            hashes,
+            np.where(found, keys, _source_keys(d, routes)),
+            results
+        )
+        yield results
+
+
+def stale_batches(
+    d: SourceRouter,
+    batches: Iterable[Tuple[Tuple[int, np.ndarray, np.ndarray], ResultStore]]
+) -> Iterator[Tuple[int, np.ndarray, np.ndarray]]:
+    # the rows of each (batch, store) pair that aren't in the store, e.g.
+    # to survey the area that tag_stored_batches will need sources for
+    for batch, store in batches:
+        yield _split_batch(d, batch, store)[-1]
+
+
+def _split_batch(
+    d: SourceRouter,
+    batch: Tuple[int, np.ndarray, np.ndarray],
+    store: ResultStore
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray,
+           Tuple[int, np.ndarray, np.ndarray]]:
+    # Returns the hashes, routes and source keys of a batch's rows, a mask
+    # of the ones found in the store along with their results, and a batch
+    # of the rest
+    start, coords, offsets = batch
+    hashes: np.ndarray = row_hashes(coords, offsets)
+    routes: np.ndarray = d.route_paths(coords, offsets)
+    keys: np.ndarray = _source_keys(d, routes)
+    found, results = store.lookup(hashes, keys)
+    counts: np.ndarray = np.diff(offsets)
+    return hashes, routes, keys, found, results, (
+        start,
+        coords[np.repeat(~found, counts)],
+        np.append(0, np.cumsum(counts[~found]))
+    )
+
+
+def _source_keys(d: SourceRouter, routes: np.ndarray) -> np.ndarray:
+    # the key of the source each row is routed to, or "" if there isn't one
+    # yet
+    keys: np.ndarray = np.full(len(routes), "", dtype=object)
+    for i in np.unique(routes):
+        keys[routes == i] = d.source_version(int(i)) or ""
+    return keys.astype(str)
+
+
+def output_name(input_file: str, output_format: str) -> str:
+    # Output files are named after their input files, with the extension
+    # changed where needed to match the output format
+    stem, ext = os.path.splitext(input_file)
+    if output_format == "npz":
+        return stem + BINARY_EXTENSION
+    if ext == BINARY_EXTENSION:
+        return stem + ".txt"
+    return input_file
+
+
+def load_paths(file_path: str) -> Tuple[np.ndarray, np.ndarray]:
+    # Reads paths from an npz file holding a "coords" array of (n, 2)
+    # x, y vertices in decimal degrees, and an "offsets" array of
+    # len(paths) + 1 offsets, so that path i is
+    # coords[offsets[i]:offsets[i + 1]], e.g. as saved by
+    #   np.savez(file_path, coords=coords, offsets=offsets)
+    # Arrays saved uncompressed, as np.savez does, are memory-mapped.
+    arrays: Dict[str, np.ndarray] = {}
+    with zipfile.ZipFile(file_path) as zf:
+        for name in ["coords", "offsets"]:
+            try:
+                info: zipfile.ZipInfo = zf.getinfo(name + ".npy")
+            except KeyError:
+                raise ValueError(
+                    "%s has no %s array" % (file_path, name)
+                )
+            if info.compress_type == zipfile.ZIP_STORED:
+                arrays[name] = _map_member(file_path, info)
+            else:
+                with zf.open(info) as f:
+                    arrays[name] = np.lib.format.read_array(f)
+    coords: np.ndarray = arrays["coords"]
+    offsets: np.ndarray = arrays["offsets"]
+    if coords.dtype != np.float64:
+        coords = coords.astype(np.float64)
+    if not np.issubdtype(offsets.dtype, np.integer):
+        raise ValueError("offsets in %s must be integers" % file_path)
+    if offsets.dtype != np.int64:
+        offsets = offsets.astype(np.int64)
+    if coords.ndim != 2 or coords.shape[1] != 2:
+        raise ValueError(
+            "coords in %s must be an (n, 2) array" % file_path
+        )
+    if offsets.ndim != 1 or len(offsets) == 0 or offsets[0] != 0 or \
+            offsets[-1] != len(coords) or np.any(np.diff(offsets) < 1):
+        raise ValueError(
+            "offsets in %s must run from 0 to len(coords), with at least "
+            "one vertex per path" % file_path
+        )
+    return coords, offsets
+
+
+def _map_member(file_path: str, info: zipfile.ZipInfo) -> np.ndarray:
+    # memory-maps an uncompressed .npy file within a zip archive
+    with open(file_path, 'rb') as f:
+        # the member's data follows its local header, whose size depends on
+        # the lengths of the file name and extra field recorded in it
+        f.seek(info.header_offset + 26)
+        name_length, extra_length = struct.unpack('<HH', f.read(4))
+        f.seek(info.header_offset + 30 + name_length + extra_length)
+        version: Tuple[int, int] = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            header = np.lib.format.read_array_header_1_0(f)
+        else:
+            header = np.lib.format.read_array_header_2_0(f)
+        shape, fortran_order, dtype = header
+        if dtype.hasobject:
+            raise ValueError("%s holds Python objects" % info.filename)
+        if int(np.prod(shape)) == 0:
+            return np.empty(shape, dtype=dtype)
+        return np.memmap(
+            file_path,
+            dtype=dtype,
+            mode='r',
+            offset=f.tell(),
+            shape=shape,
+            order='F' if fortran_order else 'C'
+        )
+
 
+def parse_coords(raw_line: str) -> List[Tuple[float, float]]:
+    # one row of input is a path as space-separated "x,y" points
+    coords: List[Tuple[float, float]] = []
+    for point in raw_line.split(" "):
+        vals = [float(x) for x in point.split(",")]
+        coords.append((vals[0], vals[1]))
+    return coords
 
-    def bbox(self) -> box:
-        return box(*self.__paths.bounds)
 
-    def n_lines(self) -> int:
-        return len(self.__paths.geoms)
+def format_elevations(results: np.ndarray) -> str:
+    # Formats an array of [start, end, climb, descent] rows as output text,
+    # all in one go.  Values are rounded to mm, and written without trailing
+    # zeros, e.g. 12.3 rather than 12.300.  Zero climbs and descents are
+    # written as 0, and rows that couldn't be tagged are left blank.
+    tagged: np.ndarray = (
+        (results[:, 0] != NULL_ELEVATION) & (results[:, 1] != NULL_ELEVATION)
+    )
+    written: np.ndarray = np.zeros(results.shape, dtype=bool)
+    written[tagged, :2] = True
+    written[tagged, 2:] = results[tagged, 2:] != 0
+    # pick a template for each row, with placeholders only where values are
+    # written.  Integers, from integer rasters, are written as they are.
+    if np.issubdtype(results.dtype, np.integer):
+        value: str = '%d'
+    else:
+        value = '%.' + str(SAVE_PRECISION) + 'f'
+    templates: np.ndarray = np.array([
+        '\t'.join([value, value, '0', '0']) + '\n',
+        '\t'.join([value, value, value, '0']) + '\n',
+        '\t'.join([value, value, '0', value]) + '\n',
+        '\t'.join([value, value, value, value]) + '\n',
+        '\n'
+    ])
+    choices: np.ndarray = np.where(
+        tagged,
+        written[:, 2] * 1 + written[:, 3] * 2,
+        4
+    )
+    text: str = ''.join(templates[choices].tolist()) % tuple(
+        results[written].tolist()
+    )
+    text = TRAILING_ZEROS.sub(r'\1', text)
+    return ROUND_ZEROS.sub('.0', text)
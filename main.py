@@ -8,9 +8,15 @@ import sys
 import time
 
 import click
+from shapely.geometry import box  # type: ignore
+from typing import List, Optional
 
-from data import DataSource
-from files import InputFile, OutputFile
+from cache import ResultStore
+from data import DataSourceError, SourceRouter
+from files import find_input_files, INPUT_ERRORS, InputFile, OutputFile, \
+    OUTPUT_FORMATS, output_name, STORE_SUFFIX, tag_files
+from metrics import METRICS
+from progress import PROGRESS
 
 __author__ = "Eldan Goldenberg for A/B Street, February-March 2021"
 __license__ = "Apache"
@@ -54,6 +60,102 @@ __license__ = "Apache"
             'Only messages of the selected severity or higher will be emitted.'
             'Default: INFO')
 )
+@click.option(
+    '--stream',
+    is_flag=True,
+    help=('Read, process and write the input in batches, '
+            'so that memory use stays roughly constant for large inputs')  # noqa: E127, E501
+)
+@click.option(
+    '--batch',
+    is_flag=True,
+    help=('Treat INPUT_FILE as a directory or glob pattern within the input '
+            'directory, and process every file it matches, writing an '  # noqa: E127, E501
+            'output file for each.  The files are streamed and share one set '  # noqa: E127, E501
+            'of loaded data sources')
+)
+@click.option(
+    '--incremental',
+    is_flag=True,
+    help=('Keep results in a store next to the output, and on later runs '
+            'only look up rows that are new, have changed, or use a data '  # noqa: E127, E501
+            'source that has been refreshed since.  The input is streamed')  # noqa: E127, E501
+)
+@click.option(
+    '--batch_size',
+    default=10000,
+    help=('Number of rows per batch when streaming, '
+            'or leave out for default value: 10000')  # noqa: E127, E501
+)
+@click.option(
+    '--output_format',
+    type=click.Choice(OUTPUT_FORMATS),
+    default='text',
+    help=('Format to write output in: tab-separated "text", or "npz" for a '
+            'NumPy archive holding a "results" array of the same values, '  # noqa: E127, E501
+            'unrounded and with NaNs for paths that could not be tagged.  '  # noqa: E127, E501
+            'Default: text')
+)
+@click.option(
+    '--bbox',
+    default=None,
+    help=('Area covered by the input, as "W,S,E,N" in decimal degrees.  '
+            'When streaming, this skips the pass through the input '  # noqa: E127, E501
+            'that would otherwise be needed to find its extent')
+)
+@click.option(
+    '--block_cache_mb',
+    default=0,
+    help=('If set, raster data is read only in the blocks that contain '
+            'input points, keeping up to this many MB of them cached, '  # noqa: E127, E501
+            'instead of loading the whole area at once')
+)
+@click.option(
+    '--crop_cache_mb',
+    default=0,
+    help=('If set, rasters merged from multiple tiles are kept in the data '
+            'directory for reuse by later runs, up to this many MB of them')  # noqa: E127, E501
+)
+@click.option(
+    '--contour_max_distance',
+    default=None,
+    type=float,
+    help=('For contour data sources, points further than this many degrees '
+            'from any contour are treated as having no elevation data')  # noqa: E127, E501
+)
+@click.option(
+    '--contour_index/--no_contour_index',
+    default=True,
+    help=('Whether to preprocess contour data sources into an index in the '
+            'data directory, which makes later runs start much faster.  '  # noqa: E127, E501
+            'Default: on')
+)
+@click.option(
+    '--metrics_json',
+    default=None,
+    help=('File to save timings of each stage of the run, and counters of '
+            'the work done, to as JSON')  # noqa: E127, E501
+)
+@click.option(
+    '--metrics_prom',
+    default=None,
+    help=('File to save the same metrics as --metrics_json to, in '
+            'Prometheus\' text format, e.g. for node_exporter\'s textfile '  # noqa: E127, E501
+            'collector')
+)
+@click.option(
+    '--progress_interval',
+    default=60,
+    help=('Seconds between reports of progress, throughput and time left '
+            'while looking up elevations, or 0 for none.  Default: 60')  # noqa: E127, E501
+)
+@click.option(
+    '--progress_file',
+    default=None,
+    help=('File to keep updated with each progress report as JSON, '
+            'including how much each worker process has done, and whether '  # noqa: E127, E501
+            'it seems to be stuck')
+)
 @click.argument('input_file')
 def main(
     input_dir: str,
@@ -62,7 +164,21 @@ def main(
     data_source_list: str,
     input_file: str,
     n_threads: int,
-    log: str
+    log: str,
+    stream: bool,
+    batch: bool,
+    incremental: bool,
+    batch_size: int,
+    output_format: str,
+    bbox: Optional[str],
+    block_cache_mb: int,
+    crop_cache_mb: int,
+    contour_max_distance: Optional[float],
+    contour_index: bool,
+    metrics_json: Optional[str],
+    metrics_prom: Optional[str],
+    progress_interval: float,
+    progress_file: Optional[str]
 ) -> None:
     start_time: float = time.time()
     logging.basicConfig(
@@ -79,10 +195,113 @@ def main(
             "Attempting to use more processes than the %s CPUs present",
             os.cpu_count()
         )
-    infile = InputFile(__name__, input_dir, input_file)
-    with DataSource(__name__, data_dir, data_source_list, infile.bbox()) as d:
-        with OutputFile(__name__, output_dir, input_file) as outfile:
-            infile.tag_elevations(d, outfile, n_threads)
+    area: Optional[box] = None
+    if bbox is not None:
+        try:
+            area = box(*[float(x) for x in bbox.split(",")])
+        except (TypeError, ValueError):
+            logger.critical('Could not parse "%s" as W,S,E,N', bbox)
+            sys.exit(1)
+    if batch:
+        input_files: List[str] = find_input_files(input_dir, input_file)
+        if len(input_files) == 0:
+            logger.critical(
+                'No files matching "%s" found in %s',
+                input_file,
+                input_dir
+            )
+            sys.exit(1)
+        logger.info("Found %s input files", len(input_files))
+        infiles: List[InputFile] = []
+        # files that can't be read are skipped, rather than holding up the
+        # rest, and reported at the end
+        unreadable: List[str] = []
+        for fname in input_files:
+            try:
+                infiles.append(InputFile(
+                    __name__,
+                    input_dir,
+                    fname,
+                    stream=True,
+                    bbox=area,
+                    batch_size=batch_size
+                ))
+            except INPUT_ERRORS as e:
+                logger.error(
+                    "Skipping %s, which could not be read: %s",
+                    fname,
+                    e
+                )
+                unreadable.append(fname)
+        if len(infiles) == 0:
+            logger.critical("None of the input files could be read")
+            sys.exit(1)
+    else:
+        infiles = [InputFile(
+            __name__,
+            input_dir,
+            input_file,
+            stream=stream or incremental,
+            bbox=area,
+            batch_size=batch_size
+        )]
+    try:
+        with SourceRouter(
+            __name__,
+            data_dir,
+            data_source_list,
+            infiles[0].bbox(),
+            block_cache_mb=block_cache_mb,
+            crop_cache_mb=crop_cache_mb,
+            contour_max_distance=contour_max_distance,
+            contour_index=contour_index
+        ) as d:
+            with PROGRESS.reporting(
+                __name__,
+                progress_interval,
+                progress_file
+            ):
+                if batch:
+                    unreadable += tag_files(
+                        __name__,
+                        infiles,
+                        d,
+                        output_dir,
+                        n_threads,
+                        output_format,
+                        incremental
+                    )
+                else:
+                    output_file: str = output_name(input_file, output_format)
+                    store: Optional[ResultStore] = None
+                    if incremental:
+                        store = ResultStore(
+                            __name__,
+                            os.path.join(
+                                output_dir,
+                                output_file + STORE_SUFFIX
+                            )
+                        )
+                    with OutputFile(
+                        __name__,
+                        output_dir,
+                        output_file,
+                        output_format
+                    ) as outfile:
+                        infiles[0].tag_elevations(d, outfile, n_threads, store)
+    except DataSourceError as e:
+        logger.critical(e)
+        write_metrics(metrics_json, metrics_prom)
+        sys.exit(1)
+    write_metrics(metrics_json, metrics_prom)
+    if batch and len(unreadable) > 0:
+        logger.critical(
+            "Run complete in %s, but %s input files could not be read: %s",
+            elapsedTime(start_time),
+            len(unreadable),
+            ", ".join(unreadable)
+        )
+        sys.exit(1)
     logger.info("Run complete in %s.", elapsedTime(start_time))
     sys.exit(0)
 
@@ -90,6 +309,26 @@ def main(
 
 
 
+def write_metrics(
+    metrics_json: Optional[str],
+    metrics_prom: Optional[str]
+) -> None:
+    logger = logging.getLogger(__name__)
+    for name, stage in METRICS.report()["stages"].items():
+        logger.debug(
+            "%s: %s seconds in %s calls",
+            name,
+            round(stage["seconds"], 3),
+            stage["calls"]
+        )
+    if metrics_json is not None:
+        METRICS.write_json(metrics_json)
+        logger.info("Metrics saved to %s", metrics_json)
+    if metrics_prom is not None:
+        METRICS.write_prometheus(metrics_prom)
+        logger.info("Metrics saved to %s", metrics_prom)
+
+
 def elapsedTime(start_time: float) -> str:
     seconds: float = time.time() - start_time
     if seconds < 1:
@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# timings and counters for each stage of a run
+
+import collections
+import contextlib
+import functools
+import json
+import os
+import tempfile
+import threading
+import time
+from typing import Any, Callable, DefaultDict, Dict, Iterator, List
+
+
+PROMETHEUS_PREFIX: str = "elevation_lookups_"
+
+
+class Metrics:
+    # Accumulates the time spent in each stage of a run, and counters of
+    # the work done, e.g.:
+    #   with METRICS.stage("download"):
+    #       ...
+    #   METRICS.count("points", len(coords))
+    # Stages can be nested, e.g. merging raster tiles happens while loading
+    # them, in which case the time counts towards both.  Times of stages
+    # running concurrently in several threads are added up.
+    # Worker processes record into their own copy, and send what they've
+    # recorded back with each chunk of results, for the parent to merge.
+
+    def __init__(self) -> None:
+        # stages and counters are updated from several threads in server
+        # mode, and while downloading SRTM tiles
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self) -> None:
+        with self.lock:
+            self.started: float = time.time()
+            self.stage_seconds: DefaultDict[str, float] = \
+                collections.defaultdict(float)
+            self.stage_calls: DefaultDict[str, int] = \
+                collections.defaultdict(int)
+            self.counters: DefaultDict[str, float] = \
+                collections.defaultdict(int)
+            # lines, points and time spent on lookups by each worker
+            # process, by pid
+            self.workers: Dict[int, DefaultDict[str, float]] = {}
+
+    @contextlib.contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        start: float = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed: float = time.perf_counter() - start
+            with self.lock:
+                self.stage_seconds[name] += elapsed
+                self.stage_calls[name] += 1
+
+    def count(self, name: str, value: float = 1) -> None:
+        with self.lock:
+            self.counters[name] += value
+
+    def take(self) -> Dict[str, Any]:
+        # returns everything recorded since the last call, and starts afresh
+        with self.lock:
+            recorded: Dict[str, Any] = {
+                "pid": os.getpid(),
+                "stage_seconds": dict(self.stage_seconds),
+                "stage_calls": dict(self.stage_calls),
+                "counters": dict(self.counters)
+            }
+            self.stage_seconds.clear()
+            self.stage_calls.clear()
+            self.counters.clear()
+        return recorded
+
+    def merge(self, recorded: Dict[str, Any]) -> None:
+        # adds what a worker process has taken to this process's totals
+        with self.lock:
+            for name, seconds in recorded["stage_seconds"].items():
+                self.stage_seconds[name] += seconds
+            for name, calls in recorded["stage_calls"].items():
+                self.stage_calls[name] += calls
+            for name, value in recorded["counters"].items():
+                self.counters[name] += value
+            worker: DefaultDict[str, float] = self.workers.setdefault(
+                recorded["pid"], collections.defaultdict(float)
+            )
+            worker["lines"] += recorded["counters"].get("lines", 0)
+            worker["points"] += recorded["counters"].get("points", 0)
+            worker["busy_s"] += recorded["stage_seconds"].get("lookup", 0)
+
+    def report(self) -> Dict[str, Any]:
+        with self.lock:
+            return {
+                "elapsed_s": time.time() - self.started,
+                "stages": {
+                    name: {
+                        "seconds": seconds,
+                        "calls": self.stage_calls[name]
+                    }
+                    for name, seconds in sorted(self.stage_seconds.items())
+                },
+                "counters": dict(sorted(self.counters.items())),
+                "workers": {
+                    str(pid): dict(
+                        worker,
+                        lines_per_s=worker["lines"] / worker["busy_s"]
+                        if worker["busy_s"] > 0 else 0.0
+                    )
+                    for pid, worker in sorted(self.workers.items())
+                }
+            }
+
+    def prometheus(self) -> str:
+        # the report in Prometheus' text exposition format
+        report: Dict[str, Any] = self.report()
+        lines: List[str] = []
+
+        def metric(
+            name: str,
+            kind: str,
+            help_text: str,
+            samples: List[str]
+        ) -> None:
+            lines.append(
+                "# HELP " + PROMETHEUS_PREFIX + name + " " + help_text
+            )
+            lines.append("# TYPE " + PROMETHEUS_PREFIX + name + " " + kind)
+            lines.extend(PROMETHEUS_PREFIX + name + s for s in samples)
+
+        metric("elapsed_seconds", "gauge", "Time since the run started", [
+            " " + repr(report["elapsed_s"])
+        ])
+        metric(
+            "stage_seconds_total",
+            "counter",
+            "Time spent in each stage",
+            [
+                '{stage="%s"} %r' % (name, stage["seconds"])
+                for name, stage in report["stages"].items()
+            ]
+        )
+        metric(
+            "stage_calls_total",
+            "counter",
+            "Number of times each stage has run",
+            [
+                '{stage="%s"} %r' % (name, stage["calls"])
+                for name, stage in report["stages"].items()
+            ]
+        )
+        for name, value in report["counters"].items():
+            metric(name + "_total", "counter", "Count of " + name, [
+                " " + repr(value)
+            ])
+        for field, help_text in [
+            ("lines", "Lines looked up by each worker process"),
+            ("points", "Points looked up by each worker process"),
+            ("busy_s", "Time each worker process has spent on lookups")
+        ]:
+            metric("worker_" + (
+                "busy_seconds" if field == "busy_s" else field
+            ) + "_total", "counter", help_text, [
+                '{worker="%s"} %r' % (pid, worker[field])
+                for pid, worker in report["workers"].items()
+            ])
+        return "\n".join(lines) + "\n"
+
+    def write_json(self, path: str) -> None:
+        write_atomically(path, json.dumps(self.report(), indent=2))
+
+    def write_prometheus(self, path: str) -> None:
+        write_atomically(path, self.prometheus())
+
+
+# the metrics for this process, shared by everything in it, as loggers are
+METRICS = Metrics()
+
+
+def timed(stage: str) -> Callable:
+    # decorator that counts all the time spent in a function towards stage
+    def decorator(f: Callable) -> Callable:
+        @functools.wraps(f)
+        def wrapper(*args, **kwargs):
+            with METRICS.stage(stage):
+                return f(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+
+def write_atomically(path: str, text: str) -> None:
+    # written under a temporary name and renamed into place, so that a
+    # reader never sees a partial file
+    fd, tmp_path = tempfile.mkstemp(
+        dir=os.path.dirname(os.path.abspath(path)),
+        suffix=".tmp"
+    )
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(text)
+        # mkstemp makes files only readable by their owner
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
@@ -0,0 +1,279 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# live progress of lookups, from counters shared with the worker processes
+
+import contextlib
+import ctypes
+import json
+import logging
+import math
+import multiprocessing as mp
+import os
+import threading
+import time
+from typing import Any, Dict, Iterator, List, Optional
+
+import numpy as np
+import psutil  # type: ignore
+
+from metrics import write_atomically
+
+
+# the columns of a ProgressBoard, one row per worker
+FIELDS: List[str] = [
+    "pid", "lines", "points", "chunks", "busy_s", "chunk_started"
+]
+PID, LINES, POINTS, CHUNKS, BUSY_S, CHUNK_STARTED = range(len(FIELDS))
+# a worker counts as stalled once it has been on one chunk for this many
+# times as long as chunks have taken on average, and at least this long
+STALL_FACTOR: float = 10
+STALL_MIN_SECONDS: float = 60
+
+
+
+
+class ProgressBoard:
+    # Counters of the work done by each process in a pool, in memory shared
+    # with them.  Each worker claims a row when it starts, and updates it as
+    # it starts and finishes each chunk, which is just a few stores, with no
+    # locking or messages.  The parent reads the whole board whenever it
+    # reports progress.  A reader can catch a row part way through being
+    # updated, which only ever throws a progress report off by one chunk.
+
+    def __init__(self, n_slots: int) -> None:
+        self.n_slots: int = n_slots
+        self.values = mp.RawArray(ctypes.c_double, n_slots * len(FIELDS))
+        # only held while claiming a row
+        self.lock = mp.Lock()
+
+    def claim(self) -> int:
+        # Called by each worker as it starts, to get the row it updates.  A
+        # pool never has more live workers than it has rows, so there's
+        # always one that's unused, or was used by a worker that has died.
+        # A worker that replaces one that died carries on from its counts,
+        # so that what it did still counts towards the totals.
+        with self.lock:
+            rows: np.ndarray = self.__rows__()
+            for slot in range(self.n_slots):
+                pid: int = int(rows[slot, PID])
+                if pid == 0 or not psutil.pid_exists(pid):
+                    rows[slot, PID] = os.getpid()
+                    rows[slot, CHUNK_STARTED] = 0
+                    return slot
+        # not tracked, which shouldn't happen
+        return -1
+
+    def start_chunk(self, slot: int) -> None:
+        if slot >= 0:
+            self.__rows__()[slot, CHUNK_STARTED] = time.time()
+
+    def finish_chunk(self, slot: int, n_lines: int, n_points: int) -> None:
+        if slot < 0:
+            return
+        row: np.ndarray = self.__rows__()[slot]
+        row[LINES] += n_lines
+        row[POINTS] += n_points
+        row[CHUNKS] += 1
+        row[BUSY_S] += time.time() - row[CHUNK_STARTED]
+        row[CHUNK_STARTED] = 0
+
+    def read(self) -> np.ndarray:
+        # a copy of the board, with a row for each worker that has started
+        rows: np.ndarray = self.__rows__().copy()
+        return rows[rows[:, PID] > 0]
+
+    def __rows__(self) -> np.ndarray:
+        # a view of the shared memory, rather than a copy of it
+        return np.frombuffer(  # type: ignore
+            self.values,
+            dtype=np.float64
+        ).reshape(
+            self.n_slots, len(FIELDS)
+        )
+
+
+
+
+class Progress:
+    # Tracks how far through the run lookups are, from the boards of all the
+    # pools in this process, and reports on it periodically while a run is
+    # going:
+    #   with PROGRESS.reporting(logger_name, interval, path):
+    #       ...
+    # Each report logs the throughput and ETA, warns about workers that seem
+    # stuck, and if a path is given, saves the full report there as JSON.
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.boards: List[ProgressBoard] = []
+        # the rows of the boards of pools that have since been closed
+        self.retired: np.ndarray = np.zeros((0, len(FIELDS)))
+        # the number of lines to be looked up, if known
+        self.total: Optional[int] = None
+        self.started: float = time.time()
+        # lines done and when, as of the previous report
+        self.last: Optional[Dict[str, float]] = None
+
+    def expect(self, n_lines: int) -> None:
+        # adds to the number of lines that the run is going to look up
+        with self.lock:
+            self.total = (self.total or 0) + n_lines
+
+    def add_board(self, board: ProgressBoard) -> None:
+        with self.lock:
+            self.boards.append(board)
+
+    def remove_board(self, board: ProgressBoard) -> None:
+        # keeps what its pool did, once it has finished working
+        with self.lock:
+            if board in self.boards:
+                self.boards.remove(board)
+                self.retired = np.concatenate([self.retired, board.read()])
+
+    def report(self) -> Dict[str, Any]:
+        now: float = time.time()
+        with self.lock:
+            rows: np.ndarray = np.concatenate(
+                [self.retired] + [board.read() for board in self.boards]
+            )
+            total: Optional[int] = self.total
+        done: float = float(rows[:, LINES].sum())
+        chunks: float = float(rows[:, CHUNKS].sum())
+        elapsed: float = now - self.started
+        rate: float = done / elapsed if elapsed > 0 else 0.0
+        if self.last is not None and now > self.last["time"]:
+            recent_rate: float = \
+                (done - self.last["lines"]) / (now - self.last["time"])
+        else:
+            recent_rate = rate
+        self.last = {"time": now, "lines": done}
+        mean_chunk_s: float = (
+            float(rows[:, BUSY_S].sum()) / chunks if chunks > 0 else math.inf
+        )
+        stall_s: float = max(STALL_MIN_SECONDS, STALL_FACTOR * mean_chunk_s)
+        workers: List[Dict[str, Any]] = []
+        for row in rows:
+            on_chunk_s: Optional[float] = (
+                now - float(row[CHUNK_STARTED])
+                if row[CHUNK_STARTED] > 0 else None
+            )
+            workers.append({
+                "pid": int(row[PID]),
+                "lines": int(row[LINES]),
+                "points": int(row[POINTS]),
+                "chunks": int(row[CHUNKS]),
+                "busy_s": float(row[BUSY_S]),
+                "lines_per_s": float(row[LINES] / row[BUSY_S])
+                if row[BUSY_S] > 0 else 0.0,
+                # None if idle, waiting for work
+                "on_chunk_s": on_chunk_s,
+                "stalled": on_chunk_s is not None and on_chunk_s > stall_s
+            })
+        return {
+            "time": now,
+            "elapsed_s": elapsed,
+            "lines_done": int(done),
+            "lines_total": total,
+            "fraction": min(1.0, done / total) if total else None,
+            "lines_per_s": rate,
+            "recent_lines_per_s": recent_rate,
+            "eta_s": max(0.0, (total - done) / rate)
+            if total is not None and rate > 0 else None,
+            "workers": workers
+        }
+
+    @contextlib.contextmanager
+    def reporting(
+        self,
+        logger_name: str,
+        interval: float,
+        path: Optional[str] = None
+    ) -> Iterator[None]:
+        # reports every interval seconds in a background thread, unless
+        # interval is 0, and saves a report once more at the end, so that
+        # the file shows the finished run
+        logger = logging.getLogger(logger_name)
+        self.started = time.time()
+        self.last = None
+        stop: threading.Event = threading.Event()
+
+        def report_periodically() -> None:
+            while not stop.wait(interval):
+                self.__log__(logger, path)
+
+        thread: threading.Thread = threading.Thread(
+            target=report_periodically,
+            daemon=True
+        )
+        if interval > 0:
+            thread.start()
+        try:
+            yield
+        finally:
+            stop.set()
+            if thread.is_alive():
+                thread.join()
+            if path is not None:
+                self.__save__(self.report(), path)
+
+    def __log__(self, logger: logging.Logger, path: Optional[str]) -> None:
+        report: Dict[str, Any] = self.report()
+        if report["fraction"] is None:
+            logger.info(
+                "Progress: %s lines done, %s lines/s",
+                report["lines_done"],
+                round(report["recent_lines_per_s"], 1)
+            )
+        else:
+            logger.info(
+                "Progress: %s of %s lines done (%s%%), %s lines/s, %s left",
+                report["lines_done"],
+                report["lines_total"],
+                round(report["fraction"] * 100, 1),
+                round(report["recent_lines_per_s"], 1),
+                format_duration(report["eta_s"])
+            )
+        workers: List[Dict[str, Any]] = report["workers"]
+        if len(workers) > 1:
+            busy: List[Dict[str, Any]] = [
+                w for w in workers if w["busy_s"] > 0
+            ]
+            logger.info(
+                "Workers: %s busy, %s idle; %s to %s lines/s each",
+                sum(w["on_chunk_s"] is not None for w in workers),
+                sum(w["on_chunk_s"] is None for w in workers),
+                round(min([w["lines_per_s"] for w in busy] or [0]), 1),
+                round(max([w["lines_per_s"] for w in busy] or [0]), 1)
+            )
+        for w in workers:
+            logger.debug(
+                "Worker %s: %s lines in %s chunks, %s lines/s, %s",
+                w["pid"],
+                w["lines"],
+                w["chunks"],
+                round(w["lines_per_s"], 1),
+                "idle" if w["on_chunk_s"] is None else
+                "on a chunk for " + format_duration(w["on_chunk_s"])
+            )
+            if w["stalled"]:
+                logger.warning(
+                    "Worker %s has been on one chunk for %s",
+                    w["pid"],
+                    format_duration(w["on_chunk_s"])
+                )
+        if path is not None:
+            self.__save__(report, path)
+
+    def __save__(self, report: Dict[str, Any], path: str) -> None:
+        write_atomically(path, json.dumps(report, indent=2))
+
+
+# the progress of this process's run, shared by everything in it
+PROGRESS = Progress()
+
+
+def format_duration(seconds: Optional[float]) -> str:
+    if seconds is None or not math.isfinite(seconds):
+        return "unknown"
+    seconds = int(seconds)
+    return "%d:%02d:%02d" % (seconds // 3600, seconds // 60 % 60, seconds % 60)
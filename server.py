@@ -0,0 +1,349 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Serve elevation lookups for batches of paths, keeping data sources loaded
+
+import http.server
+import logging
+import os
+import socketserver
+import sys
+import threading
+import time
+
+import click
+import numpy as np
+from shapely.geometry import box  # type: ignore
+from typing import List, Optional, Tuple
+
+from data import DataSourceError, SourceRouter
+from files import format_elevations, parse_coords
+from metrics import METRICS
+
+__author__ = "Eldan Goldenberg for A/B Street, February-March 2021"
+__license__ = "Apache"
+
+
+@click.command()
+@click.option(
+    '--data_dir',
+    default='data',
+    help='Specify a data directory or leave out for default value: "data"'
+)
+@click.option(
+    '--data_source_list',
+    default='datasources.json',
+    help=('Path to a JSON file enumerating available data sources, '
+            'or leave out for default value: "datasources.json"')
+)
+@click.option(
+    '--n_threads',
+    default=os.cpu_count(),
+    help=('Number of processes to execute in parallel, '
+            'or leave out for default value of 1 process per CPU core')  # noqa: E127, E501
+)
+@click.option(
+    '--log',
+    type=click.Choice(
+        ['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL']
+    ),
+    default='INFO',
+    help=('Logging level.  '
+            'Only messages of the selected severity or higher will be emitted.'
+            'Default: INFO')
+)
+@click.option(
+    '--bbox',
+    required=True,
+    help=('Area to serve lookups for, as "W,S,E,N" in decimal degrees.  '
+            'Data sources are kept loaded for this area, and points outside '  # noqa: E127, E501
+            'it get no elevation data')
+)
+@click.option(
+    '--host',
+    default='127.0.0.1',
+    help='Address to listen on, or leave out for default value: 127.0.0.1'
+)
+@click.option(
+    '--port',
+    default=8080,
+    help='Port to listen on, or leave out for default value: 8080'
+)
+@click.option(
+    '--socket',
+    default=None,
+    help=('Path of a Unix socket to listen on, '
+            'instead of listening on --host and --port')  # noqa: E127, E501
+)
+@click.option(
+    '--block_cache_mb',
+    default=0,
+    help=('If set, raster data is read only in the blocks that contain '
+            'input points, keeping up to this many MB of them cached, '  # noqa: E127, E501
+            'instead of loading the whole area at once')
+)
+@click.option(
+    '--crop_cache_mb',
+    default=0,
+    help=('If set, rasters merged from multiple tiles are kept in the data '
+            'directory for reuse by later runs, up to this many MB of them')  # noqa: E127, E501
+)
+@click.option(
+    '--contour_max_distance',
+    default=None,
+    type=float,
+    help=('For contour data sources, points further than this many degrees '
+            'from any contour are treated as having no elevation data')  # noqa: E127, E501
+)
+@click.option(
+    '--contour_index/--no_contour_index',
+    default=True,
+    help=('Whether to preprocess contour data sources into an index in the '
+            'data directory, which makes later runs start much faster.  '  # noqa: E127, E501
+            'Default: on')
+)
+def serve(
+    data_dir: str,
+    data_source_list: str,
+    n_threads: int,
+    log: str,
+    bbox: str,
+    host: str,
+    port: int,
+    socket: Optional[str],
+    block_cache_mb: int,
+    crop_cache_mb: int,
+    contour_max_distance: Optional[float],
+    contour_index: bool
+) -> None:
+    logging.basicConfig(
+        format='%(asctime)s %(levelname)s:\t%(message)s',
+        datefmt='%Y%m%d %H:%M'
+    )
+    logger = logging.getLogger(__name__)
+    logger.setLevel(level=log)
+    try:
+        area: box = box(*[float(x) for x in bbox.split(",")])
+    except (TypeError, ValueError):
+        logger.critical('Could not parse "%s" as W,S,E,N', bbox)
+        sys.exit(1)
+    try:
+        lookup = Lookup(
+            __name__,
+            data_dir,
+            data_source_list,
+            area,
+            n_threads,
+            block_cache_mb=block_cache_mb,
+            crop_cache_mb=crop_cache_mb,
+            contour_max_distance=contour_max_distance,
+            contour_index=contour_index
+        )
+    except DataSourceError as e:
+        logger.critical(e)
+        sys.exit(1)
+    server: socketserver.BaseServer
+    if socket is None:
+        server = LookupHTTPServer((host, port), LookupRequestHandler)
+        logger.info("Serving lookups at http://%s:%s/tag", host, port)
+    else:
+        if os.path.exists(socket):
+            os.remove(socket)
+        server = LookupUnixServer(socket, LookupRequestHandler)
+        logger.info("Serving lookups on %s", socket)
+    server.lookup = lookup  # type: ignore
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        logger.info("Shutting down")
+    finally:
+        server.server_close()
+        lookup.close()
+        if socket is not None and os.path.exists(socket):
+            os.remove(socket)
+    sys.exit(0)
+
+
+
+
+class Lookup:
+    # Keeps a SourceRouter, and with it all the data sources it has loaded,
+    # ready to tag batches from any number of concurrent requests.  If the
+    # data source list changes, the router is replaced by a fresh one.
+
+    def __init__(
+        self,
+        logger_name: str,
+        data_dir: str,
+        data_source_list: str,
+        bbox: box,
+        n_threads: int,
+        block_cache_mb: int = 0,
+        crop_cache_mb: int = 0,
+        contour_max_distance: Optional[float] = None,
+        contour_index: bool = True
+    ) -> None:
+        self.logger = logging.getLogger(logger_name)
+        self.logger_name: str = logger_name
+        self.data_dir: str = data_dir
+        self.sources_file: str = data_source_list
+        self.bbox: box = bbox
+        self.n_threads: int = n_threads
+        self.block_cache_mb: int = block_cache_mb
+        self.crop_cache_mb: int = crop_cache_mb
+        self.contour_max_distance: Optional[float] = contour_max_distance
+        self.contour_index: bool = contour_index
+        # held while routing and submitting a batch, so that each source is
+        # only loaded once, and while replacing the router.  Waiting for the
+        # results happens outside it, so batches are processed concurrently.
+        self.lock = threading.Lock()
+        self.router: SourceRouter = self.__load__()
+
+
+    def __load__(self) -> SourceRouter:
+        # The data source list's mtime is only recorded once loading from it
+        # has worked, so that if it fails, the next request tries again
+        sources_mtime: float = os.stat(self.sources_file).st_mtime
+        start_time: float = time.time()
+        router = SourceRouter(
+            self.logger_name,
+            self.data_dir,
+            self.sources_file,
+            self.bbox,
+            block_cache_mb=self.block_cache_mb,
+            crop_cache_mb=self.crop_cache_mb,
+            contour_max_distance=self.contour_max_distance,
+            contour_index=self.contour_index
+        )
+        try:
+            # load every source that covers any of the area now, rather
+            # than making the first request to need each one wait for it
+            router.warm(self.n_threads)
+        except BaseException:
+            # free whatever was loaded before it failed
+            router.close()
+            raise
+        self.sources_mtime: float = sources_mtime
+        self.logger.info(
+            "Data sources loaded in %s seconds",
+            round(time.time() - start_time, 1)
+        )
+        return router
+
+
+    def tag(self, coords: np.ndarray, offsets: np.ndarray) -> np.ndarray:
+        # as for SourceRouter.tag_paths
+        if len(offsets) == 1:
+            return np.empty((0, 4), dtype=np.float64)
+        with self.lock:
+            if os.stat(self.sources_file).st_mtime != self.sources_mtime:
+                self.logger.info(
+                    "%s has changed, so reloading data sources",
+                    self.sources_file
+                )
+                old: SourceRouter = self.router
+                self.router = self.__load__()
+                # this waits for anything already submitted to it to finish
+                old.close()
+            pending = self.router.submit((0, coords, offsets), self.n_threads)
+        return pending.get()
+
+
+    def close(self) -> None:
+        self.router.close()
+
+
+
+
+class LookupRequestHandler(http.server.BaseHTTPRequestHandler):
+    # POST /tag with paths in the same format as an input file, one per
+    # line, to get back their stats in the same format as an output file.
+    # GET /metrics for timings and counters of all the lookups so far, in
+    # Prometheus' text format.
+
+    def do_GET(self) -> None:
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        body: bytes = METRICS.prometheus().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self) -> None:
+        if self.path != "/tag":
+            self.send_error(404)
+            return
+        length: int = int(self.headers.get("Content-Length", 0))
+        rows: List[str] = [
+            row for row in self.rfile.read(length).decode("utf-8").split("\n")
+            if row.strip() != ''
+        ]
+        try:
+            coords, offsets = parse_rows(rows)
+        except (IndexError, ValueError):
+            self.send_error(400, "Could not parse paths")
+            return
+        lookup: Lookup = self.server.lookup  # type: ignore
+        try:
+            results: np.ndarray = lookup.tag(coords, offsets)
+        except DataSourceError as e:
+            self.send_error(500, str(e))
+            return
+        except Exception:
+            # rather than dropping the connection without a response
+            lookup.logger.exception("Failed to tag %s paths", len(rows))
+            self.send_error(500)
+            return
+        body: bytes = format_elevations(results).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/tab-separated-values")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self) -> str:
+        # Unix socket clients don't have an address
+        if isinstance(self.client_address, tuple):
+            return str(self.client_address[0])
+        return "local"
+
+    def log_message(self, format: str, *args) -> None:
+        logging.getLogger(__name__).debug(
+            "%s %s", self.address_string(), format % args
+        )
+
+
+
+
+class LookupHTTPServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+
+
+
+class LookupUnixServer(
+    socketserver.ThreadingMixIn,
+    socketserver.UnixStreamServer
+):
+    daemon_threads = True
+
+
+def parse_rows(rows: List[str]) -> Tuple[np.ndarray, np.ndarray]:
+    # returns paths given as rows of an input file as an (n, 2) array of
+    # their vertices, and an array of the offsets to the start of each
+    coords: List[Tuple[float, float]] = []
+    counts: List[int] = [0]
+    for row in rows:
+        line: List[Tuple[float, float]] = parse_coords(row)
+        coords.extend(line)
+        counts.append(len(line))
+    return (
+        np.array(coords, dtype=np.float64).reshape(-1, 2),
+        np.cumsum(counts)
+    )
+
+
+if __name__ == "__main__":
+    serve()
@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+# shared fixtures for the tests, which are run with: python3 -m pytest
+
+import gzip
+import http.server
+import json
+import os
+import sys
+import threading
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import fiona  # type: ignore
+import numpy as np
+import pytest
+import rasterio  # type: ignore
+from rasterio.transform import from_origin  # type: ignore
+
+# the modules under test live in the top level of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+ETAG: str = '"v1"'
+
+
+def write_dem(
+    path: str,
+    west: float,
+    north: float,
+    pixel_size: float,
+    values: np.ndarray,
+    nodata: float = -32768
+) -> None:
+    # saves values as a single band GeoTIFF in EPSG:4326
+    with rasterio.open(
+        path,
+        'w',
+        driver="GTiff",
+        width=values.shape[1],
+        height=values.shape[0],
+        count=1,
+        dtype=values.dtype,
+        crs="EPSG:4326",
+        transform=from_origin(west, north, pixel_size, pixel_size),
+        nodata=nodata
+    ) as dst:
+        dst.write(values, 1)
+
+
+def write_contours(
+    path: str,
+    driver: str,
+    lines: List[List[Tuple[float, float]]],
+    properties: List[Dict]
+) -> None:
+    # saves lines, each with its properties, as a vector file in EPSG:4326
+    with fiona.open(
+        path,
+        'w',
+        driver=driver,
+        crs="EPSG:4326",
+        schema={
+            "geometry": "LineString",
+            "properties": {
+                name: "float" if isinstance(value, float) else
+                "int" if isinstance(value, int) else "str"
+                for name, value in properties[0].items()
+            }
+        }
+    ) as dst:
+        for line, props in zip(lines, properties):
+            dst.write({
+                "geometry": {"type": "LineString", "coordinates": line},
+                "properties": props
+            })
+
+
+def write_sources(path: str, sources: List[Dict]) -> None:
+    with open(path, 'w') as f:
+        json.dump({"sources": sources}, f)
+
+
+def raster_source(
+    filename: str,
+    bbox: Tuple[float, float, float, float]
+) -> Dict:
+    # a local raster data source entry, as in datasources.json
+    return {
+        "name": filename,
+        "url": None,
+        "filename": filename,
+        "crs": "EPSG:4326",
+        "bbox": list(bbox),
+        "download_method": "local",
+        "lookup_method": "raster",
+        "lookup_field": 1,
+        "units": "meters",
+        "recheck_interval_days": None
+    }
+
+
+def contour_source(
+    filename: str,
+    bbox: Tuple[float, float, float, float],
+    lookup_field: str
+) -> Dict:
+    # a local contour lines data source entry, as in datasources.json
+    return dict(
+        raster_source(filename, bbox),
+        lookup_method="contour_lines",
+        lookup_field=lookup_field
+    )
+
+
+
+
+class FileHandler(http.server.BaseHTTPRequestHandler):
+    # Serves content as one file, or each of files at its path, with ETag
+    # and Range support.  The server's settings say whether to refuse HEAD,
+    # leave the size out of HEAD responses, or gzip everything whatever the
+    # client asks for.
+
+    def do_HEAD(self) -> None:
+        self.__respond__(send_body=False)
+
+    def do_GET(self) -> None:
+        self.__respond__(send_body=True)
+
+    def __respond__(self, send_body: bool) -> None:
+        server = self.server
+        server.requests.append((self.command, dict(self.headers)))  # type: ignore  # noqa: E501
+        if self.command == "HEAD" and server.head_status != 200:  # type: ignore  # noqa: E501
+            self.send_response(server.head_status)  # type: ignore
+            self.end_headers()
+            return
+        if len(server.files) > 0 and self.path not in server.files:  # type: ignore  # noqa: E501
+            self.send_response(404)
+            self.end_headers()
+            return
+        body: bytes = server.files.get(self.path, server.content)  # type: ignore  # noqa: E501
+        status: int = 200
+        headers: Dict[str, str] = {"ETag": ETAG}
+        byte_range: Optional[str] = self.headers.get("Range")
+        if server.gzip:  # type: ignore
+            # ranges are then of the compressed body
+            body = gzip.compress(body)
+            headers["Content-Encoding"] = "gzip"
+        if byte_range is not None and \
+                self.headers.get("If-Range") in [None, ETAG]:
+            start: int = int(byte_range[len("bytes="):-1])
+            if start >= len(body):
+                self.send_response(416)
+                self.send_header("Content-Range", "bytes */" + str(len(body)))
+                self.end_headers()
+                return
+            status = 206
+            headers["Content-Range"] = "bytes %s-%s/%s" % (
+                start, len(body) - 1, len(body)
+            )
+            body = body[start:]
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        if send_body or server.head_length:  # type: ignore
+            self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if send_body:
+            self.wfile.write(body)
+
+    def log_message(self, format: str, *args) -> None:
+        pass
+
+
+
+
+@pytest.fixture
+def dem_dir(tmp_path) -> str:
+    # A data directory holding a 0.001° DEM of the area (0, 50, 1, 52), in
+    # which every pixel has a different value, and a data source list for
+    # it, at dem_dir/datasources.json
+    rows, cols = np.mgrid[0:2000, 0:1000]
+    write_dem(
+        os.path.join(tmp_path, "dem.tif"),
+        0,
+        52,
+        0.001,
+        (rows * 0.01 + cols * 0.1).astype(np.float32)
+    )
+    write_sources(
+        os.path.join(tmp_path, "datasources.json"),
+        [raster_source("dem.tif", (0, 50, 1, 52))]
+    )
+    return str(tmp_path)
+
+
+@pytest.fixture
+def server() -> Iterator[http.server.HTTPServer]:
+    # a local HTTP server, serving a FileHandler's files
+    httpd = http.server.ThreadingHTTPServer(("127.0.0.1", 0), FileHandler)
+    httpd.requests = []  # type: ignore
+    httpd.content = b""  # type: ignore
+    httpd.files = {}  # type: ignore
+    httpd.head_status = 200  # type: ignore
+    httpd.head_length = True  # type: ignore
+    httpd.gzip = False  # type: ignore
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
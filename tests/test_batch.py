@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+# --batch runs, tagging many input files with one set of data sources
+
+import os
+from typing import List
+
+import numpy as np
+from click.testing import CliRunner
+
+from conftest import raster_source, write_dem, write_sources
+from main import main
+
+# paths in the area of dem.tif, and of a second source far from it
+NEAR: List[str] = [
+    "0.1,51.0 0.2,51.1 0.15,51.2",
+    "0.3,50.5",
+    "0.5,51.5 0.5,51.6"
+]
+FAR: List[str] = ["5.5,50.5 5.6,50.6", "5.1,50.1"]
+
+
+
+
+def run(dem_dir: str, output_dir: str, *args: str) -> int:
+    os.makedirs(os.path.join(dem_dir, output_dir), exist_ok=True)
+    result = CliRunner().invoke(main, [
+        "--input_dir", os.path.join(dem_dir, "input"),
+        "--data_dir", dem_dir,
+        "--output_dir", os.path.join(dem_dir, output_dir),
+        "--data_source_list", os.path.join(dem_dir, "datasources.json"),
+        "--n_threads", "1",
+        "--batch_size", "2"
+    ] + list(args))
+    return result.exit_code
+
+
+def read(path: str) -> str:
+    with open(path) as f:
+        return f.read()
+
+
+def test_batch_matches_single_files(dem_dir):
+    rows, cols = np.mgrid[0:1000, 0:1000]
+    write_dem(
+        os.path.join(dem_dir, "far.tif"),
+        5,
+        51,
+        0.001,
+        (rows + cols).astype(np.float32)
+    )
+    write_sources(os.path.join(dem_dir, "datasources.json"), [
+        raster_source("dem.tif", (0, 50, 1, 52)),
+        raster_source("far.tif", (5, 50, 6, 51))
+    ])
+    inputs = {
+        "a.txt": NEAR,
+        "b.txt": NEAR[1:] + FAR,
+        "c.txt": FAR,
+        # unreadable part way through, after a batch that could be tagged
+        "bad.txt": NEAR + ["0.1,51.0 not-a-point"]
+    }
+    os.mkdir(os.path.join(dem_dir, "input"))
+    for name, rows_in in inputs.items():
+        with open(os.path.join(dem_dir, "input", name), 'w') as f:
+            f.write("\n".join(rows_in) + "\n")
+    with open(os.path.join(dem_dir, "input", "broken.npz"), 'wb') as f:
+        f.write(b"not a zip file")
+    # the unreadable files are reported, after tagging the rest
+    assert run(dem_dir, "batch", "--batch", "*") == 1
+    assert sorted(os.listdir(os.path.join(dem_dir, "batch"))) == \
+        ["a.txt", "b.txt", "c.txt"]
+    # batches are always streamed, so are compared with streamed single runs
+    for name in ["a.txt", "b.txt", "c.txt"]:
+        assert run(dem_dir, "single", "--stream", name) == 0
+        assert read(os.path.join(dem_dir, "batch", name)) == \
+            read(os.path.join(dem_dir, "single", name))
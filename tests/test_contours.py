@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+# contour line sources, in the vector formats that they're published in
+
+import os
+from typing import List, Tuple
+
+import numpy as np
+import pytest
+from shapely.geometry import LineString, Point  # type: ignore
+
+from api import ElevationLookup
+from conftest import contour_source, write_contours, write_sources
+
+
+# contours every 10m, running north-south, 0.01° apart
+LINES = [[(x, 50.0), (x, 51.0)] for x in [0.1, 0.11, 0.12]]
+ELEVATIONS = [100.0, 110.0, 120.0]
+
+# paths with vertices on a contour, between two of them, and repeated, both
+# within a path and between paths
+PATHS: List[List[Tuple[float, float]]] = [
+    [(0.1, 50.5), (0.11, 50.5), (0.12, 50.5)],
+    [(0.103, 50.2), (0.107, 50.3), (0.114, 50.4), (0.118, 50.5)],
+    [(0.11, 50.5), (0.11, 50.5)],
+    [(0.118, 50.5), (0.107, 50.3), (0.118, 50.5), (0.107, 50.3)],
+    [(0.107, 50.3)],
+    [(0.125, 50.7), (0.2, 50.7), (0.095, 50.6)]
+]
+
+
+
+
+@pytest.fixture(params=[("GeoJSON", ".geojson"), ("GPKG", ".gpkg")])
+def contour_dir(tmp_path, request) -> str:
+    # contours with other properties besides their elevation, as published
+    # ones have, and a data source list for them
+    driver, extension = request.param
+    write_contours(
+        os.path.join(tmp_path, "contours" + extension),
+        driver,
+        LINES,
+        [
+            {"OBJECTID": i, "CL93_ELEV": elevation, "TYPE": "index"}
+            for i, elevation in enumerate(ELEVATIONS)
+        ]
+    )
+    write_sources(
+        os.path.join(tmp_path, "datasources.json"),
+        [contour_source(
+            "contours" + extension, (0, 50, 1, 51), "CL93_ELEV"
+        )]
+    )
+    return str(tmp_path)
+
+
+@pytest.mark.parametrize("contour_index", [True, False])
+def test_loads_contours_with_other_properties(contour_dir, contour_index):
+    with ElevationLookup(
+        os.path.join(contour_dir, "datasources.json"),
+        bbox=(0, 50, 1, 51),
+        data_dir=contour_dir,
+        contour_index=contour_index
+    ) as lookup:
+        np.testing.assert_allclose(
+            lookup.sample_points(np.array([[0.1, 50.5], [0.119, 50.5]])),
+            [100, 120]
+        )
+
+
+def nearest_elevation(point: Tuple[float, float]) -> float:
+    # the elevation of the nearest contour, found the slow way
+    distances: List[float] = [
+        LineString(line).distance(Point(point)) for line in LINES
+    ]
+    return ELEVATIONS[int(np.argmin(distances))]
+
+
+def stats(path: List[Tuple[float, float]]) -> List[float]:
+    # [start, end, climb, descent], looked up a vertex at a time, as they
+    # were before contours were looked up in bulk
+    start: float = nearest_elevation(path[0])
+    climb: float = 0
+    descent: float = 0
+    previous: float = start
+    for point in path[1:]:
+        elevation: float = nearest_elevation(point)
+        climb += max(elevation - previous, 0)
+        descent += max(previous - elevation, 0)
+        previous = elevation
+    return [start, previous, climb, descent]
+
+
+@pytest.mark.parametrize("contour_index", [True, False])
+def test_matches_point_by_point_lookup(contour_dir, contour_index):
+    with ElevationLookup(
+        os.path.join(contour_dir, "datasources.json"),
+        bbox=(0, 50, 1, 51),
+        data_dir=contour_dir,
+        contour_index=contour_index
+    ) as lookup:
+        np.testing.assert_allclose(
+            lookup.tag_paths(
+                np.array([point for path in PATHS for point in path]),
+                np.cumsum([0] + [len(path) for path in PATHS])
+            ),
+            [stats(path) for path in PATHS]
+        )
@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+# entries in the crop cache that are in use are never evicted
+
+import os
+from typing import Dict
+
+import numpy as np
+from rasterio.transform import from_origin  # type: ignore
+
+from cache import CropCache
+
+
+
+
+def store(cache: CropCache, source: str, west: float) -> str:
+    # caches a 1° crop of source from west
+    values: np.ndarray = np.zeros((10, 10), dtype=np.float32)
+    profile: Dict = {
+        "driver": "GTiff",
+        "width": 10,
+        "height": 10,
+        "count": 1,
+        "dtype": "float32",
+        "crs": "EPSG:4326",
+        "transform": from_origin(west, 51, 0.1, 0.1)
+    }
+    return cache.store([source], 1, (west, 50, west + 1, 51), values, profile)
+
+
+def test_entries_in_use_are_not_evicted(tmp_path):
+    source: str = os.path.join(tmp_path, "source.tif")
+    open(source, 'w').close()
+    cache_dir: str = os.path.join(tmp_path, "cache")
+    # with no room at all, every entry not in use is evicted straight away
+    first = CropCache(__name__, cache_dir, 0)
+    stored: str = store(first, source, 0)
+    second = CropCache(__name__, cache_dir, 0)
+    store(second, source, 1)
+    assert os.path.exists(stored)
+    first.release()
+    store(second, source, 2)
+    assert not os.path.exists(stored)
+    assert not os.path.exists(stored[:-len(".tif")] + ".lock")
+    # and the same for an entry that's been found rather than stored
+    third = CropCache(__name__, cache_dir, 0)
+    found = third.find([source], 1, (1.5, 50.5, 1.6, 50.6))
+    assert found is not None
+    second.release()
+    store(CropCache(__name__, cache_dir, 0), source, 3)
+    assert os.path.exists(found)
+    third.release()
@@ -0,0 +1,253 @@
+# -*- coding: utf-8 -*-
+# downloads of http and ftp sources, from local stand-ins for the servers
+
+import ftplib
+import http.server
+import json
+import os
+from typing import Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+import pytest
+from shapely.geometry import box  # type: ignore
+
+import data
+from conftest import ETAG, raster_source, write_dem, write_sources
+from data import DataSource, DataSourceError
+
+
+
+
+class FakeFTP:
+    # Stands in for ftplib.FTP, serving content as the one file.  It can be
+    # set to drop the connection part way through the next download, or to
+    # refuse REST as servers that can't resume do.  The offset that each
+    # download was started from is recorded in retrieved.
+    content: bytes = b""
+    fail_after: Optional[int] = None
+    refuse_rest: bool = False
+    retrieved: List[Optional[int]] = []
+
+    def __init__(self, timeout: Optional[float] = None) -> None:
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        pass
+
+    def connect(self, host: str, port: int) -> None:
+        pass
+
+    def login(self, user: str, password: str) -> None:
+        pass
+
+    def voidcmd(self, cmd: str) -> str:
+        if cmd.startswith("MDTM "):
+            return "213 20200101000000"
+        return "200 OK"
+
+    def size(self, path: str) -> int:
+        return len(self.content)
+
+    def retrbinary(
+        self,
+        cmd: str,
+        callback: Callable[[bytes], None],
+        blocksize: int = 8192,
+        rest: Optional[int] = None
+    ) -> str:
+        self.retrieved.append(rest)
+        if rest is not None and self.refuse_rest:
+            raise ftplib.error_perm("502 REST not implemented")
+        body: bytes = self.content[rest or 0:]
+        if self.fail_after is not None:
+            callback(body[:self.fail_after])
+            type(self).fail_after = None
+            raise EOFError()
+        callback(body)
+        return "226 Transfer complete"
+
+
+
+
+@pytest.fixture
+def ftp(monkeypatch) -> type:
+    # a FakeFTP of its own for each test
+    fake: type = type("FakeFTP", (FakeFTP,), {"retrieved": []})
+    monkeypatch.setattr(data.ftplib, "FTP", fake)
+    return fake
+
+
+def remote_source(tmp_path: str, url: str, method: str) -> Tuple[str, str]:
+    # a data source list for a remote file, and the path it's saved to
+    entry: Dict = raster_source("dem.tif", (0, 50, 1, 52))
+    entry["url"] = url
+    entry["download_method"] = method
+    # always check for a newer version
+    entry["recheck_interval_days"] = 0
+    os.mkdir(os.path.join(tmp_path, "data"))
+    sources_path: str = os.path.join(tmp_path, "datasources.json")
+    write_sources(sources_path, [entry])
+    return sources_path, os.path.join(tmp_path, "data", "dem.tif")
+
+
+def dem_content(tmp_path: str) -> bytes:
+    # the file to serve
+    remote_path: str = os.path.join(tmp_path, "remote.tif")
+    write_dem(
+        remote_path,
+        0,
+        52,
+        0.01,
+        np.arange(200 * 100, dtype=np.float32).reshape(200, 100)
+    )
+    with open(remote_path, 'rb') as f:
+        return f.read()
+
+
+@pytest.fixture
+def source(tmp_path, server) -> Tuple[str, str, bytes]:
+    # a data source list for the server's file, the path it's saved to,
+    # and its contents
+    server.content = dem_content(tmp_path)
+    sources_path, path = remote_source(
+        tmp_path,
+        "http://127.0.0.1:%s/dem.tif" % server.server_address[1],
+        "http"
+    )
+    return sources_path, path, server.content
+
+
+@pytest.fixture
+def ftp_source(tmp_path, ftp) -> Tuple[str, str, bytes]:
+    # as for source, from FakeFTP
+    ftp.content = dem_content(tmp_path)
+    sources_path, path = remote_source(
+        tmp_path, "ftp://127.0.0.1/dem.tif", "ftp"
+    )
+    return sources_path, path, ftp.content
+
+
+def load(sources_path: str) -> None:
+    DataSource(
+        __name__,
+        os.path.join(os.path.dirname(sources_path), "data"),
+        sources_path,
+        box(0.1, 51, 0.2, 51.1)
+    ).close()
+
+
+def gets(server: http.server.HTTPServer) -> List[Dict[str, str]]:
+    return [
+        headers for method, headers in server.requests  # type: ignore
+        if method == "GET"
+    ]
+
+
+def saved(path: str) -> bytes:
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def write_part(path: str, content: bytes, size: Optional[int]) -> None:
+    # as left by an interrupted download of the server's file
+    with open(path + ".part", 'wb') as f:
+        f.write(content)
+    with open(path + ".part.json", 'w') as f:
+        json.dump({
+            "etag": ETAG,
+            "last_modified": None,
+            "size": None if size is None else str(size)
+        }, f)
+
+
+def test_unchanged_file_is_not_downloaded_again(server, source):
+    sources_path, path, content = source
+    load(sources_path)
+    assert saved(path) == content
+    assert len(gets(server)) == 1
+    mtime: int = os.stat(path).st_mtime_ns
+    load(sources_path)
+    assert len(gets(server)) == 1
+    assert not os.path.exists(path + ".part")
+    # the recheck is recorded without touching the file, whose mtime the
+    # caches built from it depend on
+    assert os.stat(path).st_mtime_ns == mtime
+    with open(path + ".download.json") as f:
+        assert "checked" in json.load(f)
+
+
+def test_interrupted_download_is_resumed(server, source):
+    sources_path, path, content = source
+    write_part(path, content[:1000], len(content))
+    load(sources_path)
+    assert saved(path) == content
+    assert gets(server)[0]["Range"] == "bytes=1000-"
+    assert gets(server)[0]["If-Range"] == ETAG
+
+
+def test_complete_part_file_is_renamed(server, source):
+    sources_path, path, content = source
+    # without a size to compare with, finding that it's complete takes a
+    # range request that the server answers with 416
+    server.head_length = False
+    write_part(path, content, None)
+    load(sources_path)
+    assert saved(path) == content
+    assert not os.path.exists(path + ".part")
+
+
+def test_gzipped_download(server, source):
+    sources_path, path, content = source
+    server.gzip = True
+    load(sources_path)
+    assert saved(path) == content
+    assert gets(server)[0]["Accept-Encoding"] == "identity"
+
+
+def test_gzipped_download_is_not_resumed(server, source):
+    sources_path, path, content = source
+    server.gzip = True
+    write_part(path, content[:1000], None)
+    load(sources_path)
+    assert saved(path) == content
+    # the range sent back is of the compressed file, so it's fetched again
+    assert [headers.get("Range") for headers in gets(server)] == \
+        ["bytes=1000-", None]
+
+
+def test_server_without_head(server, source):
+    sources_path, path, content = source
+    server.head_status = 405
+    load(sources_path)
+    assert saved(path) == content
+    # with nothing to compare, each recheck downloads it again
+    load(sources_path)
+    assert len(gets(server)) == 2
+    assert saved(path) == content
+
+
+def test_interrupted_ftp_download_is_resumed(ftp, ftp_source):
+    sources_path, path, content = ftp_source
+    ftp.fail_after = 1000
+    with pytest.raises(DataSourceError):
+        load(sources_path)
+    assert saved(path + ".part") == content[:1000]
+    load(sources_path)
+    assert saved(path) == content
+    assert ftp.retrieved == [None, 1000]
+
+
+def test_ftp_server_that_cant_resume(ftp, ftp_source):
+    sources_path, path, content = ftp_source
+    ftp.fail_after = 1000
+    ftp.refuse_rest = True
+    with pytest.raises(DataSourceError):
+        load(sources_path)
+    load(sources_path)
+    assert saved(path) == content
+    assert ftp.retrieved == [None, 1000, None]
+    assert not os.path.exists(path + ".part")
+    assert not os.path.exists(path + ".part.json")
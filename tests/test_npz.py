@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+# paths read from and results written to .npz files, which should give the
+# same results as the text files they stand in for
+
+import os
+from typing import List
+
+import numpy as np
+import pytest
+from click.testing import CliRunner
+
+from conftest import write_dem
+from files import load_paths
+from main import main
+
+# paths in the area of dem.tif, the last of them on a pixel with no data
+PATHS: List[List[List[float]]] = [
+    [[0.1, 51.0], [0.2, 51.1], [0.15, 51.2]],
+    [[0.3, 50.5], [0.3, 50.5]],
+    [[0.5, 51.6], [0.5, 51.7]],
+    [[0.5005, 51.4995], [0.5005, 51.4995]]
+]
+SAVERS = [np.savez, np.savez_compressed]
+
+
+
+
+@pytest.fixture
+def data_dir(dem_dir) -> str:
+    # dem_dir, with no data at (0.5005, 51.4995)
+    rows, cols = np.mgrid[0:2000, 0:1000]
+    values: np.ndarray = (rows * 0.01 + cols * 0.1).astype(np.float32)
+    values[500, 500] = -32768
+    write_dem(os.path.join(dem_dir, "dem.tif"), 0, 52, 0.001, values)
+    return dem_dir
+
+
+def write_inputs(dem_dir: str, paths: List[List[List[float]]], save) -> None:
+    # saves paths as both input/paths.txt and input/paths.npz
+    os.makedirs(os.path.join(dem_dir, "input"), exist_ok=True)
+    with open(os.path.join(dem_dir, "input", "paths.txt"), 'w') as f:
+        for path in paths:
+            f.write(" ".join("%s,%s" % (x, y) for x, y in path) + "\n")
+    save(
+        os.path.join(dem_dir, "input", "paths.npz"),
+        coords=np.array(
+            [point for path in paths for point in path]
+        ).reshape(-1, 2),
+        offsets=np.cumsum([0] + [len(path) for path in paths])
+    )
+
+
+def run(dem_dir: str, output_dir: str, *args: str) -> None:
+    os.makedirs(os.path.join(dem_dir, output_dir), exist_ok=True)
+    result = CliRunner().invoke(main, [
+        "--input_dir", os.path.join(dem_dir, "input"),
+        "--data_dir", dem_dir,
+        "--output_dir", os.path.join(dem_dir, output_dir),
+        "--data_source_list", os.path.join(dem_dir, "datasources.json"),
+        "--n_threads", "1",
+        "--batch_size", "2"
+    ] + list(args))
+    assert result.exit_code == 0
+
+
+def read_text(path: str) -> np.ndarray:
+    # reads output text back as results, with NaN for rows left blank
+    with open(path) as f:
+        return np.array([
+            [float(x) for x in row.split("\t")] if row.strip() != ""
+            else [np.nan] * 4
+            for row in f
+        ]).reshape(-1, 4)
+
+
+def read_npz(path: str) -> np.ndarray:
+    with np.load(path) as npz:
+        return npz["results"]
+
+
+@pytest.mark.parametrize("save", SAVERS)
+def test_loads_paths(data_dir, save):
+    write_inputs(data_dir, PATHS, save)
+    coords, offsets = load_paths(os.path.join(data_dir, "input", "paths.npz"))
+    # compressed arrays can't be mapped, so are read into memory instead
+    assert isinstance(coords, np.memmap) == (save is np.savez)
+    np.testing.assert_array_equal(
+        coords, [point for path in PATHS for point in path]
+    )
+    np.testing.assert_array_equal(offsets, [0, 3, 5, 7, 9])
+    assert offsets.dtype == np.int64
+
+
+@pytest.mark.parametrize("save", SAVERS)
+@pytest.mark.parametrize("stream", [[], ["--stream"]])
+def test_npz_in_text_out(data_dir, save, stream):
+    write_inputs(data_dir, PATHS, save)
+    run(data_dir, "from_text", *stream, "paths.txt")
+    run(data_dir, "from_npz", *stream, "paths.npz")
+    with open(os.path.join(data_dir, "from_text", "paths.txt")) as f:
+        expected: str = f.read()
+    with open(os.path.join(data_dir, "from_npz", "paths.txt")) as f:
+        assert f.read() == expected
+    # with a blank row for the path with no data
+    assert expected.endswith("\n\n")
+
+
+@pytest.mark.parametrize("stream", [[], ["--stream"]])
+def test_text_in_npz_out(data_dir, stream):
+    write_inputs(data_dir, PATHS, np.savez)
+    run(data_dir, "text", *stream, "paths.txt")
+    run(data_dir, "npz", "--output_format", "npz", *stream, "paths.txt")
+    run(data_dir, "both", "--output_format", "npz", *stream, "paths.npz")
+    results: np.ndarray = read_npz(os.path.join(data_dir, "npz", "paths.npz"))
+    assert results.dtype == np.float64
+    assert results.shape == (len(PATHS), 4)
+    # the same as the text output, which is rounded to mm
+    np.testing.assert_allclose(
+        results,
+        read_text(os.path.join(data_dir, "text", "paths.txt")),
+        atol=0.0005
+    )
+    assert np.isnan(results[-1]).all()
+    np.testing.assert_array_equal(
+        read_npz(os.path.join(data_dir, "both", "paths.npz")), results
+    )
+
+
+@pytest.mark.parametrize("input_file", ["paths.txt", "paths.npz"])
+@pytest.mark.parametrize("stream", [[], ["--stream"]])
+def test_empty_input(data_dir, input_file, stream):
+    write_inputs(data_dir, [], np.savez)
+    run(data_dir, "text", *stream, input_file)
+    run(data_dir, "npz", "--output_format", "npz", *stream, input_file)
+    assert read_text(os.path.join(data_dir, "text", "paths.txt")).shape == \
+        (0, 4)
+    assert read_npz(os.path.join(data_dir, "npz", "paths.npz")).shape == \
+        (0, 4)
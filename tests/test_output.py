@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+# elevations from integer rasters are written as integers, as they always
+# have been, and those from float rasters as floats
+
+import os
+from typing import Iterator, Tuple
+
+import numpy as np
+import pytest
+
+from cache import ResultStore
+from conftest import raster_source, write_dem, write_sources
+from data import SourceRouter
+from files import format_elevations, tag_stored_batches
+
+
+# a line climbing from 512 to 524, and a point with no data
+COORDS: np.ndarray = np.array([
+    [0.0005, 50.9995], [0.0105, 50.9995], [0.0205, 50.9895],
+    [0.5, 50.5]
+])
+OFFSETS: np.ndarray = np.array([0, 3, 4])
+
+
+
+
+@pytest.fixture(params=[np.int16, np.float32])
+def dem_router(tmp_path, request) -> Iterator[Tuple[SourceRouter, np.dtype]]:
+    # a 0.001° DEM of the area (0, 50, 1, 51), where every pixel is 512 plus
+    # its row plus its column / 10, and with no data at (0.5, 50.5)
+    rows, cols = np.mgrid[0:1000, 0:1000]
+    values: np.ndarray = (512 + rows + cols // 10).astype(request.param)
+    values[500, 500] = -32768
+    write_dem(os.path.join(tmp_path, "dem.tif"), 0, 51, 0.001, values)
+    sources: str = os.path.join(tmp_path, "datasources.json")
+    write_sources(sources, [raster_source("dem.tif", (0, 50, 1, 51))])
+    router = SourceRouter(__name__, str(tmp_path), sources, None)
+    yield router, np.dtype(request.param)
+    router.close()
+
+
+def test_written_as_the_raster_values_are(dem_router, tmp_path):
+    router, dtype = dem_router
+    results: np.ndarray = router.tag_paths(COORDS, OFFSETS, 1)
+    if np.issubdtype(dtype, np.integer):
+        assert format_elevations(results) == "512\t524\t12\t0\n\n"
+    else:
+        assert format_elevations(results) == \
+            "512.0\t524.0\t12.0\t0\n\n"
+    # and the same when looked up for a store, and then copied from it
+    path: str = os.path.join(tmp_path, "store.npz")
+    for run in range(2):
+        store = ResultStore(__name__, path)
+        tagged = list(tag_stored_batches(
+            router, [((0, COORDS, OFFSETS), store)], 1
+        ))
+        store.save()
+        assert tagged[0].dtype == results.dtype
+        np.testing.assert_array_equal(tagged[0], results)
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+# progress reported through ProgressBoards
+
+import os
+import subprocess
+import sys
+
+import numpy as np
+from shapely.geometry import box  # type: ignore
+
+from data import DataSource
+from progress import CHUNKS, FIELDS, LINES, PID, ProgressBoard
+
+
+def test_replacement_worker_takes_over_a_dead_workers_row():
+    board = ProgressBoard(2)
+    assert board.claim() == 0
+    board.start_chunk(0)
+    board.finish_chunk(0, 10, 20)
+    # a worker that has since exited, having done 5 lines
+    dead = subprocess.Popen([sys.executable, "-c", "pass"])
+    dead.wait()
+    board.values[len(FIELDS) + PID] = dead.pid
+    board.values[len(FIELDS) + LINES] = 5
+    # the live worker's row is left alone
+    assert board.claim() == 1
+    rows: np.ndarray = board.read()
+    assert rows[:, PID].tolist() == [os.getpid(), os.getpid()]
+    assert rows[:, LINES].tolist() == [10, 5]
+
+
+def test_serial_lookups_report_progress_chunk_by_chunk(dem_dir):
+    n_lines: int = 1000
+    xs: np.ndarray = np.linspace(0.1, 0.9, n_lines)
+    coords: np.ndarray = np.stack([xs, np.full(n_lines, 51.0)], axis=1)
+    with DataSource(
+        __name__,
+        dem_dir,
+        os.path.join(dem_dir, "datasources.json"),
+        box(0, 50, 1, 52)
+    ) as d:
+        d.tag_paths(coords, np.arange(n_lines + 1), 1)
+        rows: np.ndarray = d.local_board.read()  # type: ignore
+    assert rows[0, LINES] == n_lines
+    assert rows[0, CHUNKS] > 1
@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+# raster lookups shouldn't depend on the area that's loaded around them
+
+import os
+
+import numpy as np
+import pytest
+import rasterio  # type: ignore
+
+from api import ElevationLookup
+
+
+def expected_elevations(dem_dir: str, coords: np.ndarray) -> np.ndarray:
+    # read straight from the whole DEM, the way the original version did
+    with rasterio.open(os.path.join(dem_dir, "dem.tif")) as dem:
+        values: np.ndarray = dem.read(1)
+        return np.array([
+            values[dem.index(x, y)] for x, y in coords
+        ], dtype=np.float64)
+
+
+@pytest.mark.parametrize("block_cache_mb", [0, 1])
+def test_vertices_on_the_edges_of_the_loaded_area(dem_dir, block_cache_mb):
+    # each line's bbox is loaded for it alone, so its south and east edges
+    # fall exactly on the lines' vertices, and pixel boundaries
+    sources: str = os.path.join(dem_dir, "datasources.json")
+    coords: np.ndarray = np.array([[0.1, 51.0], [0.2, 51.1]])
+    expected: np.ndarray = expected_elevations(dem_dir, coords)
+    with ElevationLookup(
+        sources,
+        data_dir=dem_dir,
+        block_cache_mb=block_cache_mb
+    ) as lookup:
+        np.testing.assert_allclose(lookup.sample_points(coords), expected)
+        np.testing.assert_allclose(
+            lookup.tag_paths(coords, np.array([0, 2])),
+            [[
+                expected[0],
+                expected[1],
+                max(expected[1] - expected[0], 0),
+                max(expected[0] - expected[1], 0)
+            ]],
+            rtol=1e-6
+        )
+    # and the same as when the whole area is loaded up front
+    with ElevationLookup(
+        sources,
+        bbox=(0, 50, 1, 52),
+        data_dir=dem_dir,
+        block_cache_mb=block_cache_mb
+    ) as lookup:
+        np.testing.assert_allclose(lookup.sample_points(coords), expected)
@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+# routing lines between sources, and loading each source for the areas of
+# the lines routed to it
+
+import os
+from typing import List
+
+import numpy as np
+import pytest
+from shapely.geometry import box  # type: ignore
+
+from api import ElevationLookup
+from conftest import raster_source, write_dem, write_sources
+from data import DataSource, NULL_ELEVATION, SourceRouter
+
+# two groups of lines at opposite corners of dem.tif, several of them
+# crossing from one cell of the clustering grid into the next, and with
+# vertices between the DEM's pixel centres
+GROUPS: List[List[List[float]]] = [
+    [[0.0503, 50.0507], [0.1512, 50.1021]],
+    [[0.0991, 50.1992], [0.1009, 50.2017], [0.0987, 50.2051]],
+    [[0.2004, 50.1996]],
+    [[0.8021, 51.7013], [0.7988, 51.8027]],
+    [[0.8993, 51.8991], [0.9012, 51.9018], [0.8507, 51.9507]],
+    [[0.7497, 51.7503]]
+]
+# and one spanning both groups, which joins them into one cluster
+SPANNING: List[List[float]] = [[0.1502, 50.1507], [0.8508, 51.8003]]
+
+
+
+
+def test_lines_in_a_source_outside_bbox(dem_dir):
+    # a second source, which doesn't overlap the bbox loaded for at all
+    rows, cols = np.mgrid[0:1000, 0:1000]
+    write_dem(
+        os.path.join(dem_dir, "far.tif"),
+        5,
+        51,
+        0.001,
+        (rows + cols).astype(np.float32)
+    )
+    sources: str = os.path.join(dem_dir, "datasources.json")
+    write_sources(sources, [
+        raster_source("dem.tif", (0, 50, 1, 52)),
+        raster_source("far.tif", (5, 50, 6, 51))
+    ])
+    coords: np.ndarray = np.array([
+        [0.5, 51.5], [0.6, 51.5],
+        [5.5, 50.5], [5.6, 50.5]
+    ])
+    with ElevationLookup(
+        sources,
+        bbox=(0, 50, 1, 52),
+        data_dir=dem_dir
+    ) as lookup:
+        # and again, as a source that failed to load would fail again
+        for i in range(2):
+            results: np.ndarray = lookup.tag_paths(
+                coords, np.array([0, 2, 4])
+            )
+            assert not np.isnan(results[0]).any()
+            assert np.isnan(results[1, :2]).all()
+
+
+@pytest.mark.parametrize("paths, n_clusters", [
+    (GROUPS, 2),
+    (GROUPS + [SPANNING], 1)
+])
+def test_clusters_match_one_load(dem_dir, paths, n_clusters):
+    # Loading each cluster of lines separately gives the same results as
+    # loading the whole area at once, whether the input is streamed or not
+    sources: str = os.path.join(dem_dir, "datasources.json")
+    coords: np.ndarray = np.array([point for path in paths for point in path])
+    offsets: np.ndarray = np.cumsum([0] + [len(path) for path in paths])
+    with SourceRouter(__name__, dem_dir, sources, None) as router:
+        whole = DataSource(
+            __name__,
+            dem_dir,
+            sources,
+            box(0, 50, 1, 52),
+            source=router.sources[0]
+        )
+        try:
+            expected: np.ndarray = whole.tag_paths(coords, offsets, 1)
+        finally:
+            whole.close()
+        assert not (expected == NULL_ELEVATION).any()
+        np.testing.assert_array_equal(
+            router.tag_paths(coords, offsets, 1), expected
+        )
+        _, cluster_of = router.clusters[0]
+        assert len(set(cluster_of.values())) == n_clusters
+    # streamed in batches of two lines, which split each group up
+    batches = [
+        (
+            start,
+            coords[offsets[start]:offsets[start:start + 3][-1]],
+            offsets[start:start + 3] - offsets[start]
+        )
+        for start in range(0, len(paths), 2)
+    ]
+    with SourceRouter(__name__, dem_dir, sources, None) as router:
+        router.survey(batches)
+        assert len(router.partition_bounds) == n_clusters
+        np.testing.assert_array_equal(
+            np.concatenate(list(router.tag_batches(batches, 1))), expected
+        )
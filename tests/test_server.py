@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+# the lookup server, answering requests from a thread of the test process
+
+import os
+import threading
+import urllib.error
+import urllib.request
+from typing import Iterator, Tuple
+
+import numpy as np
+import pytest
+from shapely.geometry import box  # type: ignore
+
+from conftest import raster_source, write_dem, write_sources
+from data import SourceRouter
+from files import format_elevations
+from server import Lookup, LookupHTTPServer, LookupRequestHandler
+
+PATHS: str = "0.1,51.0 0.2,51.1\n0.5,50.5\n"
+
+
+
+
+@pytest.fixture
+def server(dem_dir) -> Iterator[Tuple[str, str]]:
+    # the server's URL, and the data source list it was loaded from
+    sources: str = os.path.join(dem_dir, "datasources.json")
+    lookup = Lookup(__name__, dem_dir, sources, box(0, 50, 1, 52), 1)
+    httpd = LookupHTTPServer(("127.0.0.1", 0), LookupRequestHandler)
+    httpd.lookup = lookup  # type: ignore
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield "http://127.0.0.1:%s" % httpd.server_address[1], sources
+    httpd.shutdown()
+    httpd.server_close()
+    lookup.close()
+
+
+def post(url: str, body: str) -> Tuple[int, str]:
+    try:
+        with urllib.request.urlopen(url + "/tag", body.encode("utf-8")) as r:
+            return r.status, r.read().decode("utf-8")
+    except urllib.error.HTTPError as e:
+        return e.code, ""
+
+
+def expected(sources: str, dem_dir: str) -> str:
+    # the same paths, tagged without the server
+    router = SourceRouter(__name__, dem_dir, sources, None)
+    try:
+        return format_elevations(router.tag_paths(
+            np.array([[0.1, 51.0], [0.2, 51.1], [0.5, 50.5]]),
+            np.array([0, 2, 3]),
+            1
+        ))
+    finally:
+        router.close()
+
+
+def edit_sources(sources: str, entries) -> None:
+    # rewrites the data source list, making sure its mtime changes
+    mtime: float = os.stat(sources).st_mtime
+    write_sources(sources, entries)
+    os.utime(sources, (mtime + 1, mtime + 1))
+
+
+def test_tags_paths(server, dem_dir):
+    url, sources = server
+    assert post(url, PATHS) == (200, expected(sources, dem_dir))
+
+
+def test_empty_request(server):
+    url, sources = server
+    assert post(url, "") == (200, "")
+
+
+def test_unparseable_paths(server):
+    url, sources = server
+    assert post(url, "0.1,51.0 nonsense\n")[0] == 400
+
+
+def test_unexpected_errors_get_a_response(server, monkeypatch):
+    url, sources = server
+
+    def fail(*args, **kwargs):
+        raise TypeError("unexpected")
+
+    monkeypatch.setattr(SourceRouter, "submit", fail)
+    assert post(url, PATHS)[0] == 500
+    monkeypatch.undo()
+    assert post(url, PATHS)[0] == 200
+
+
+def test_metrics(server):
+    url, sources = server
+    post(url, PATHS)
+    with urllib.request.urlopen(url + "/metrics") as r:
+        assert r.status == 200
+        assert "lines" in r.read().decode("utf-8")
+
+
+def test_reloads_changed_sources(server, dem_dir):
+    url, sources = server
+    before: str = post(url, PATHS)[1]
+    # the same area, with every value 1m higher
+    rows, cols = np.mgrid[0:2000, 0:1000]
+    write_dem(
+        os.path.join(dem_dir, "higher.tif"),
+        0,
+        52,
+        0.001,
+        (rows * 0.01 + cols * 0.1 + 1).astype(np.float32)
+    )
+    edit_sources(sources, [raster_source("higher.tif", (0, 50, 1, 52))])
+    after: str = post(url, PATHS)[1]
+    assert after == expected(sources, dem_dir)
+    assert after != before
+
+
+def test_retries_a_failed_reload(server, dem_dir):
+    url, sources = server
+    before: str = post(url, PATHS)[1]
+    edit_sources(sources, [raster_source("missing.tif", (0, 50, 1, 52))])
+    assert post(url, PATHS)[0] == 500
+    # still failing, rather than going back to the old sources unnoticed
+    assert post(url, PATHS)[0] == 500
+    edit_sources(sources, [raster_source("dem.tif", (0, 50, 1, 52))])
+    assert post(url, PATHS) == (200, before)
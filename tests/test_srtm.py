@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+# SRTM tile downloads, with elevation's clip swapped for a local stand-in
+
+import os
+import threading
+import time
+from typing import Dict, List
+
+import numpy as np
+import pytest
+import requests
+from elevation.datasource import srtm1_tiles_names  # type: ignore
+from shapely.geometry import box  # type: ignore
+
+import data
+from api import ElevationLookup
+from conftest import write_dem, write_sources
+from data import DataSource, DataSourceError
+
+
+
+
+class FakeClip:
+    # Stands in for elevation.clip, writing a small tile for the bounds it's
+    # given after a short delay, and recording how many calls overlap
+
+    def __init__(self, fail: bool = False) -> None:
+        self.fail: bool = fail
+        self.lock = threading.Lock()
+        self.calls: List[List[int]] = []
+        self.running: int = 0
+        self.most_running: int = 0
+        # the paths the tiles were written to, and whether anything was at
+        # the final path yet
+        self.outputs: List[str] = []
+
+    def __call__(self, bounds: List[int], output: str, cache_dir: str) -> None:
+        with self.lock:
+            self.calls.append(bounds)
+            self.outputs.append(output)
+            self.running += 1
+            self.most_running = max(self.most_running, self.running)
+        try:
+            time.sleep(0.2)
+            if self.fail:
+                raise OSError("download failed")
+            self.write_tile(bounds, output)
+        finally:
+            with self.lock:
+                self.running -= 1
+
+    def write_tile(self, bounds: List[int], output: str) -> None:
+        write_dem(
+            output,
+            bounds[0],
+            bounds[3],
+            0.1,
+            np.full((10, 10), bounds[0] * 10 + bounds[1], dtype=np.int16)
+        )
+
+
+
+
+class ServedClip(FakeClip):
+    # As for FakeClip, but fetching each tile over HTTP from a server with
+    # them at the paths elevation would download them from
+
+    def __init__(self, url: str) -> None:
+        super().__init__()
+        self.url: str = url
+
+    def write_tile(self, bounds: List[int], output: str) -> None:
+        for name in srtm1_tiles_names(*bounds):
+            response = requests.get(self.url + "/" + name)
+            response.raise_for_status()
+            with open(output, 'wb') as f:
+                f.write(response.content)
+
+
+@pytest.fixture
+def srtm_dir(tmp_path) -> str:
+    # a data directory with an empty data source list, so SRTM is used
+    write_sources(os.path.join(tmp_path, "datasources.json"), [])
+    return str(tmp_path)
+
+
+def load(srtm_dir: str, bounds: List[float]) -> None:
+    DataSource(
+        __name__,
+        srtm_dir,
+        os.path.join(srtm_dir, "datasources.json"),
+        box(*bounds)
+    ).close()
+
+
+def tile_dir_contents(srtm_dir: str) -> List[str]:
+    return sorted(os.listdir(os.path.join(srtm_dir, "srtm")))
+
+
+def tile_content(tmp_path: str, x: int, y: int) -> bytes:
+    # a 0.1° tile of the 1° square to the north east of x, y, in which each
+    # pixel's value is 100 (10 x + y) + 10 row + column
+    path: str = os.path.join(tmp_path, "tile.tif")
+    rows, cols = np.mgrid[0:10, 0:10]
+    write_dem(
+        path,
+        x,
+        y + 1,
+        0.1,
+        (100 * (10 * x + y) + 10 * rows + cols).astype(np.int16)
+    )
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def test_tiles_are_fetched_concurrently(monkeypatch, srtm_dir):
+    clip = FakeClip()
+    monkeypatch.setattr(data.eio, "clip", clip)
+    load(srtm_dir, [5.5, 45.5, 7.5, 47.5])
+    assert sorted(clip.calls) == [
+        [x, y, x + 1, y + 1] for x in [5, 6, 7] for y in [45, 46, 47]
+    ]
+    assert clip.most_running > 1
+    # just the tiles are left: no lock files or working directories
+    assert tile_dir_contents(srtm_dir) == sorted(
+        "srtm.%s.%s.tif" % (x, y) for x in [5, 6, 7] for y in [45, 46, 47]
+    )
+
+
+def test_tiles_are_renamed_into_place(monkeypatch, srtm_dir):
+    clip = FakeClip()
+    monkeypatch.setattr(data.eio, "clip", clip)
+    load(srtm_dir, [5.5, 45.5, 6.5, 46.5])
+    # written elsewhere, each in its own working directory
+    assert len(set(os.path.dirname(path) for path in clip.outputs)) == 4
+    for path in clip.outputs:
+        assert os.path.dirname(os.path.dirname(path)) == \
+            os.path.join(srtm_dir, "srtm")
+    failing = FakeClip(fail=True)
+    monkeypatch.setattr(data.eio, "clip", failing)
+    with pytest.raises(OSError):
+        load(srtm_dir, [8.5, 45.5, 8.6, 45.6])
+    # a failed download leaves nothing behind, not even a partial tile
+    assert tile_dir_contents(srtm_dir) == sorted(
+        "srtm.%s.%s.tif" % (x, y) for x in [5, 6] for y in [45, 46]
+    )
+
+
+def test_each_tile_is_fetched_once(monkeypatch, srtm_dir):
+    clip = FakeClip()
+    monkeypatch.setattr(data.eio, "clip", clip)
+    errors: Dict[int, Exception] = {}
+
+    def load_overlapping(i: int) -> None:
+        try:
+            load(srtm_dir, [5.5 + i * 0.1, 45.5, 6.5 + i * 0.1, 46.5])
+        except (DataSourceError, OSError) as e:
+            errors[i] = e
+
+    # all of these need the same tiles, and wait for each other's downloads
+    threads: List[threading.Thread] = [
+        threading.Thread(target=load_overlapping, args=(i,))
+        for i in range(4)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == {}
+    assert sorted(clip.calls) == [
+        [x, y, x + 1, y + 1] for x in [5, 6] for y in [45, 46]
+    ]
+    assert tile_dir_contents(srtm_dir) == sorted(
+        "srtm.%s.%s.tif" % (x, y) for x in [5, 6] for y in [45, 46]
+    )
+
+
+def test_points_on_whole_degrees(monkeypatch, srtm_dir):
+    clip = FakeClip()
+    monkeypatch.setattr(data.eio, "clip", clip)
+    with ElevationLookup(
+        os.path.join(srtm_dir, "datasources.json"),
+        data_dir=srtm_dir
+    ) as lookup:
+        # in the tile to the south east, whose values are 10 x + y
+        assert lookup.sample_points([[5.0, 5.0]]).tolist() == [54]
+        assert lookup.sample_points([[5.0, 5.5], [6.0, 5.0]]).tolist() == \
+            [55, 64]
+
+
+def test_served_tiles_are_merged(monkeypatch, srtm_dir, server):
+    server.files = {
+        "/N%s/N%sE00%s.tif" % (y, y, x): tile_content(srtm_dir, x, y)
+        for x in [5, 6] for y in [45, 46]
+    }
+    clip = ServedClip("http://127.0.0.1:%s" % server.server_address[1])
+    monkeypatch.setattr(data.eio, "clip", clip)
+    with ElevationLookup(
+        os.path.join(srtm_dir, "datasources.json"),
+        bbox=(5.05, 45.05, 6.95, 46.95),
+        data_dir=srtm_dir
+    ) as lookup:
+        # a path through all four tiles, loaded as one mosaic of them
+        results: np.ndarray = lookup.tag_paths(
+            np.array([
+                [5.25, 45.75], [6.55, 45.15], [5.95, 46.05], [6.05, 46.95]
+            ]),
+            np.array([0, 4])
+        )
+    assert results.tolist() == [[9522, 10600, 1964, 886]]
+    # one request for each tile, as anything else isn't found
+    assert len(server.requests) == 4
+    assert clip.most_running > 1
+    assert tile_dir_contents(srtm_dir) == sorted(
+        "srtm.%s.%s.tif" % (x, y) for x in [5, 6] for y in [45, 46]
+    )